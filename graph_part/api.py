@@ -6,6 +6,7 @@ import numpy as np
 import os
 import pandas as pd
 from .graph_part import run_partitioning
+from .temp_utils import tmp_dir_context
 
 
 def _write_fasta(sequences: Dict[str,str], labels: Dict[str,str] = None, priority: Dict[str,str] = None, fname='graphpart_api.fasta.tmp') -> None:
@@ -82,11 +83,21 @@ def stratified_k_fold(sequences: Union[List[str], np.ndarray, Dict[str,str]],
                      no_moving: bool = False,
                      remove_same: bool = False,
                      save_checkpoint_path: str = None,
+                     checkpoint_format: str = 'csv',
                      denominator: str = 'full',
                      nucleotide: bool = False,
+                     prefilter: bool = False,
+                     prefilter_kmer: int = None,
+                     prefilter_min_shared: int = None,
+                     cache_dir: str = None,
+                     cache_size: float = 10,
+                     run_dir: str = None,
+                     resume: bool = False,
+                     distributed: bool = False,
+                     tmp_dir: str = None,
                      triangular: bool = False,
                      threads: int = 4,
-                     chunks: int = 10,
+                     chunks: int = None,
                      parallel_mode: str = 'multithread',
                      gapopen: float = 10,
                      gapextend: float = 0.5,
@@ -123,52 +134,63 @@ def stratified_k_fold(sequences: Union[List[str], np.ndarray, Dict[str,str]],
     #TODO add warnings that arguments will be ignored depending on alignment_mode.
     '''
     # 1. Validate arguments.
-    if alignment_mode not in ['mmseqs2', 'needle', 'precomputed']:
-        raise NotImplementedError(f'Alignment mode {alignment_mode} is not implemented. Choose either `needle` or `mmseqs2`.')
+    if alignment_mode not in ['mmseqs2', 'needle', 'nw', 'precomputed']:
+        raise NotImplementedError(f'Alignment mode {alignment_mode} is not implemented. Choose either `needle`, `nw` or `mmseqs2`.')
 
     # Sort out the input formats.
     original_type = type(sequences)
     sequences, labels, priority = _convert_to_dict(sequences, labels, priority)
 
     # 2. Write the data to a temporary fasta file for alignment.
-    _write_fasta(sequences, labels, priority, 'graphpart_api.fasta.tmp')
-
-    config = {
-        "alignment_mode": alignment_mode,
-        "fasta_file": "graphpart_api.fasta.tmp",
-        "threshold": threshold,
-        "partitions": partitions,
-        "transformation": transformation,
-        "out_file": "graphpart_python", # not used anyway
-        "priority_name": "priority" if priority is not None else None,
-        "labels_name": "label" if labels is not None else None,
-        "initialization_mode": initialization_mode,
-        "no_moving": no_moving,
-        "remove_same": remove_same,
-        "test_ratio": 0,
-        "val_ratio": 0,
-        "save_checkpoint_path": save_checkpoint_path,
-        "denominator": denominator,
-        "nucleotide": nucleotide,
-        "triangular": triangular,
-        "threads": threads,
-        "chunks": chunks,
-        "parallel_mode": parallel_mode,
-        "gapopen": gapopen,
-        "gapextend": gapextend,
-        "endweight": endweight,
-        "endopen": endopen,
-        "endextend": endextend,
-        "matrix": matrix,
-        "edge_file": edge_file,
-        "metric_column": metric_column,
-        "allow_moving": not no_moving, # silly conversions because in the CLI we want to have those default-false.
-        "removal_type": not remove_same,
-    }
-
-    # 3. Partition
-    partition_assignment_df = run_partitioning(config, write_output_file=False, write_json_report=False, verbose=False)
-    os.remove(config['fasta_file'])
+    # the input file is removed also when partitioning fails.
+    with tmp_dir_context(tmp_dir) as api_tmp_dir:
+        _write_fasta(sequences, labels, priority, os.path.join(api_tmp_dir, 'graphpart_api.fasta'))
+
+        config = {
+            "alignment_mode": alignment_mode,
+            "fasta_file": os.path.join(api_tmp_dir, 'graphpart_api.fasta'),
+            "threshold": threshold,
+            "partitions": partitions,
+            "transformation": transformation,
+            "out_file": "graphpart_python", # not used anyway
+            "priority_name": "priority" if priority is not None else None,
+            "labels_name": "label" if labels is not None else None,
+            "initialization_mode": initialization_mode,
+            "no_moving": no_moving,
+            "remove_same": remove_same,
+            "test_ratio": 0,
+            "val_ratio": 0,
+            "save_checkpoint_path": save_checkpoint_path,
+            "checkpoint_format": checkpoint_format,
+            "denominator": denominator,
+            "nucleotide": nucleotide,
+            "prefilter": prefilter,
+            "prefilter_kmer": prefilter_kmer,
+            "prefilter_min_shared": prefilter_min_shared,
+            "cache_dir": cache_dir,
+            "cache_size": cache_size,
+            "run_dir": run_dir,
+            "resume": resume,
+            "distributed": distributed,
+            "tmp_dir": tmp_dir,
+            "triangular": triangular,
+            "threads": threads,
+            "chunks": chunks,
+            "parallel_mode": parallel_mode,
+            "gapopen": gapopen,
+            "gapextend": gapextend,
+            "endweight": endweight,
+            "endopen": endopen,
+            "endextend": endextend,
+            "matrix": matrix,
+            "edge_file": edge_file,
+            "metric_column": metric_column,
+            "allow_moving": not no_moving, # silly conversions because in the CLI we want to have those default-false.
+            "removal_type": not remove_same,
+        }
+
+        # 3. Partition
+        partition_assignment_df = run_partitioning(config, write_output_file=False, write_json_report=False, verbose=False)
 
     # 4. Make output lists.
     partition_assignment_df = partition_assignment_df.reset_index()
@@ -197,12 +219,21 @@ def train_test_validation_split(sequences: Union[List[str], np.ndarray, Dict[str
                      no_moving: bool = False,
                      remove_same: bool = False,
                      save_checkpoint_path: str = None,
+                     checkpoint_format: str = 'csv',
                      denominator: str = 'full',
                      nucleotide: bool = False,
                      prefilter: bool = False,
+                     prefilter_kmer: int = None,
+                     prefilter_min_shared: int = None,
+                     cache_dir: str = None,
+                     cache_size: float = 10,
+                     run_dir: str = None,
+                     resume: bool = False,
+                     distributed: bool = False,
+                     tmp_dir: str = None,
                      triangular: bool = False,
                      threads: int = 4,
-                     chunks: int = 10,
+                     chunks: int = None,
                      parallel_mode: str = 'multithread',
                      gapopen: float = 10,
                      gapextend: float = 0.5,
@@ -240,8 +271,8 @@ def train_test_validation_split(sequences: Union[List[str], np.ndarray, Dict[str
 
     '''
     # 1. Validate arguments.
-    if alignment_mode not in ['mmseqs2', 'needle', 'precomputed']:
-        raise NotImplementedError(f'Alignment mode {alignment_mode} is not implemented. Choose either `needle` or `mmseqs2`.')
+    if alignment_mode not in ['mmseqs2', 'needle', 'nw', 'precomputed']:
+        raise NotImplementedError(f'Alignment mode {alignment_mode} is not implemented. Choose either `needle`, `nw` or `mmseqs2`.')
 
     if test_size*100 % 5 !=0 or valid_size*100 % 5 != 0:
         raise NotImplementedError('Graph-Part currently only supports ratios that are a multiple of 0.05!')
@@ -263,45 +294,55 @@ def train_test_validation_split(sequences: Union[List[str], np.ndarray, Dict[str
     sequences, labels, priority = _convert_to_dict(sequences, labels, priority)
 
     # 2. Write the data to a temporary fasta file for alignment.
-    _write_fasta(sequences, labels, priority, 'graphpart_api.fasta.tmp')
-
-    config = {
-        "alignment_mode": alignment_mode,
-        "fasta_file": "graphpart_api.fasta.tmp",
-        "threshold": threshold,
-        "partitions": partitions,
-        "transformation": transformation,
-        "out_file": "graphpart_python", # not used anyway
-        "priority_name": "priority" if priority is not None else None,
-        "labels_name": "label" if labels is not None else None,
-        "initialization_mode": initialization_mode,
-        "no_moving": no_moving,
-        "remove_same": remove_same,
-        "test_ratio": test_size,
-        "val_ratio": valid_size,
-        "save_checkpoint_path": save_checkpoint_path,
-        "denominator": denominator,
-        "nucleotide": nucleotide,
-        "prefilter": prefilter,
-        "triangular": triangular,
-        "threads": threads,
-        "chunks": chunks,
-        "parallel_mode": parallel_mode,
-        "gapopen": gapopen,
-        "gapextend": gapextend,
-        "endweight": endweight,
-        "endopen": endopen,
-        "endextend": endextend,
-        "matrix": matrix,
-        "edge_file": edge_file,
-        "metric_column": metric_column,
-        "allow_moving": not no_moving, # silly conversions because in the CLI we want to have those default-false.
-        "removal_type": not remove_same,
-    }
-
-    # 3. Partition
-    partition_assignment_df = run_partitioning(config, write_output_file=False, write_json_report=False, verbose=False)
-    os.remove(config['fasta_file'])
+    # the input file is removed also when partitioning fails.
+    with tmp_dir_context(tmp_dir) as api_tmp_dir:
+        _write_fasta(sequences, labels, priority, os.path.join(api_tmp_dir, 'graphpart_api.fasta'))
+
+        config = {
+            "alignment_mode": alignment_mode,
+            "fasta_file": os.path.join(api_tmp_dir, 'graphpart_api.fasta'),
+            "threshold": threshold,
+            "partitions": partitions,
+            "transformation": transformation,
+            "out_file": "graphpart_python", # not used anyway
+            "priority_name": "priority" if priority is not None else None,
+            "labels_name": "label" if labels is not None else None,
+            "initialization_mode": initialization_mode,
+            "no_moving": no_moving,
+            "remove_same": remove_same,
+            "test_ratio": test_size,
+            "val_ratio": valid_size,
+            "save_checkpoint_path": save_checkpoint_path,
+            "checkpoint_format": checkpoint_format,
+            "denominator": denominator,
+            "nucleotide": nucleotide,
+            "prefilter": prefilter,
+            "prefilter_kmer": prefilter_kmer,
+            "prefilter_min_shared": prefilter_min_shared,
+            "cache_dir": cache_dir,
+            "cache_size": cache_size,
+            "run_dir": run_dir,
+            "resume": resume,
+            "distributed": distributed,
+            "tmp_dir": tmp_dir,
+            "triangular": triangular,
+            "threads": threads,
+            "chunks": chunks,
+            "parallel_mode": parallel_mode,
+            "gapopen": gapopen,
+            "gapextend": gapextend,
+            "endweight": endweight,
+            "endopen": endopen,
+            "endextend": endextend,
+            "matrix": matrix,
+            "edge_file": edge_file,
+            "metric_column": metric_column,
+            "allow_moving": not no_moving, # silly conversions because in the CLI we want to have those default-false.
+            "removal_type": not remove_same,
+        }
+
+        # 3. Partition
+        partition_assignment_df = run_partitioning(config, write_output_file=False, write_json_report=False, verbose=False)
 
     # 4. Make output lists.
     partition_assignment_df = partition_assignment_df.reset_index()
@@ -0,0 +1,259 @@
+'''
+On-disk cache of pairwise alignment results.
+Results are keyed by a hash of each of the two sequences and by the
+parameters of the aligner, so they stay valid when sequences are added,
+removed or relabelled between runs. The cache is a SQLite database in
+the cache directory. When it grows beyond its maximum size, the pairs of
+the least recently used sequences are evicted.
+
+Files that are expensive to build from a whole input file, such as the
+mmseqs2 sequence databases, are kept in a directory cache instead.
+Both kinds of cache in a cache directory share one maximum size.
+'''
+import hashlib
+import json
+import math
+import os
+import shutil
+import socket
+import sqlite3
+import time
+from typing import Any, Callable, Dict, List, Tuple
+import numpy as np
+
+
+## Default maximum size of the cache database, in GB.
+DEFAULT_CACHE_SIZE = 10
+
+## Maximum number of (query, library) pairs that are looked up at once.
+LOOKUP_CELLS = 1 << 22
+
+## After eviction, the cache is this fraction of its maximum size.
+EVICT_TO = 0.9
+
+ALIGNMENTS_DB = 'alignments.sqlite'
+
+
+def tree_size(path: str) -> int:
+    '''Size in bytes of a file, or of all files below a directory. Files removed meanwhile are skipped.'''
+    paths = [path] if not os.path.isdir(path) else (os.path.join(root, file) for root, _, files in os.walk(path) for file in files)
+    total = 0
+    for file in paths:
+        try:
+            total += os.lstat(file).st_size
+        except FileNotFoundError:
+            # another process evicted it.
+            pass
+    return total
+
+
+def cache_usage(cache_dir: str, exclude: str) -> int:
+    '''Size in bytes of the files in cache_dir, without the top-level entries whose name starts with exclude.'''
+    return sum(tree_size(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir) if not name.startswith(exclude))
+
+
+def sequence_hashes(seqs: List[str]) -> np.ndarray:
+    '''64-bit hashes of the uppercased sequences.'''
+    return np.array([int.from_bytes(hashlib.blake2b(seq.upper().encode(), digest_size=8).digest(), 'little', signed=True) for seq in seqs], dtype=np.int64)
+
+
+class AlignmentCache():
+    '''
+    Identities of (query, library) sequence pairs for one set of aligner parameters.
+    A pair can be cached without identity, when the aligner did not report it.
+    max_size (GB) applies to the whole cache_dir, including other caches in it.
+    '''
+
+    def __init__(self, cache_dir: str, params: Dict[str, Any], max_size: float = DEFAULT_CACHE_SIZE):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_size = max_size * 1024**3
+        self.db = sqlite3.connect(os.path.join(cache_dir, ALIGNMENTS_DB), timeout=600)
+        # only takes effect when the database is created, allows shrinking the file after eviction.
+        self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS params (id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS pairs (params INTEGER, a INTEGER, b INTEGER, identity REAL, PRIMARY KEY (params, a, b)) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sequences (params INTEGER, h INTEGER, last_used REAL, PRIMARY KEY (params, h)) WITHOUT ROWID')
+        self.db.execute('CREATE TEMP TABLE qry (h INTEGER PRIMARY KEY)')
+        self.db.execute('CREATE TEMP TABLE lib (h INTEGER PRIMARY KEY)')
+
+        key = json.dumps(params, sort_keys=True)
+        self.db.execute('INSERT OR IGNORE INTO params (key) VALUES (?)', (key,))
+        self.params = self.db.execute('SELECT id FROM params WHERE key = ?', (key,)).fetchone()[0]
+        self.db.commit()
+
+    def touch(self, hashes: np.ndarray) -> None:
+        '''Mark sequences as used now, eviction removes the least recently used ones first.'''
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO sequences VALUES (?, ?, ?)', ((self.params, h, now) for h in np.unique(hashes).tolist()))
+        self.db.commit()
+
+    def lookup(self, qry_hashes: np.ndarray, lib_hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Look up all pairs of the given queries and libraries.
+        Returns a (query, library) mask of the cached pairs and their identities,
+        NaN for pairs that are cached without identity.
+        '''
+        qrys, qry_inverse = np.unique(qry_hashes, return_inverse=True)
+        libs, lib_inverse = np.unique(lib_hashes, return_inverse=True)
+        self.db.execute('DELETE FROM qry')
+        self.db.execute('DELETE FROM lib')
+        self.db.executemany('INSERT INTO qry VALUES (?)', ((h,) for h in qrys.tolist()))
+        self.db.executemany('INSERT INTO lib VALUES (?)', ((h,) for h in libs.tolist()))
+        # CROSS JOIN fixes the join order, so that each pair is one primary key lookup.
+        rows = self.db.execute('SELECT p.a, p.b, p.identity FROM qry CROSS JOIN lib CROSS JOIN pairs p '
+                               'WHERE p.params = ? AND p.a = qry.h AND p.b = lib.h', (self.params,)).fetchall()
+
+        found = np.zeros((len(qrys), len(libs)), dtype=bool)
+        identity = np.full((len(qrys), len(libs)), np.nan)
+        if len(rows) > 0:
+            a, b, ident = zip(*rows)
+            a, b = np.searchsorted(qrys, np.array(a, dtype=np.int64)), np.searchsorted(libs, np.array(b, dtype=np.int64))
+            found[a, b] = True
+            identity[a, b] = np.array(ident, dtype=np.float64)
+
+        qry_inverse, lib_inverse = qry_inverse.reshape(-1), lib_inverse.reshape(-1)
+        return found[qry_inverse][:, lib_inverse], identity[qry_inverse][:, lib_inverse]
+
+    def store(self, qry_hashes: np.ndarray, lib_hashes: np.ndarray, identities: np.ndarray) -> None:
+        '''Store the identities of (query, library) pairs, NaN for pairs without identity.'''
+        identities = [None if math.isnan(x) else x for x in np.asarray(identities, dtype=np.float64).tolist()]
+        self.db.executemany('INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?)',
+                            zip([self.params] * len(identities), np.asarray(qry_hashes).tolist(), np.asarray(lib_hashes).tolist(), identities))
+        self.db.commit()
+
+    def evict(self) -> None:
+        '''
+        If the cache directory is larger than its maximum size, remove the pairs of the least
+        recently used sequences, of all parameter sets, until it is below EVICT_TO of it.
+        The other caches in the directory count towards the size, but are not evicted here.
+        Free pages are returned to the file system.
+        '''
+        page_size = self.db.execute('PRAGMA page_size').fetchone()[0]
+        used = (self.db.execute('PRAGMA page_count').fetchone()[0] - self.db.execute('PRAGMA freelist_count').fetchone()[0]) * page_size
+        others = cache_usage(self.cache_dir, exclude=ALIGNMENTS_DB)
+        if used + others > self.max_size:
+            n_sequences = self.db.execute('SELECT COUNT(*) FROM sequences').fetchone()[0]
+            n_evict = math.ceil((used + others - EVICT_TO * self.max_size) / (used / max(1, n_sequences)))
+            evicted = self.db.execute('SELECT params, h FROM sequences ORDER BY last_used LIMIT ?', (n_evict,)).fetchall()
+            self.db.executemany('DELETE FROM pairs WHERE params = ? AND a = ?', evicted)
+            self.db.executemany('DELETE FROM sequences WHERE params = ? AND h = ?', evicted)
+            # pairs whose library was evicted. This scans the table, but eviction is rare.
+            self.db.execute('DELETE FROM pairs WHERE NOT EXISTS (SELECT 1 FROM sequences s WHERE s.params = pairs.params AND s.h = pairs.b)')
+            self.db.commit()
+        # return free pages to the file system. execute() would only step the pragma once, freeing one page.
+        self.db.executescript('PRAGMA incremental_vacuum;')
+
+    def close(self) -> None:
+        self.evict()
+        self.db.close()
+
+
+def split_cached_pairs(cache: AlignmentCache,
+                       hashes: np.ndarray,
+                       tiles: List[Tuple[np.ndarray, np.ndarray]],
+                       add_cached: Callable[[np.ndarray, np.ndarray, np.ndarray], None],
+                       needed: Callable[[np.ndarray, np.ndarray], np.ndarray] = None,
+                       merge: bool = False) -> Tuple[List[Tuple[np.ndarray, np.ndarray]], int, int]:
+    '''
+    Look up the (query, library) pairs of each tile of sequence indices in the cache.
+    needed(qrys, libs) can restrict the pairs of a tile, by default all are needed.
+    Cached pairs are passed to add_cached(qrys, libs, identities).
+    The missing pairs of a tile are grouped into rectangles of queries that miss
+    the same libraries. With merge, rectangles of different tiles are merged too,
+    this needs all tiles to have the same libraries.
+    Returns the rectangles as (qrys, libs) and the numbers of cached and missing pairs.
+    '''
+    groups = {}
+    n_cached, n_missing = 0, 0
+    for t, (qrys, libs) in enumerate(tiles):
+        block_size = max(1, LOOKUP_CELLS // max(1, len(libs)))
+        for start in range(0, len(qrys), block_size):
+            block = qrys[start:start+block_size]
+            found, identity = cache.lookup(hashes[block], hashes[libs])
+            missing = ~found
+            if needed is not None:
+                mask = needed(block, libs)
+                found &= mask
+                missing &= mask
+
+            q, l = np.nonzero(found)
+            add_cached(block[q], libs[l], identity[q, l])
+            n_cached += len(q)
+            n_missing += int(np.count_nonzero(missing))
+
+            # only queries that miss pairs are grouped, usually most of them are cached or none.
+            has_missing = missing.any(axis=1)
+            for qry, pattern in zip(block[has_missing].tolist(), np.packbits(missing[has_missing], axis=1)):
+                groups.setdefault((-1 if merge else t, pattern.tobytes()), (t, []))[1].append(qry)
+
+    rectangles = []
+    for (_, pattern), (t, qrys) in groups.items():
+        libs = tiles[t][1]
+        libs = libs[np.unpackbits(np.frombuffer(pattern, dtype=np.uint8), count=len(libs)).astype(bool)]
+        if len(libs) > 0:
+            rectangles.append((np.array(qrys, dtype=np.int64), libs))
+    return rectangles, n_cached, n_missing
+
+
+class DirectoryCache():
+    '''
+    Directories of files that are built from an input, each stored under a key
+    that identifies the input and the parameters of the build, in cache_dir/name.
+    When the cache directory grows beyond its maximum size, including other
+    caches in it, the least recently used directories are evicted.
+    '''
+
+    def __init__(self, cache_dir: str, name: str, max_size: float = DEFAULT_CACHE_SIZE):
+        self.root = cache_dir
+        self.name = name
+        self.cache_dir = os.path.join(cache_dir, name)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_size = max_size * 1024**3
+        self.used = set()
+
+    def get(self, key: str, build: Callable[[str], None]) -> Tuple[str, bool]:
+        '''
+        The directory of key. If it is not cached yet, build(path) fills a new directory first.
+        Returns the directory and whether it was cached.
+        '''
+        path = os.path.join(self.cache_dir, key)
+        cached = os.path.isdir(path)
+        if not cached:
+            # built under a temporary name, so that a directory that exists is complete.
+            # The cache can be shared by hosts, whose processes can have the same pid.
+            tmp_path = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path)
+            build(tmp_path)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # another process built it at the same time.
+                shutil.rmtree(tmp_path)
+        os.utime(path)
+        self.used.add(key)
+        return path, cached
+
+    def evict(self) -> None:
+        '''
+        If the cache directory is larger than its maximum size, remove the least recently used
+        directories until it is below EVICT_TO of it. Directories used by this instance are kept,
+        the other caches in the directory count towards the size, but are not evicted here.
+        '''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp') or not os.path.isdir(path):
+                continue
+            entries.append((os.stat(path).st_mtime, tree_size(path), name))
+
+        total = sum(size for _, size, _ in entries) + cache_usage(self.root, exclude=self.name)
+        if total <= self.max_size:
+            return
+        for _, size, name in sorted(entries):
+            if total <= EVICT_TO * self.max_size:
+                break
+            if name not in self.used:
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+                total -= size
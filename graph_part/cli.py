@@ -24,7 +24,8 @@ def get_args() -> argparse.Namespace:
                                                             supplementary information such as labelling.
                                                             Currently the interleaved fasta file format, 
                                                             with | or : header separators are supported.
-                                                            The - header separator is untested. ''',
+                                                            The - header separator is untested.
+                                                            May be gzip, bzip2 or xz compressed. ''',
                         required=True,
                         )
     core_parser.add_argument("-th","--threshold",type=float, help='''The desired threshold, should be within the
@@ -70,8 +71,14 @@ def get_args() -> argparse.Namespace:
     
     #checkpointing
     core_parser.add_argument('--save-checkpoint-path', '-sc', type=str, default=None, help='''Path to save the computed similarities above the threshold. 
-                                                                                            Can be used later in the precomputed mode.'''
+                                                                                            Can be used later in the precomputed mode. Paths ending in
+                                                                                            .gz, .bz2 or .xz are written compressed.'''
                         )
+    core_parser.add_argument('--checkpoint-format', '-cf', type=str, choices=['csv', 'binary'], default='csv', help='''Format of --save-checkpoint-path. binary is much faster to 
+                                                                                            save and load, the precomputed mode recognizes both.''')
+
+    # temporary files
+    core_parser.add_argument("-td","--tmp-dir",type=str, help='Directory in which each run makes its own directory for temporary files. Defaults to the system temporary directory.', default=None)
 
 
     # Parsers for the different run modes.
@@ -80,12 +87,14 @@ def get_args() -> argparse.Namespace:
     parser_precomputed =  subparsers.add_parser('precomputed', help='Use precomputed identities.', parents=[core_parser])
     parser_needle = subparsers.add_parser('needle', help='Use EMBOSS needle alignments.', parents=[core_parser])
     parser_mmseqs2 = subparsers.add_parser('mmseqs2', help='Use MMseqs2 alignments.', parents=[core_parser])
+    parser_nw = subparsers.add_parser('nw', help='Use the built-in Needleman-Wunsch aligner.', parents=[core_parser])
+    parser_worker = subparsers.add_parser('worker', help='Align chunk pairs of a distributed needle run.')
 
     # 2. Arguments that are only required with precomputed metrics.
     parser_precomputed.add_argument("-ef","--edge-file",type=str, help='''Path to a comma separated file containing 
                                                             pairwise metrics, the first two columns should 
                                                             contain entity identifiers specified in the 
-                                                            --fasta-file.''',
+                                                            --fasta-file. May be gzip, bzip2 or xz compressed.''',
                         default=None,
                         )
     parser_precomputed.add_argument("-mc","--metric-column",type=int, help='''The 0-indexed or zero-based indexing number,
@@ -106,12 +115,27 @@ def get_args() -> argparse.Namespace:
 
     # optimize runtime
     parser_needle.add_argument("-nt","--threads",type=int, help='Number of threads to run in parallel.', default=1)
-    parser_needle.add_argument("-nc","--chunks",type=int, help='Number of chunks to split the fasta file.', default=10)
+    parser_needle.add_argument("-nc","--chunks",type=int, help='Number of chunks to split the fasta file. By default derived from the number of threads.', default=None)
+    parser_needle.add_argument("-mf","--max-in-flight",type=int, help='Maximum number of chunk pairs that are submitted but not yet added to the graph. Defaults to twice the number of threads.', default=None)
     parser_needle.add_argument("-pm", "--parallel-mode", type=str, help='Parallelization strategy to use.',
                                 choices=['multithread', 'multiprocess'], 
                                 default='multithread'
                                 )
     
+    # k-mer prefilter
+    parser_needle.add_argument("-pr","--prefilter", action='store_true', help='Only align pairs of sequences that share k-mers instead of all pairs.')
+    parser_needle.add_argument("-pk","--prefilter-kmer",type=int, help='k-mer size of the prefilter, between 1 and 7. Defaults to 3 for proteins and 6 for nucleotides.', default=None)
+    parser_needle.add_argument("-ps","--prefilter-min-shared",type=int, help='Minimum number of distinct k-mers that a pair needs to share to be aligned. Lower is more sensitive. Defaults to 2, 5 is faster for proteins but misses some edges.', default=None)
+
+    # resumable runs
+    parser_needle.add_argument("-rd","--run-dir",type=str, help='Directory in which the edges of each finished chunk pair are saved, so that the run can be resumed.', default=None)
+    parser_needle.add_argument("-re","--resume", action='store_true', help='Resume the run in --run-dir. Finished chunk pairs are not aligned again.')
+    parser_needle.add_argument("-di","--distributed", action='store_true', help='Let `graphpart worker` processes on other hosts that share --run-dir align chunk pairs of this run.')
+
+    # alignment cache
+    parser_needle.add_argument("-cd","--cache-dir",type=str, help='Directory of a persistent alignment cache. Pairs of sequences that were aligned in earlier runs with the same parameters are not aligned again.', default=None)
+    parser_needle.add_argument("-cs","--cache-size",type=float, help='Maximum size of the cache directory in GB, shared by all caches in it. The pairs of the least recently used sequences are evicted first.', default=10)
+
     # customize needle
     parser_needle.add_argument('--gapopen','-gapopen', type=float, default=10, help='Passed to needle. See EMBOSS documentation.')
     parser_needle.add_argument('--gapextend','-gapextend', type=float, default=0.5, help='Passed to needle. See EMBOSS documentation.')
@@ -121,15 +145,48 @@ def get_args() -> argparse.Namespace:
     parser_needle.add_argument('--matrix', '--datafile','-datafile', type=str, default='EBLOSUM62', help='Passed to needle. See EMBOSS documentation.')
 
 
-    # 4. Arguments that are only required with mmseqs2.
+    # 4. Arguments that are only required with the built-in aligner.
+    parser_nw.add_argument("-dn","--denominator",type=str, help='Denominator to use for sequence identity computation.', 
+                        choices=['full', 'shortest', 'longest', 'mean', 'no_gaps'], 
+                        default='full',
+                        )
+    parser_nw.add_argument("-nu","--nucleotide", action='store_true', help= 'Input contains nucleotide sequences (Default is proteins).')
+    parser_nw.add_argument("-nt","--threads",type=int, help='Number of processes to run in parallel. -1 uses all cores.', default=-1)
+    parser_nw.add_argument("-mf","--max-in-flight",type=int, help='Maximum number of tiles that are submitted but not yet added to the graph. Defaults to twice the number of processes.', default=None)
+    parser_nw.add_argument("-pr","--prefilter", action='store_true', help='Only align pairs of sequences that share k-mers instead of all pairs.')
+    parser_nw.add_argument("-pk","--prefilter-kmer",type=int, help='k-mer size of the prefilter, between 1 and 7. Defaults to 3 for proteins and 6 for nucleotides.', default=None)
+    parser_nw.add_argument("-ps","--prefilter-min-shared",type=int, help='Minimum number of distinct k-mers that a pair needs to share to be aligned. Lower is more sensitive. Defaults to 2, 5 is faster for proteins but misses some edges.', default=None)
+
+    parser_nw.add_argument('--gapopen','-gapopen', type=float, default=10, help='Gap open penalty, as in needle.')
+    parser_nw.add_argument('--gapextend','-gapextend', type=float, default=0.5, help='Gap extension penalty, as in needle.')
+    parser_nw.add_argument('--endweight','-endweight', action='store_true', help='Apply end gap penalties, as in needle.')
+    parser_nw.add_argument('--endopen','-endopen', type=float, default=10, help='End gap open penalty, as in needle.')
+    parser_nw.add_argument('--endextend','-endextend', type=float, default=0.5, help='End gap extension penalty, as in needle.')
+    parser_nw.add_argument('--matrix', '--datafile','-datafile', type=str, default=None, help='EBLOSUM62, EDNAFULL or the path to a matrix file in EMBOSS format. Defaults to EBLOSUM62 for proteins and EDNAFULL for nucleotides.')
+
+
+    # 5. Arguments that are only required with mmseqs2.
     parser_mmseqs2.add_argument("-nu","--nucleotide", action='store_true', help= 'Input contains nucleotide sequences (Default is proteins).')
     parser_mmseqs2.add_argument("-pr","--prefilter", action='store_true', help= 'Use the mmseqs2 prefiltering procedure instead of forcing all-vs-all alignments.')
     parser_mmseqs2.add_argument("-dn","--denominator",type=str, help='Denominator to use for sequence identity computation.', 
                         choices=['shortest', 'longest', 'n_aligned'], 
                         default='shortest',
                         )
+    parser_mmseqs2.add_argument("-nt","--threads",type=int, help='Number of threads that mmseqs2 uses. -1 uses all cores.', default=-1)
+    parser_mmseqs2.add_argument("-cd","--cache-dir",type=str, help='Directory of a persistent cache of the sequence database and, with --prefilter or --nucleotide, the prefilter results.', default=None)
+    parser_mmseqs2.add_argument("-cs","--cache-size",type=float, help='Maximum size of the cache directory in GB, shared by all caches in it. The least recently used databases are evicted first.', default=10)
+
+    # 6. Workers of distributed needle runs only need the run directory.
+    parser_worker.add_argument("run_dir",type=str, help='The --run-dir of the distributed run.')
+    parser_worker.add_argument("-nt","--threads",type=int, help='Number of threads to run in parallel.', default=1)
+    parser_worker.add_argument("-pm", "--parallel-mode", type=str, help='Parallelization strategy to use.',
+                                choices=['multithread', 'multiprocess'],
+                                default='multithread'
+                                )
 
     args =  parser.parse_args()
+    if args.alignment_mode == 'worker':
+        return args
 
 
     # Perform checks
@@ -146,6 +203,13 @@ def get_args() -> argparse.Namespace:
                 raise PermissionError(file_path)
 
 
+    if getattr(args, 'resume', False) and args.run_dir is None:
+        parser.error('--resume needs a --run-dir.')
+    if getattr(args, 'distributed', False) and args.run_dir is None:
+        parser.error('--distributed needs a --run-dir.')
+    if getattr(args, 'run_dir', None) is not None and (args.cache_dir is not None or args.prefilter):
+        parser.error('--run-dir can not be combined with --cache-dir or --prefilter.')
+
     create_dir_or_fail(args.out_file)
     if args.save_checkpoint_path is not None:
         create_dir_or_fail(args.save_checkpoint_path)
@@ -161,6 +225,11 @@ def main():
 
     
     args = get_args()
+    if args.alignment_mode == 'worker':
+        from .needle_utils import run_worker
+        run_worker(args.run_dir, args.threads, args.parallel_mode)
+        return
+
     config = vars(args)
     config['allow_moving'] = not args.no_moving
     config['removal_type'] = not args.remove_same
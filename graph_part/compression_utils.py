@@ -0,0 +1,141 @@
+'''
+Transparent reading of gzip, bzip2 and xz compressed input files.
+The compression of an input is recognized by its first bytes, not by its name.
+Compressed inputs are decompressed by a reader thread that runs ahead of the
+parser, the stdlib codecs release the GIL while they decompress, so that
+decompression and parsing overlap. Output files are compressed according to
+the extension of their name.
+'''
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+from types import ModuleType
+from typing import IO, Optional
+
+
+## Magic bytes at the start of a compressed file, and the module that decompresses it.
+MAGIC = [(b'\x1f\x8b', gzip), (b'BZh', bz2), (b'\xfd7zXZ\x00', lzma)]
+
+EXTENSIONS = {'.gz': gzip, '.bz2': bz2, '.xz': lzma}
+
+## Size of the decompressed blocks that the reader thread passes on, in bytes.
+BLOCK_SIZE = 1 << 20
+
+## Number of decompressed blocks the reader thread may be ahead of the parser.
+QUEUE_BLOCKS = 8
+
+
+def compression_module(fp: str) -> Optional[ModuleType]:
+    '''The module that decompresses fp, None if it is not compressed.'''
+    with open(fp, 'rb') as f:
+        head = f.read(max(len(magic) for magic, _ in MAGIC))
+    for magic, module in MAGIC:
+        if head.startswith(magic):
+            return module
+    return None
+
+
+class ThreadedDecompressor(io.RawIOBase):
+    '''
+    Raw binary stream of the decompressed content of a file. The file is
+    decompressed in blocks by a background thread, errors are raised on read.
+    '''
+
+    def __init__(self, fp: str, module: ModuleType):
+        self._queue = queue.Queue(QUEUE_BLOCKS)
+        self._stop = threading.Event()
+        self._block = memoryview(b'')
+        self._eof = False
+        self._thread = threading.Thread(target=self._decompress, args=(fp, module), daemon=True)
+        self._thread.start()
+
+    def _decompress(self, fp: str, module: ModuleType) -> None:
+        try:
+            with module.open(fp, 'rb') as f:
+                while not self._stop.is_set():
+                    block = f.read(BLOCK_SIZE)
+                    self._put(block)
+                    if len(block) == 0:
+                        return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item) -> None:
+        # don't block forever when the stream was closed before it was read to the end.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while len(self._block) == 0:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            if len(item) == 0:
+                self._eof = True
+                return 0
+            self._block = memoryview(item)
+        n = min(len(b), len(self._block))
+        b[:n] = self._block[:n]
+        self._block = self._block[n:]
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+        super().close()
+
+
+def open_input(fp: str, mode: str = 'r', background: bool = True) -> IO:
+    '''
+    Open fp for reading in mode 'r' or 'rb', decompressing it if it is compressed.
+    With background, compressed files are decompressed by a reader thread, which
+    pays off when the whole file is read. Uncompressed files are opened as usual.
+    '''
+    module = compression_module(fp)
+    if module is None:
+        return open(fp, mode)
+    if background:
+        stream = io.BufferedReader(ThreadedDecompressor(fp, module), BLOCK_SIZE)
+    else:
+        stream = module.open(fp, 'rb')
+    return stream if 'b' in mode else io.TextIOWrapper(stream)
+
+
+def read_head(fp: str, size: int) -> bytes:
+    '''The first size bytes of the decompressed content of fp.'''
+    with open_input(fp, 'rb', background=False) as f:
+        return f.read(size)
+
+
+def output_module(fp: str) -> Optional[ModuleType]:
+    '''The module that compresses fp according to its extension, None for other extensions.'''
+    return EXTENSIONS.get(os.path.splitext(fp)[1].lower())
+
+
+def open_output(fp: str, mode: str = 'w') -> IO:
+    '''
+    Open fp for writing in mode 'w' or 'wb'. Names ending in .gz, .bz2 or .xz
+    are written compressed.
+    '''
+    module = output_module(fp)
+    if module is None:
+        return open(fp, mode)
+    if module is gzip:
+        # the default of gzip.open is its slowest level, 6 is the default of the gzip tool.
+        return gzip.open(fp, mode if 'b' in mode else mode + 't', compresslevel=6)
+    return module.open(fp, mode if 'b' in mode else mode + 't')
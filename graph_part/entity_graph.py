@@ -0,0 +1,320 @@
+'''
+Integer-indexed graph store used by Graph-Part.
+Entities (sequences, molecules) are numbered in the order in which
+they are loaded. Accession strings are only needed when loading the
+data and when writing the output, all other steps work on node ids.
+'''
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+import numpy as np
+
+
+def csr_adjacency(src: np.ndarray, dst: np.ndarray, metric: np.ndarray, n_nodes: int, rank: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Build a CSR adjacency (indptr, indices, metric) with both orientations of each edge.
+    The neighbours of each node are sorted by the rank of their edge if given, else by node id.
+    '''
+    rows = np.concatenate([src, dst])
+    cols = np.concatenate([dst, src])
+    metric = np.concatenate([metric, metric])
+    order = np.lexsort((cols, rows)) if rank is None else np.lexsort((cols, np.concatenate([rank, rank]), rows))
+
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_nodes), out=indptr[1:])
+    return indptr, cols[order], metric[order]
+
+
+def fan_out_duplicates(src: np.ndarray, dst: np.ndarray, metric: np.ndarray, rank: np.ndarray, representative: np.ndarray,
+                       duplicate_metric: float = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Copy each edge to all pairs of duplicates of its two nodes, with the rank of the edge.
+    representative[i] is the node whose sequence node i duplicates, i itself for unique nodes.
+    With duplicate_metric, all duplicates of a representative and the representative
+    itself are connected with this metric, ranked after all other edges.
+    Returns unique edges as in `EdgeAccumulator.edges`.
+    '''
+    representative = np.asarray(representative, dtype=np.int64)
+    n = len(representative)
+    members = np.argsort(representative, kind='stable')
+    size = np.bincount(representative, minlength=n)
+    start = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(size, out=start[1:])
+
+    def expand(a: np.ndarray, b: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # enumerate the size[a] * size[b] member pairs of each (a, b).
+        counts = size[a] * size[b]
+        edge = np.repeat(np.arange(len(a)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        b_size = size[b][edge]
+        return edge, members[start[a][edge] + k // b_size], members[start[b][edge] + k % b_size]
+
+    accumulator = EdgeAccumulator()
+    edge, fan_src, fan_dst = expand(representative[src], representative[dst])
+    rank = np.asarray(rank, dtype=np.int64)
+    accumulator.add(fan_src, fan_dst, np.asarray(metric)[edge], rank[edge])
+    if duplicate_metric is not None:
+        groups = np.flatnonzero(size > 1)
+        _, fan_src, fan_dst = expand(groups, groups)
+        start_rank = int(rank.max()) + 1 if len(rank) > 0 else 0
+        accumulator.add(fan_src, fan_dst, np.full(len(fan_src), duplicate_metric, dtype=np.float64), start_rank + np.arange(len(fan_src)))
+    return accumulator.edges()
+
+
+class EdgeAccumulator():
+    '''
+    Growable buffers for undirected edges that are added in batches.
+    Each pair is stored as (min, max). Duplicated pairs are merged to their
+    minimum metric when compacting and when the edges are finalized.
+    Each edge has a rank, by default the order in which it was added. A merged
+    pair keeps the rank of its first occurrence, as in a graph whose edges are
+    inserted one by one.
+    '''
+
+    ## Compact instead of growing once the buffer is this large and doubled since the last compaction.
+    COMPACT_SIZE = 1 << 22
+
+    def __init__(self):
+        self.src = np.zeros(0, dtype=np.int32)
+        self.dst = np.zeros(0, dtype=np.int32)
+        self.metric = np.zeros(0, dtype=np.float64)
+        self.rank = np.zeros(0, dtype=np.int64)
+        self.n = 0
+        self.n_compacted = 0
+        self.n_added = 0
+
+    def __len__(self) -> int:
+        return self.n
+
+    def add(self, src: np.ndarray, dst: np.ndarray, metric: np.ndarray, rank: np.ndarray = None) -> None:
+        '''Add a batch of edges between node ids. Self-pairs are dropped.'''
+        src = np.asarray(src, dtype=np.int32)
+        dst = np.asarray(dst, dtype=np.int32)
+        metric = np.asarray(metric, dtype=np.float64)
+        if rank is None:
+            rank = np.arange(self.n_added, self.n_added + len(src), dtype=np.int64)
+        rank = np.asarray(rank, dtype=np.int64)
+        self.n_added += len(src)
+        lo, hi = np.minimum(src, dst), np.maximum(src, dst)
+        keep = lo != hi
+        if not keep.all():
+            lo, hi, metric, rank = lo[keep], hi[keep], metric[keep], rank[keep]
+        if len(lo) == 0:
+            return
+
+        self._reserve(len(lo))
+        self.src[self.n:self.n + len(lo)] = lo
+        self.dst[self.n:self.n + len(lo)] = hi
+        self.metric[self.n:self.n + len(lo)] = metric
+        self.rank[self.n:self.n + len(lo)] = rank
+        self.n += len(lo)
+
+    def _reserve(self, n_new: int) -> None:
+        capacity = len(self.src)
+        if self.n + n_new <= capacity:
+            return
+        ## Duplicated pairs in a large buffer may free enough space without growing it.
+        if self.n >= self.COMPACT_SIZE and self.n >= 2 * self.n_compacted:
+            self.compact()
+            if self.n + n_new <= capacity:
+                return
+
+        capacity = max(self.n + n_new, 2 * capacity, 1024)
+        for name in ('src', 'dst', 'metric', 'rank'):
+            column = getattr(self, name)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.n] = column[:self.n]
+            setattr(self, name, grown)
+
+    def compact(self) -> None:
+        '''Merge duplicated pairs in the buffer to their minimum metric.'''
+        src, dst, metric, rank = self.edges()
+        self.n = self.n_compacted = len(src)
+        self.src[:self.n], self.dst[:self.n], self.metric[:self.n], self.rank[:self.n] = src, dst, metric, rank
+
+    def edges(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Unique edges as src, dst, metric and rank arrays, with the minimum metric
+        and the minimum rank of each pair. Edges are ordered by (src, dst) with src < dst.
+        '''
+        src, dst, metric, rank = self.src[:self.n], self.dst[:self.n], self.metric[:self.n], self.rank[:self.n]
+
+        # sort by pair, then by metric, and keep the first entry of each pair.
+        pair = (src.astype(np.int64) << 32) | dst.astype(np.int64)
+        order = np.lexsort((metric, pair))
+        pair = pair[order]
+        first = np.ones(len(pair), dtype=bool)
+        first[1:] = pair[1:] != pair[:-1]
+        first_rank = np.minimum.reduceat(rank[order], np.flatnonzero(first)) if len(pair) > 0 else rank[:0]
+        order = order[first]
+        return src[order], dst[order], metric[order], first_rank
+
+
+class EntityGraph():
+    '''
+    Undirected graph of entities with a distance metric on each edge.
+
+    Node attributes (priority, label, cluster, component size,
+    between-connectivity) are NumPy columns indexed by node id. Edges are
+    collected in batches with `add_edges` and converted to flat `src`/`dst`/`metric`
+    arrays and a CSR adjacency (`indptr`, `indices`, `adj_metric`) by
+    `finalize`. The neighbours of a node are in the order in which their edges
+    were first added, see `EdgeAccumulator`. Removing nodes only clears them in the `alive` mask,
+    so node ids stay valid for the whole run.
+    '''
+
+    def __init__(self):
+        self.ids: List[str] = []
+        self.index: Dict[str, int] = {}
+
+        # node columns grow while loading, finalize() trims them to the number of nodes.
+        self._priority = np.zeros(0, dtype=bool)
+        self._label = np.zeros(0, dtype=np.int64)
+        # edges are buffered while loading, converted to arrays by finalize()
+        self._edges = EdgeAccumulator()
+        # representative of each node with a duplicated sequence, edges are fanned out by finalize()
+        self._representative: Dict[int, int] = {}
+        self._duplicate_metric: float = None
+
+        self.priority: np.ndarray = None
+        self.label: np.ndarray = None
+        self.cluster: np.ndarray = None
+        self.alive: np.ndarray = None
+        # size of the linkage cluster of each node, set by the partitioning initialization.
+        self.component_size: np.ndarray = None
+        # only set once removal ran, it is reported in the output table.
+        self.between_connectivity: np.ndarray = None
+
+        self.src: np.ndarray = None
+        self.dst: np.ndarray = None
+        self.metric: np.ndarray = None
+        # order in which each edge was first added, used to break ties as in the order of insertion.
+        self.rank: np.ndarray = None
+        self.indptr: np.ndarray = None
+        self.indices: np.ndarray = None
+        self.adj_metric: np.ndarray = None
+
+    def _reserve(self, n: int) -> None:
+        '''Grow the node columns to hold at least n nodes.'''
+        capacity = len(self._priority)
+        if n <= capacity:
+            return
+        capacity = max(n, 2 * capacity, 1024)
+        for name in ('_priority', '_label'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+
+    def add_node(self, AC: str, priority: bool, label: int) -> int:
+        '''Add a node, or overwrite the attributes of an existing one. Returns the node id.'''
+        idx = self.index.setdefault(AC, len(self.ids))
+        if idx == len(self.ids):
+            self.ids.append(AC)
+            self._reserve(len(self.ids))
+        self._priority[idx] = priority
+        self._label[idx] = label
+        return idx
+
+    def add_nodes(self, ACs: Iterable[str], priority: Union[bool, Iterable[bool]], label: Union[int, Iterable[int]]) -> np.ndarray:
+        '''
+        Add many nodes at once, with the same semantics as repeated `add_node` calls:
+        new nodes are numbered in order, repeated accessions keep their first id
+        and get the attributes of their last occurrence. Returns the node ids.
+        '''
+        n_before = len(self.ids)
+        index = self.index
+        idx = np.array([index.setdefault(AC, len(index)) for AC in ACs], dtype=np.int64)
+        # dicts keep insertion order, so the new keys are the new nodes in order.
+        self.ids.extend(islice(index, n_before, None))
+        self._reserve(len(self.ids))
+
+        self._priority[idx] = np.asarray(priority, dtype=bool)
+        self._label[idx] = np.asarray(label, dtype=np.int64)
+        return idx
+
+    def has_node(self, AC: str) -> bool:
+        return AC in self.index
+
+    def node_ids(self, ACs: Iterable[str]) -> np.ndarray:
+        '''Node ids of a list of accessions, -1 for accessions that are not in the graph.'''
+        get = self.index.get
+        return np.fromiter((get(AC, -1) for AC in ACs), dtype=np.int64)
+
+    def add_edges(self, src: np.ndarray, dst: np.ndarray, metric: np.ndarray) -> None:
+        '''
+        Add a batch of edges between node ids. Pairs can be added multiple
+        times and in both orientations, `finalize` keeps the minimum metric.
+        '''
+        self._edges.add(src, dst, metric)
+
+    def add_edge(self, qry: str, lib: str, metric: float) -> None:
+        '''Add a single edge between two loaded nodes.'''
+        self._edges.add([self.index[qry]], [self.index[lib]], [metric])
+
+    def set_duplicates(self, duplicates: np.ndarray, representatives: np.ndarray, metric: float = None) -> None:
+        '''
+        Mark nodes as having the same sequence as a representative node, so that only
+        representatives need to be aligned. `finalize` copies the edges of each
+        representative to its duplicates, and connects the duplicates of a representative
+        to it and to each other with `metric`. With metric None, they are not connected.
+        '''
+        for node, rep in zip(np.asarray(duplicates).tolist(), np.asarray(representatives).tolist()):
+            if node != rep:
+                self._representative[node] = rep
+        self._duplicate_metric = metric
+
+    def finalize(self) -> None:
+        '''
+        Convert the loaded nodes and edges to arrays. Duplicated and reversed pairs
+        are merged to their minimum metric, self-pairs are dropped. Edges are
+        fanned out to the nodes registered with `set_duplicates`.
+        Edges are ordered by (src, dst) with src < dst.
+        '''
+        n = len(self.ids)
+        self.priority = self._priority[:n].copy()
+        self.label = self._label[:n].copy()
+        self.cluster = np.zeros(n, dtype=np.float64)
+        self.alive = np.ones(n, dtype=bool)
+        self.component_size = np.ones(n, dtype=np.int64)
+
+        if len(self._representative) > 0:
+            representative = np.arange(n)
+            representative[list(self._representative)] = list(self._representative.values())
+            src, dst, metric, rank = self._edges.edges()
+            self._edges = EdgeAccumulator()
+            self.src, self.dst, self.metric, self.rank = fan_out_duplicates(src, dst, metric, rank, representative, self._duplicate_metric)
+        else:
+            self.src, self.dst, self.metric, self.rank = self._edges.edges()
+        self._edges = EdgeAccumulator()
+        self._representative = {}
+        self._priority, self._label = np.zeros(0, dtype=bool), np.zeros(0, dtype=np.int64)
+
+        self.indptr, self.indices, self.adj_metric = csr_adjacency(self.src, self.dst, self.metric, n, self.rank)
+
+    def number_of_nodes(self) -> int:
+        return int(np.count_nonzero(self.alive))
+
+    def number_of_edges(self) -> int:
+        return int(np.count_nonzero(self.alive[self.src] & self.alive[self.dst]))
+
+    def nodes(self) -> np.ndarray:
+        '''Ids of all nodes that were not removed, in loading order.'''
+        return np.flatnonzero(self.alive)
+
+    def neighbours(self, node: int) -> Tuple[np.ndarray, np.ndarray]:
+        '''Neighbour ids and edge metrics of a node, in the order of their edges. Includes removed neighbours.'''
+        start, end = self.indptr[node], self.indptr[node + 1]
+        return self.indices[start:end], self.adj_metric[start:end]
+
+    def edge_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''src, dst and metric arrays of all edges between nodes that were not removed.'''
+        keep = self.alive[self.src] & self.alive[self.dst]
+        return self.src[keep], self.dst[keep], self.metric[keep]
+
+    def edges(self) -> Iterator[Tuple[int, int, float]]:
+        '''Iterate (src, dst, metric) of all edges between nodes that were not removed.'''
+        src, dst, metric = self.edge_arrays()
+        return zip(src.tolist(), dst.tolist(), metric.tolist())
+
+    def remove_nodes(self, nodes: np.ndarray) -> None:
+        self.alive[nodes] = False
@@ -2,15 +2,17 @@
 
 import pandas as pd 
 import numpy as np
-import networkx as nx
 from typing import Dict, List, Tuple, Any, Union
 import time
+import os
 from collections import Counter
-from itertools import product
-import time
+import heapq
 
 from .transformations import TRANSFORMATIONS
+from .entity_graph import EntityGraph, csr_adjacency
 from .train_val_test_split import train_val_test_split
+from .temp_utils import tmp_dir_context
+from .compression_utils import open_input, open_output
 
 #TODO update new arg names here
 """
@@ -63,23 +65,34 @@ https://creativecommons.org/licenses/by-nc/4.0/legalcode
 """
 
 
-def process_csv(line: str) -> Tuple[str, dict]:
+def process_csv(line: str) -> Tuple[str, bool, int]:
     """ NOT IMPLEMENTED """
     raise NotImplementedError('Graph-Part does not support starting from .csv yet.')
-    yield None, None
+    yield None, None, None
 
-def process_fasta(line: str, priority_name:str, labels_name:str, labels: dict) -> Tuple[str, dict]:
-    """ Processes a fasta header lines or fasta meta data lines, if you will.
-        Only supports interleaved fasta with > initialized header lines.
-        Separate metadata with pipes | or colons :, whitespace between separators are ignored. 
-        Some fasta files use the dash - as a separator. The dash is also used as an isoform indicator
-        in accension numbers the dash separator. The option space dash space or [ - ] is implemented, but untested. """
+def split_fasta_header(line: str) -> List[str]:
+    '''Split a fasta header line into the accession and the metadata fields, see `process_fasta`.'''
     spl = line.strip().split('|')
     if ' - ' in spl[0]:
        spl = line.strip().split(' - ')
     if ':' in spl[0]:
         spl = line.strip().split(':')
+    return spl
 
+
+def fasta_accession(line: str) -> str:
+    '''The accession of a fasta header line, as the node of its entity is named.'''
+    return split_fasta_header(line)[0].strip()[1:]
+
+
+def process_fasta(line: str, priority_name:str, labels_name:str, labels: dict) -> Tuple[str, bool, int]:
+    """ Processes a fasta header lines or fasta meta data lines, if you will.
+        Only supports interleaved fasta with > initialized header lines.
+        Separate metadata with pipes | or colons :, whitespace between separators are ignored. 
+        Some fasta files use the dash - as a separator. The dash is also used as an isoform indicator
+        in accension numbers the dash separator. The option space dash space or [ - ] is implemented, but untested.
+        Returns the accession, the priority and the label value. """
+    spl = split_fasta_header(line)
     AC = spl[0].strip()[1:]
     priority = False
     label = '0'
@@ -100,175 +113,211 @@ def process_fasta(line: str, priority_name:str, labels_name:str, labels: dict) -
 
     label = labels[label]['val']
 
-    node_data = {
-        'priority': priority,
-        'label-val': label
-    }
-    return AC, node_data
+    return AC, priority, label
 
 
-def load_entities(entity_fp: str, priority_name: str, labels_name: str):
-    part_graph = nx.Graph()
-    full_graph = nx.Graph()
+def load_entities(entity_fp: str, priority_name: str, labels_name: str) -> Tuple[EntityGraph, dict]:
+    graph = EntityGraph()
 
+    ## Collect the node attributes as columns and add all nodes in one go.
     labels = {}
-    with open(entity_fp) as inf:
+    ACs, priorities, label_vals = [], [], []
+    with open_input(entity_fp) as inf:
         processing_as = None
         for line in inf:
             if '>' in line and processing_as != 'csv':
-                AC, node_data = process_fasta(line, priority_name, labels_name, labels)
+                AC, priority, label = process_fasta(line, priority_name, labels_name, labels)
                 processing_as = 'fasta'
             elif processing_as == 'fasta':
                 continue
             else:
-                AC, node_data = process_csv(line)
+                AC, priority, label = process_csv(line)
                 processing_as = 'csv'
 
-            full_graph.add_node(AC)
-            nx.set_node_attributes(full_graph, {AC:node_data})
-            
-            part_graph.add_node(AC)
+            ACs.append(AC)
+            priorities.append(priority)
+            label_vals.append(label)
+
+    graph.add_nodes(ACs, priorities, label_vals)
 
-    return full_graph, part_graph, labels
+    return graph, labels
+
+
+def collapse_duplicates(entity_fp: str, graph: EntityGraph, transformation: str, threshold: float, unique_fp: str) -> int:
+    '''
+    Find entities with identical sequences, ignoring case as the aligners and
+    the alignment cache do. Only the first entity of each
+    sequence is written to unique_fp to be aligned. The others are registered as duplicates
+    in the graph, which gives them the edges of the first one and connects them to it
+    with identity 1.0. Returns the number of duplicates, unique_fp is only written if there are any.
+    '''
+    from .needle_utils import parse_fasta
+    ids, seqs = parse_fasta(entity_fp)
+    first = {}
+    representative = np.array([first.setdefault(seq.upper(), i) for i, seq in enumerate(seqs)], dtype=np.int64)
+    is_unique = representative == np.arange(len(seqs))
+    if is_unique.all():
+        return 0
+
+    # parse_fasta only splits at '|', the nodes are named by the full accession parsing of load_entities.
+    names = [fasta_accession(id) for id in ids]
+    nodes = graph.node_ids(names)
+    if (nodes < 0).any():
+        raise RuntimeError(f'Sequence {names[np.flatnonzero(nodes < 0)[0]]} was not found in the graph. This should not happen, please report a bug.')
+    metric = TRANSFORMATIONS[transformation](1.0)
+    graph.set_duplicates(nodes[~is_unique], nodes[representative[~is_unique]], None if metric > threshold else metric)
+    with open(unique_fp, 'w') as f:
+        for i in np.flatnonzero(is_unique).tolist():
+            f.write(ids[i]+'\n')
+            f.write(seqs[i]+'\n')
+
+    return int(np.count_nonzero(~is_unique))
 
 
 def partition_assignment(cluster_vector, label_vector, n_partitions, n_class):
     ''' Function to separate proteins into N partitions with balanced classes 
         Courtesy of José Juan Almagro Armenteros '''
     
-    # Unique cluster number
-    u_cluster = np.unique(cluster_vector)
+    # Unique cluster number, and the position of each protein's cluster in it
+    u_cluster, cl_index = np.unique(cluster_vector, return_inverse=True)
+    cl_index = cl_index.reshape(-1)
+    
+    # Count number of each class in each cluster, all clusters in one pass
+    cl_counts = np.bincount(cl_index * n_class + label_vector.astype(np.int64), minlength=len(u_cluster) * n_class)
+    cl_counts = cl_counts.reshape(len(u_cluster), n_class).astype(float)
     
     # Initialize matrices
     loc_number = np.ones((n_partitions,n_class))
-    cl_number = np.zeros(cluster_vector.shape[0])
+    cl_partition = np.zeros(len(u_cluster))
     
-    for i in u_cluster:
-        # Extract the labels for the proteins in that cluster
-        positions = np.where(cluster_vector == i)
-        cl_labels = label_vector[positions]
-        
-        # Count number of each class
-        u, count = np.unique(cl_labels, return_counts=True)
-        
-        u = u.astype(np.int32)
-        temp_loc_number = np.copy(loc_number)
-        temp_loc_number[:,u] += count
-        loc_per = loc_number/temp_loc_number
+    for i, count in enumerate(cl_counts):
+        # Adding zero counts leaves a class unchanged, so this matches only updating the classes in the cluster
+        loc_per = loc_number/(loc_number + count)
         best_group = np.argmin(np.sum(loc_per,axis=1))
-        loc_number[best_group,u] += count
+        loc_number[best_group] += count
         
         # Store the selected partition
-        cl_number[positions] = best_group
+        cl_partition[i] = best_group
     
-    return cl_number
+    return cl_partition[cl_index]
         
 
-def partition_data(full_graph: nx.classes.graph.Graph, 
-                   part_graph: nx.classes.graph.Graph,
+def _find_root(parent: List[int], node: int) -> int:
+    '''Find the root of a node in the disjoint-set forest, compressing the path on the way.'''
+    root = node
+    while parent[root] != root:
+        root = parent[root]
+    while parent[node] != root:
+        parent[node], node = root, parent[node]
+    return root
+
+
+def restricted_linkage(graph: EntityGraph,
+                       threshold: float,
+                       part_size: int,
+                       label_limits: np.ndarray) -> np.ndarray:
+    '''
+    Restricted closest neighbour linkage. Edges up to the threshold are visited from
+    shortest to longest and link their clusters unless a cluster reached `part_size`
+    or the merged cluster would reach one of the `label_limits`.
+    Clusters are kept in a disjoint-set forest (union by size, path compression),
+    with the cluster size and label counts stored at the root.
+    Returns the cluster of each node, numbered in the order of their first entity.
+    '''
+    n_nodes = len(graph.ids)
+    parent = list(range(n_nodes))
+    cluster_sizes = [1] * n_nodes
+    label_counts = np.zeros((n_nodes, len(label_limits)), dtype=int)
+    label_counts[np.arange(n_nodes), graph.label] = 1
+
+    ## Order the edges by metric. Ties are visited by node, then in the order in which
+    ## the edges of a node were added, as the edges of the networkx graph were.
+    ## No need to look at edges above the threshold.
+    alive = graph.alive[graph.src] & graph.alive[graph.dst]
+    src, dst, metrics, rank = graph.src[alive], graph.dst[alive], graph.metric[alive], graph.rank[alive]
+    order = np.lexsort((rank, src, metrics))
+    n_linkable = np.searchsorted(metrics[order], threshold, side='right')
+    order = order[:n_linkable]
+
+    count = 0
+    ## Linking entities, if restrictions allow
+    for qry, lib, metric in zip(src[order].tolist(), dst[order].tolist(), metrics[order].tolist()):
+        qry_root, lib_root = _find_root(parent, qry), _find_root(parent, lib)
+        if qry_root == lib_root:
+            continue
+
+        ## RESTRICTIONS!
+        if cluster_sizes[qry_root] >= part_size:
+            continue
+        if cluster_sizes[lib_root] >= part_size:
+            continue
+        merged_counts = label_counts[qry_root] + label_counts[lib_root]
+        if (merged_counts >= label_limits).any():
+            continue
+
+        ## Hang the smaller cluster below the root of the larger one.
+        if cluster_sizes[qry_root] < cluster_sizes[lib_root]:
+            qry_root, lib_root = lib_root, qry_root
+        parent[lib_root] = qry_root
+        cluster_sizes[qry_root] += cluster_sizes[lib_root]
+        label_counts[qry_root] = merged_counts
+
+        count += 1
+        if count % 10000 == 0:
+            print("edges:", count)
+            print(cluster_sizes[qry_root], merged_counts, metric)
+
+    roots = np.array([_find_root(parent, n) for n in range(n_nodes)])
+
+    ## Number the linked clusters in the order of their first entity.
+    _, first, inverse = np.unique(roots, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=int)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[inverse.reshape(-1)]
+
+
+def partition_data(graph: EntityGraph,
                    labels: dict,
                    threshold: float,
                    nr_of_parts: int,
                    mode: int):
-    part_size = full_graph.number_of_nodes()//nr_of_parts
+    part_size = graph.number_of_nodes()//nr_of_parts
 
     label_limits = np.array([x[1]['lim'] for x in sorted(labels.items(), key=lambda x:x[1]['val'] )])
     print(part_size, label_limits)
-    
-    count = 0
-    ## AC, cluster, label
-    acs = []
-    clusters = []
-    labels = []
+
     print("Initialization mode", mode)
 
-    ## Initialize the initialization
-    for ind, AC in enumerate(part_graph.nodes()):
-        label_counts = np.zeros(len(label_limits), dtype=int)
-        label_counts[full_graph.nodes[AC]['label-val']] = 1
-        cluster_nr = ind
-        
-        if mode == 'simple':
-            d = full_graph.nodes[AC]
-            acs.append(AC)
-            clusters.append(cluster_nr)
-            labels.append(d['label-val'])
-        nx.set_node_attributes(part_graph, {
-            AC:{
-                'cluster': cluster_nr,
-                'C-size': 1,
-                'label-counts': label_counts
-            }
-        })
+    ## Initialize the initialization, every entity is its own cluster.
+    n_nodes = len(graph.ids)
+    clusters = np.arange(n_nodes)
 
     ## Restricted closest neighbour linkage
     if mode in ['slow-nn', 'fast-nn']:
-        ## Linking entities, if restrictions allow
-        for qry, lib, data in sorted(full_graph.edges(data=True), key=lambda x: x[2]['metric']):
-            if data['metric'] > threshold:
-                ## No need to continue if threshold reached.
-                break
-            
-            if part_graph.has_edge(qry, lib):
-                ## Update edge if it exists
-                if part_graph[qry][lib]['metric'] > data['metric']:
-                    nx.set_edge_attributes(part_graph,{(qry,lib):data['metric']}, 'metric')
-                continue
-            
-            if part_graph.nodes[qry]['cluster'] == part_graph.nodes[lib]['cluster']:
-               continue
+        clusters = restricted_linkage(graph, threshold, part_size, label_limits)
+    graph.component_size = np.bincount(clusters, minlength=n_nodes)[clusters]
 
-            ## RESTRICTIONS!
-            if part_graph.nodes[qry]['C-size'] >= part_size:
-                continue
-            if part_graph.nodes[lib]['C-size'] >= part_size:
-                continue
-            if (part_graph.nodes[qry]['label-counts']+part_graph.nodes[lib]['label-counts'] >= label_limits).any():
-                continue
-            
-            ## Add edge and update mini-cluster
-            attr = part_graph.nodes[qry]
-            if attr['cluster'] != part_graph.nodes[lib]['cluster'] or mode == 'fast-nn':
-                attr['C-size'] += part_graph.nodes[lib]['C-size']
-                attr['label-counts'] += part_graph.nodes[lib]['label-counts']
-            nx.set_node_attributes(part_graph, {qry:attr})
-            part_graph.add_edge(qry, lib, metric=data['metric'])
-
-            for descendant in nx.descendants(part_graph, qry):
-                nx.set_node_attributes(part_graph, {descendant:attr})
-
-            count += 1
-            if count % 10000 == 0:
-                print("edges:", part_graph.number_of_edges()) 
-                print (attr, data)
-        #with open('graph_part_miniclusters.txt','w+') as outf:
-        for cc_nr, cc in enumerate(nx.connected_components(part_graph)):
-            for n in cc:
-                d = full_graph.nodes[n]
-                acs.append(n)
-                clusters.append(cc_nr)
-                labels.append(d['label-val'])
-                    #outf.write("%s,%d\n" % (n,cc_nr))
-
-    acs = np.array(acs)
-    clusters = np.array(clusters)
-    labels = np.array(labels)
-    print(len(np.unique(labels)))
-    partitioning = partition_assignment(clusters, labels, nr_of_parts, len(np.unique(labels)))
-    for ind, p in enumerate(partitioning):
-        attr = part_graph.nodes[acs[ind]]
-        attr['cluster'] = p
-        nx.set_node_attributes(part_graph,{acs[ind]:attr})
-
-
-def remover(full_graph: nx.classes.graph.Graph, 
-            part_graph: nx.classes.graph.Graph, 
-            threshold:float, 
+    print(len(np.unique(graph.label)))
+    graph.cluster = partition_assignment(clusters, graph.label, nr_of_parts, len(np.unique(graph.label)))
+
+
+def remover(graph: EntityGraph,
+            threshold:float,
             json_dict: Dict[str, Any],
-            move_to_most_neighbourly:bool = True, 
+            move_to_most_neighbourly:bool = True,
             ignore_priority:bool = True,
             simplistic_removal:bool = True,
             verbose: bool = True):
+    '''
+    Remove entities until no within-threshold edges between partitions are left.
+    Each round visits the entities in loading order, moves them to the partition that
+    holds most of their within-threshold neighbours and computes their between-partition
+    connectivity. Then the most connected entities are removed.
+
+    Only entities whose own partition or whose within-threshold neighbourhood changed since
+    their last visit are visited again, all others would give the same result.
+    The most connected entities are taken from a max-heap.
+    '''
 
     if ignore_priority:
         json_dict['removal_step_1'] = {}
@@ -276,90 +325,158 @@ def remover(full_graph: nx.classes.graph.Graph,
     else:
         json_dict['removal_step_2'] = {}
         dict_key = 'removal_step_2'
-    
+
     if verbose:
         print("Min-threshold", "\t", "#Entities", "\t", "#Edges", "\t", "Connectivity", "\t", "#Problematics", "\t", "#Relocated", "\t", "#To-be-removed")
+
+    n_nodes = len(graph.ids)
+    cluster = graph.cluster
+    alive = graph.alive
+    skip_node = graph.priority & ignore_priority
+
+    ## Only within-threshold edges can move or connect entities. Neighbours are kept in the
+    ## order in which their edges were loaded, which breaks ties between equally neighbourly clusters.
+    within = alive[graph.src] & alive[graph.dst] & (graph.metric < threshold)
+    indptr, indices, adj_metric = csr_adjacency(graph.src[within], graph.dst[within], graph.metric[within], n_nodes, graph.rank[within])
+
+    ## State of each entity at its last visit.
+    between_connectivity = np.zeros(n_nodes, dtype=int)
+    min_between = np.full(n_nodes, np.inf)
+    version = [0] * n_nodes
+    connectivity_heap = [] # (-connectivity, node, version), stale entries are skipped.
+    bc_sum = 0
+    bc_count = 0
+
+    def visit(n: int) -> Tuple[bool, np.ndarray]:
+        '''Move n if allowed and update its connectivity. Returns if it moved and its neighbours.'''
+        nonlocal bc_sum, bc_count
+        neighbours = indices[indptr[n]:indptr[n+1]]
+        metrics = adj_metric[indptr[n]:indptr[n+1]]
+        keep = alive[neighbours]
+        neighbours, metrics = neighbours[keep], metrics[keep]
+        neighbour_clusters = cluster[neighbours]
+        node_cluster = cluster[n]
+        moved = False
+
+        ## FIRST MOVE NODE TO CLUSTER WITH MOST NEIGHBOURS
+        if move_to_most_neighbourly and len(neighbours) > 0:
+            counts = Counter(neighbour_clusters.tolist())
+            most_neighbourly_cluster = max(counts.items(), key=lambda x:x[1])[0]
+            if most_neighbourly_cluster != node_cluster:
+                cluster[n] = most_neighbourly_cluster
+                moved = True
+
+        ## Connectivity is computed with respect to the partition the node was in at the start of its visit.
+        connectivity = 0
+        min_between[n] = np.inf
+        if not skip_node[n]:
+            nb_oc_wth = metrics[neighbour_clusters != node_cluster]
+            connectivity = len(nb_oc_wth)
+            if connectivity > 0:
+                min_between[n] = nb_oc_wth.min()
+            if not simplistic_removal:
+                ## The more complex removal criterion. This was worse for GPI anchors. Haven't checked for Subnuclear
+                nb_sc_wth = metrics[neighbour_clusters == node_cluster]
+                connectivity += np.count_nonzero(nb_sc_wth[:,None] + nb_oc_wth[None,:] >= threshold)
+
+        if connectivity != between_connectivity[n]:
+            bc_sum += connectivity - between_connectivity[n]
+            bc_count += int(connectivity > 0) - int(between_connectivity[n] > 0)
+            between_connectivity[n] = connectivity
+            version[n] += 1
+            if connectivity > 0:
+                heapq.heappush(connectivity_heap, (-connectivity, n, version[n]))
+
+        return moved, neighbours
+
+    n_entities = graph.number_of_nodes()
+    n_edges = graph.number_of_edges()
+    to_visit = set(graph.nodes().tolist())
     removing_round = 0
     while True:
-        between_connectivity = {}
-        min_oc_wth= 1
+        ## Visit in loading order. A node that moves changes the neighbourhood of its neighbours:
+        ## later ones are visited in this round, earlier ones in the next.
         number_moved = 0
-        for n,d in full_graph.nodes(data=True):
-            neighbours = nx.neighbors(full_graph,n)
-            neighbour_clusters = Counter((part_graph.nodes[nb]['cluster'] for nb in nx.neighbors(full_graph,n) if full_graph[n][nb]['metric'] < threshold))
-            cluster = part_graph.nodes[n]['cluster']
-            nb_sc_wth = []
-            nb_oc_wth = []
-            
-            ## FIRST MOVE NODE TO CLUSTER WITH MOST NEIGHBOURS
-            if move_to_most_neighbourly:
-                if len(neighbour_clusters) > 0:
-                    most_neighbourly_cluster = max(neighbour_clusters.items(), key=lambda x:x[1])[0]
-                    if most_neighbourly_cluster != cluster:
-                        part_graph.nodes[n]['cluster'] = most_neighbourly_cluster
-                        number_moved += 1
-            
-            if ignore_priority and full_graph.nodes[n]['priority']:
-                between_connectivity[n] = 0
+        queue = sorted(to_visit)
+        queued = to_visit
+        to_visit = set()
+        while queue:
+            n = heapq.heappop(queue)
+            if not alive[n]:
                 continue
-
-            for neighbour in neighbours:
-                nb_cluster = part_graph.nodes[neighbour]['cluster']
-                if nb_cluster == cluster and full_graph[n][neighbour]['metric'] < threshold and not simplistic_removal:
-                    ## The more complex removal criterion. This was worse for GPI anchors. Haven't checked for Subnuclear
-                    nb_sc_wth.append(full_graph[n][neighbour]['metric'])
-                elif nb_cluster != cluster and full_graph[n][neighbour]['metric'] < threshold:
-                    min_oc_wth = min(min_oc_wth, full_graph[n][neighbour]['metric'])
-                    nb_oc_wth.append(full_graph[n][neighbour]['metric'])
-
-            ## The more complex additional connectivity criterion, will be empty with simple_removal == True        
-            distances = [x for x in (sum(x_) for x_ in product(nb_sc_wth, nb_oc_wth)) if x >= threshold] 
-            
-            distances += nb_oc_wth
-
-            between_connectivity[n] = len(distances)
-            
-        nx.set_node_attributes(full_graph, between_connectivity, 'between_connectivity')
-        bc_sum = np.sum(np.fromiter((d['between_connectivity'] for n,d in full_graph.nodes(data=True)),int))
-        bc_count = np.sum(np.fromiter((1 for n,d in full_graph.nodes(data=True) if d['between_connectivity'] > 0),int))
+            moved, neighbours = visit(n)
+            if moved:
+                number_moved += 1
+                to_visit.add(n)
+                for neighbour in neighbours.tolist():
+                    if neighbour > n and neighbour not in queued:
+                        queued.add(neighbour)
+                        heapq.heappush(queue, neighbour)
+                    elif neighbour < n:
+                        to_visit.add(neighbour)
+
+        graph.between_connectivity = between_connectivity
+        min_oc_wth = min(1, float(np.min(min_between[alive]))) if n_entities > 0 else 1
 
         removing_round += 1
         number_to_remove = int(bc_count*np.log10(removing_round)/100)+1 # int(bc_count*0.01)+1
-        ## Remove 1% + 1 of the most problematic entities
-        remove_these = [x[0] for x in sorted(((n,d['between_connectivity']) for n,d in full_graph.nodes(data=True) if d['between_connectivity'] > 0), key=lambda x:x[1], reverse=True)[:number_to_remove]]
-        
+        ## Remove 1% + 1 of the most problematic entities, ties in loading order.
+        remove_these = []
+        while len(remove_these) < number_to_remove and len(connectivity_heap) > 0:
+            _, n, n_version = heapq.heappop(connectivity_heap)
+            if alive[n] and version[n] == n_version:
+                remove_these.append(n)
+
         if verbose:
-            print(round(min_oc_wth,7), "\t\t", full_graph.number_of_nodes(), "\t\t", full_graph.number_of_edges(), "\t\t", bc_sum, "\t\t", bc_count, "\t\t", number_moved, "\t\t", len(remove_these))
-        
+            print(round(min_oc_wth,7), "\t\t", n_entities, "\t\t", n_edges, "\t\t", bc_sum, "\t\t", bc_count, "\t\t", number_moved, "\t\t", len(remove_these))
+
         json_dict[dict_key][removing_round] = {
                                                 "Min-threshold": round(min_oc_wth,7) ,
-                                                "#Entities": full_graph.number_of_nodes(),
-                                                "#Edges": full_graph.number_of_edges(),
-                                                "Connectivity": int(bc_sum), 
-                                                "#Problematics": int(bc_count), 
-                                                "#Relocated": number_moved, 
+                                                "#Entities": n_entities,
+                                                "#Edges": n_edges,
+                                                "Connectivity": int(bc_sum),
+                                                "#Problematics": int(bc_count),
+                                                "#Relocated": number_moved,
                                                 "#To-be-removed":len(remove_these)
                                                 }
 
-        full_graph.remove_nodes_from(remove_these)
-        # If we've removed the last problematic entities, we stop
-        if full_graph.number_of_nodes()==0 or bc_sum==0 or len(remove_these) == bc_count:
+        # If we remove the last problematic entities, we stop after this round
+        done = bc_sum == 0 or len(remove_these) == bc_count
+
+        ## Removing a node changes the neighbourhood of its within-threshold neighbours.
+        for n in remove_these:
+            n_edges -= int(np.count_nonzero(alive[graph.neighbours(n)[0]]))
+            alive[n] = False
+            neighbours = indices[indptr[n]:indptr[n+1]]
+            to_visit.update(neighbours[alive[neighbours]].tolist())
+            bc_sum -= between_connectivity[n]
+            bc_count -= 1
+        n_entities -= len(remove_these)
+
+        if n_entities==0 or done:
             break
 
+        ## Drop stale heap entries once they dominate the heap.
+        if len(connectivity_heap) > 2 * bc_count + 1024:
+            connectivity_heap = [(-between_connectivity[n], n, version[n]) for n in np.flatnonzero(alive & (between_connectivity > 0)).tolist()]
+            heapq.heapify(connectivity_heap)
+
 def score_partitioning(df:pd.core.frame.DataFrame) -> float:
     s0 = df.shape[0]
     s1 = df.shape[1]
     return float((df.product(axis=1)**(1/s1)).product()**(1/s0))
 
 def display_results(
-    part_graph: nx.classes.graph.Graph, 
-    full_graph: nx.classes.graph.Graph,
+    graph: EntityGraph,
     labels: dict,
     nr_of_parts: int,
     verbose: bool = True) -> Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]:
     """ """
-    df = pd.DataFrame(((d) for n,d in full_graph.nodes(data=True)))
-    df['cluster'] = [part_graph.nodes[n]['cluster'] for n in full_graph.nodes()]
+    nodes = graph.nodes()
+    df = pd.DataFrame({'priority': graph.priority[nodes], 'label-val': graph.label[nodes]})
+    if graph.between_connectivity is not None:
+        df['between_connectivity'] = graph.between_connectivity[nodes]
+    df['cluster'] = graph.cluster[nodes]
 
     # It can happen that removal completely removed one partition.
     # In this case, we need to report back an error
@@ -370,7 +487,7 @@ def display_results(
         '''
         raise RuntimeError(error_string)
 
-    df['AC'] = [n for n in full_graph.nodes()]
+    df['AC'] = [graph.ids[n] for n in nodes]
     result = df.groupby(['cluster','label-val'])['AC'].count().reset_index().pivot_table(values='AC',columns=['label-val'],index=['cluster']).T
     df.set_index('AC', inplace=True)
     result['label'] = ''
@@ -378,34 +495,38 @@ def display_results(
         result.loc[labels[l]['val'], 'label'] = l
         result['mean'] = result[list(range(nr_of_parts))].mean(axis=1)
         result['count'] = result[list(range(nr_of_parts))].sum(axis=1)
-    
+
     if verbose:
         print(result)
         print()
         print("Partitioning score:", score_partitioning(result[range(nr_of_parts)]))
         print()
     return df, result
-    
+
 
 def removal_needed(
-    part_graph: nx.classes.graph.Graph, 
-    full_graph: nx.classes.graph.Graph,
-    threshold: float) -> bool:
-    """ """
-    min_between = float('Inf')
-    for qry, lib, fed in full_graph.edges(data=True):
-        if part_graph.nodes[qry]['cluster'] != part_graph.nodes[lib]['cluster']:
-            if fed['metric'] < min_between:
-                min_between = fed['metric']
-            if min_between < threshold:
-                print ("! ", qry, lib, fed, " !")
-                return True
-    return False
-
-
-def make_graphs_from_sequences(config: Dict[str, Any], threshold: float, json_dict: Dict[str,Any], verbose: bool = True) -> Tuple[nx.classes.graph.Graph, nx.classes.graph.Graph, dict]:
+    graph: EntityGraph,
+    threshold: float) -> Tuple[bool, int, Union[float, None]]:
+    '''
+    Check whether there are within-threshold edges between partitions.
+    Returns whether removal is needed, the number of within-threshold edges between
+    partitions and the minimum distance between partitions (None if no edges cross partitions).
     '''
-    This function performs the alignments and constructs the graphs.
+    src, dst, metric = graph.edge_arrays()
+    between_metric = metric[graph.cluster[src] != graph.cluster[dst]]
+    if len(between_metric) == 0:
+        return False, 0, None
+
+    n_between = int(np.count_nonzero(between_metric < threshold))
+    min_between = float(between_metric.min())
+    if n_between > 0:
+        print ("! ", n_between, "edges between partitions, minimum distance", min_between, " !")
+    return n_between > 0, n_between, min_between
+
+
+def make_graphs_from_sequences(config: Dict[str, Any], threshold: float, json_dict: Dict[str,Any], verbose: bool = True) -> Tuple[EntityGraph, dict]:
+    '''
+    This function performs the alignments and constructs the graph.
 
     Parameters:
     ------------
@@ -424,14 +545,19 @@ def make_graphs_from_sequences(config: Dict[str, Any], threshold: float, json_di
 
     Returns:
     ------------
-        full_graph: nx.classes.graph.Graph
-            Networkx graph that has sequences as nodes and their distances as edge attributes
-        part_graph: nx.classes.graph.Graph
-            Networkx graph that collects the final partition assignments.
+        graph: EntityGraph
+            Graph that has sequences as nodes and their distances as edge attributes.
+            Also collects the partition assignments.
         labels: dict
             Dictionary of label statistics
     '''
-    full_graph, part_graph, labels = load_entities(config['fasta_file'], config['priority_name'], config['labels_name'])
+    ## Run directories are only implemented for the chunked needle mode, don't drop them silently.
+    if config.get('run_dir') is not None and (config.get('cache_dir') is not None or config.get('prefilter')):
+        raise ValueError('A run directory can not be combined with the alignment cache or the prefilter.')
+    if config.get('run_dir') is None and (config.get('resume') or config.get('distributed')):
+        raise ValueError('Resuming and distributing a run need a run directory.')
+
+    graph, labels = load_entities(config['fasta_file'], config['priority_name'], config['labels_name'])
 
     for l in labels:
         """ Find the expected number of entities labelled l in any partition """
@@ -443,47 +569,92 @@ def make_graphs_from_sequences(config: Dict[str, Any], threshold: float, json_di
     json_dict['labels_start'] = labels
 
 
-    if config['alignment_mode'] == 'precomputed':
-        from .precomputed_utils import load_edge_list
-        print('Parsing edge list.')
-        load_edge_list(config['edge_file'], full_graph, config['transformation'], threshold, config['metric_column'])
-        elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
-        if verbose:
-            print(f"Edge list parsing executed in {elapsed_align:0.2f} seconds.")
-
-    elif config['alignment_mode'] == 'mmseqs2':
-        from .mmseqs_utils import generate_edges_mmseqs
-        generate_edges_mmseqs(config['fasta_file'], full_graph, config['transformation'], threshold, config['threshold'], denominator=config['denominator'], delimiter='|', is_nucleotide=config['nucleotide'], use_prefilter=config['prefilter'])
-        elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
-        if verbose:
-            print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")    
-
-    elif config['alignment_mode'] == 'needle' and config['threads']>1:
-        from .needle_utils import generate_edges_mp
-        print('Computing pairwise sequence identities.')
-        generate_edges_mp(config['fasta_file'], full_graph, config['transformation'], threshold, denominator=config['denominator'], n_chunks=config['chunks'], n_procs=config['threads'], parallel_mode=config['parallel_mode'], triangular=config['triangular'], delimiter='|', 
-                            is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'])
-        elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
-        if verbose:
-            print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")
-
-    elif config['alignment_mode'] == 'needle':
-        from .needle_utils import generate_edges
-        print('Computing pairwise sequence identities.')
-        generate_edges(config['fasta_file'],full_graph, config['transformation'], threshold, denominator=config['denominator'], delimiter='|',
-                            is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'])
-        elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
-        if verbose:
-            print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")
-
-    else:
-        raise NotImplementedError('Encountered unspecified alignment mode. This should never happen.')
-
-    
-    return full_graph, part_graph, labels
-
-
-def partition_and_remove(full_graph: nx.classes.graph.Graph, part_graph: nx.classes.graph.Graph, labels: dict, json_dict: dict,
+    ## All temporary files of the run go to its own directory, by default in the system temporary directory.
+    with tmp_dir_context(config.get('tmp_dir')) as tmp_dir:
+        ## Identical sequences are only aligned once, their edges are copied when the graph is finalized.
+        fasta_file = config['fasta_file']
+        unique_fp = os.path.join(tmp_dir, 'graphpart_unique.fasta')
+        if config['alignment_mode'] != 'precomputed':
+            json_dict['duplicates'] = collapse_duplicates(config['fasta_file'], graph, config['transformation'], threshold, unique_fp)
+            if json_dict['duplicates'] > 0:
+                print(f"Found {json_dict['duplicates']} sequences that are identical to an earlier one, aligning each sequence once.")
+                fasta_file = unique_fp
+
+        if config['alignment_mode'] == 'precomputed':
+            from .precomputed_utils import load_edge_list
+            print('Parsing edge list.')
+            load_edge_list(config['edge_file'], graph, config['transformation'], threshold, config['metric_column'])
+            elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
+            if verbose:
+                print(f"Edge list parsing executed in {elapsed_align:0.2f} seconds.")
+
+        elif config['alignment_mode'] == 'mmseqs2':
+            from .mmseqs_utils import generate_edges_mmseqs
+            generate_edges_mmseqs(fasta_file, graph, config['transformation'], threshold, config['threshold'], denominator=config['denominator'], delimiter='|', is_nucleotide=config['nucleotide'], use_prefilter=config['prefilter'],
+                                  cache_dir=config.get('cache_dir'), cache_size=config.get('cache_size', 10), n_threads=config.get('threads', -1), tmp_dir=tmp_dir)
+            elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
+            if verbose:
+                print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")    
+
+        elif config['alignment_mode'] == 'needle' and config.get('cache_dir') is not None:
+            from .needle_utils import generate_edges_cached
+            print('Computing pairwise sequence identities, using the alignment cache.')
+            generate_edges_cached(fasta_file, graph, config['transformation'], threshold, config['cache_dir'], cache_size=config.get('cache_size', 10), denominator=config['denominator'],
+                                n_chunks=config['chunks'], n_procs=config['threads'], parallel_mode=config['parallel_mode'], triangular=config['triangular'],
+                                prefilter=config.get('prefilter', False), kmer_size=config.get('prefilter_kmer'), min_shared_kmers=config.get('prefilter_min_shared'), delimiter='|',
+                                is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'], max_in_flight=config.get('max_in_flight'), tmp_dir=tmp_dir, json_dict=json_dict)
+            elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
+            if verbose:
+                print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")
+
+        elif config['alignment_mode'] == 'needle' and config.get('prefilter'):
+            from .needle_utils import generate_edges_prefiltered
+            print('Computing pairwise sequence identities of k-mer prefilter candidates.')
+            generate_edges_prefiltered(fasta_file, graph, config['transformation'], threshold, denominator=config['denominator'], kmer_size=config.get('prefilter_kmer'), min_shared_kmers=config.get('prefilter_min_shared'),
+                                n_procs=config['threads'], parallel_mode=config['parallel_mode'], triangular=config['triangular'], delimiter='|',
+                                is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'], max_in_flight=config.get('max_in_flight'), tmp_dir=tmp_dir, json_dict=json_dict)
+            elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
+            if verbose:
+                print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")
+
+        elif config['alignment_mode'] == 'needle' and (config['threads']>1 or config.get('run_dir') is not None):
+            from .needle_utils import generate_edges_mp
+            print('Computing pairwise sequence identities.')
+            generate_edges_mp(fasta_file, graph, config['transformation'], threshold, denominator=config['denominator'], n_chunks=config['chunks'], n_procs=config['threads'], parallel_mode=config['parallel_mode'], triangular=config['triangular'], delimiter='|', 
+                                is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'], max_in_flight=config.get('max_in_flight'),
+                                run_dir=config.get('run_dir'), resume=config.get('resume', False), distributed=config.get('distributed', False), tmp_dir=tmp_dir, json_dict=json_dict)
+            elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
+            if verbose:
+                print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")
+
+        elif config['alignment_mode'] == 'nw':
+            from .nw_utils import generate_edges_nw
+            print('Computing pairwise sequence identities.')
+            generate_edges_nw(fasta_file, graph, config['transformation'], threshold, denominator=config['denominator'], n_procs=config['threads'], delimiter='|',
+                                is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'], max_in_flight=config.get('max_in_flight'),
+                                prefilter=config.get('prefilter', False), kmer_size=config.get('prefilter_kmer'), min_shared_kmers=config.get('prefilter_min_shared'), json_dict=json_dict)
+            elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
+            if verbose:
+                print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")
+
+        elif config['alignment_mode'] == 'needle':
+            from .needle_utils import generate_edges
+            print('Computing pairwise sequence identities.')
+            generate_edges(fasta_file, graph, config['transformation'], threshold, denominator=config['denominator'], delimiter='|',
+                                is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'], tmp_dir=tmp_dir, json_dict=json_dict)
+            elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
+            if verbose:
+                print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")
+
+        else:
+            raise NotImplementedError('Encountered unspecified alignment mode. This should never happen.')
+
+    graph.finalize()
+
+    return graph, labels
+
+
+def partition_and_remove(graph: EntityGraph, labels: dict, json_dict: dict,
                             threshold: float, config: dict, write_intermediate_file: bool = False, verbose: bool = True) -> pd.core.frame.DataFrame:
     '''
     This function runs the core Graph-Part algorithm. Its inputs are generated by
@@ -491,47 +662,56 @@ def partition_and_remove(full_graph: nx.classes.graph.Graph, part_graph: nx.clas
     kind for non-sequence data.
     '''
     
-    partition_data(full_graph, part_graph, labels, threshold, config['partitions'], config['initialization_mode'])
+    partition_data(graph, labels, threshold, config['partitions'], config['initialization_mode'])
 
-    df, result = display_results(part_graph, full_graph, labels, config['partitions'], verbose=verbose)
+    df, result = display_results(graph, labels, config['partitions'], verbose=verbose)
     if config['test_ratio']>0:
-        train_val_test_split(part_graph, full_graph, threshold, config['test_ratio'], config['val_ratio'], config['partitions'])
+        train_val_test_split(graph, threshold, config['test_ratio'], config['val_ratio'], config['partitions'])
         config['partitions'] = 3 if config['val_ratio']>0 else 2
 
-    df, result = display_results(part_graph, full_graph, labels, config['partitions'], verbose=verbose)
+    df, result = display_results(graph, labels, config['partitions'], verbose=verbose)
     if write_intermediate_file:
         df.to_csv(config['out_file'] + "pre-removal")
-    print('Currently have this many samples:', full_graph.number_of_nodes())
+    print('Currently have this many samples:', graph.number_of_nodes())
 
     json_dict['partitioning_pre_removal'] = result.to_json()
-    json_dict['samples_pre_removal'] = full_graph.number_of_nodes()
+    json_dict['samples_pre_removal'] = graph.number_of_nodes()
     json_dict['score_pre_removal'] = score_partitioning(result[range(config['partitions'])])
 
     
     ## Check if we need to remove any
-    if removal_needed(part_graph, full_graph, threshold):     
-        print('Need to remove! Currently have this many samples:', full_graph.number_of_nodes())
+    need_removal, n_between, min_between = removal_needed(graph, threshold)
+    json_dict['edges_between_pre_removal'] = n_between
+    json_dict['min_between_pre_removal'] = min_between
 
-        remover(full_graph, part_graph, threshold, json_dict, config['allow_moving'], True, config['removal_type'], verbose=verbose)    
+    if need_removal:
+        print('Need to remove! Currently have this many samples:', graph.number_of_nodes())
 
-    if removal_needed(part_graph, full_graph, threshold):   
-        print('Need to remove priority! Currently have this many samples:', full_graph.number_of_nodes())
-        remover(full_graph, part_graph, threshold, json_dict, config['allow_moving'], False, config['removal_type'], verbose=verbose)    
+        remover(graph, threshold, json_dict, config['allow_moving'], True, config['removal_type'], verbose=verbose)    
+        need_removal, n_between, min_between = removal_needed(graph, threshold)
 
-    print('After removal we have this many samples:', full_graph.number_of_nodes())
+    if need_removal:
+        print('Need to remove priority! Currently have this many samples:', graph.number_of_nodes())
+        remover(graph, threshold, json_dict, config['allow_moving'], False, config['removal_type'], verbose=verbose)    
+        need_removal, n_between, min_between = removal_needed(graph, threshold)
 
+    print('After removal we have this many samples:', graph.number_of_nodes())
 
-    df, result = display_results(part_graph, full_graph, labels, config['partitions'], verbose=verbose)
+
+    df, result = display_results(graph, labels, config['partitions'], verbose=verbose)
 
     json_dict['partitioning_after_removal'] = result.to_json()
-    json_dict['samples_after_removal'] = full_graph.number_of_nodes()
+    json_dict['samples_after_removal'] = graph.number_of_nodes()
     json_dict['score_after_removal'] = score_partitioning(result[range(config['partitions'])])
 
-    if removal_needed(part_graph, full_graph, threshold):
+    # the graph does not change after the last check, so its result is still valid.
+    if need_removal:
         print ("Something is wrong! Removal still needed!")
         json_dict['removal_needed_end'] = True
     else:
         json_dict['removal_needed_end'] = False
+    json_dict['edges_between_after_removal'] = n_between
+    json_dict['min_between_after_removal'] = min_between
 
     return df
 
@@ -573,31 +753,39 @@ def run_partitioning(config: Dict[str, Union[str,int,float,bool]], write_output_
 
     ## Processing starts here:
 
-    ## Load entities/samples as networkx graphs. labels contains label metadata.
-    full_graph, part_graph, labels = make_graphs_from_sequences(config, threshold, json_dict, verbose)
+    ## Load entities/samples as a graph. labels contains label metadata.
+    graph, labels = make_graphs_from_sequences(config, threshold, json_dict, verbose)
 
 
     ## Let's look at the number of edges
-    print("Full graph nr. of edges:", full_graph.number_of_edges())
+    print("Full graph nr. of edges:", graph.number_of_edges())
 
-    json_dict['graph_edges_start'] = full_graph.number_of_edges()
+    json_dict['graph_edges_start'] = graph.number_of_edges()
     json_dict['time_edges_complete'] = time.perf_counter()
 
-    if config['save_checkpoint_path'] is not None:
+    if config['save_checkpoint_path'] is not None and config.get('checkpoint_format', 'csv') == 'binary':
+        from .transformations import ARRAY_INVERSE_TRANSFORMATIONS
+        from .precomputed_utils import write_binary_edge_list
+        print(f'Saving binary edge list at {config["save_checkpoint_path"]} ...')
+        src, dst, metric = graph.edge_arrays()
+        # we save the original metric. not the one that we transformed. So revert transformation.
+        write_binary_edge_list(config['save_checkpoint_path'], graph.ids, src, dst, ARRAY_INVERSE_TRANSFORMATIONS[config['transformation']](metric))
+
+    elif config['save_checkpoint_path'] is not None:
         from .transformations import INVERSE_TRANSFORMATIONS
         from tqdm.auto import tqdm
         print(f'Saving edge list at {config["save_checkpoint_path"]} ...')
-        with open(config['save_checkpoint_path'], 'w') as f:
+        with open_output(config['save_checkpoint_path']) as f:
             inv_tf = INVERSE_TRANSFORMATIONS[config['transformation']]
-            for qry, lib, data in tqdm(full_graph.edges(data=True)):
+            for qry, lib, metric in tqdm(graph.edges(), total=graph.number_of_edges()):
                 # we save the original metric. not the one that we transformed. So revert transformation.
-                score = inv_tf(data['metric'])
-                f.write(qry+ ',' + lib +',' + str(score) +'\n')
+                score = inv_tf(metric)
+                f.write(graph.ids[qry]+ ',' + graph.ids[lib] +',' + str(score) +'\n')
 
 
     
     ## Finally, let's partition this
-    df = partition_and_remove(full_graph, part_graph, labels, json_dict, threshold, config, write_intermediate_file=False, verbose=verbose)
+    df = partition_and_remove(graph, labels, json_dict, threshold, config, write_intermediate_file=False, verbose=verbose)
 
     ## clustering to outfile. This will probably change...
     if write_output_file:
@@ -1,10 +1,22 @@
 import subprocess
 import os
 import shutil
-from .transformations import TRANSFORMATIONS
-import networkx as nx
+from typing import Iterator, List, Tuple
+import numpy as np
+import pandas as pd
+from .transformations import ARRAY_TRANSFORMATIONS
+from .entity_graph import EntityGraph
+from .temp_utils import make_tmp_dir
+from .cache_utils import DEFAULT_CACHE_SIZE, DirectoryCache
+from .run_dir_utils import file_hash
 from tqdm.auto import tqdm
 
+## Number of alignments that are parsed and added to the graph at once.
+BATCH_SIZE = 1000000
+
+## All-vs-all alignments are done in blocks of queries with about this many pairs.
+BLOCK_PAIRS = 1 << 27
+
 # mmseqs createdb data/netgpi_dataset.fasta temp/netgpi_db
 # mmseqs prefilter -s 7.5 temp/netgpi_db temp/netgpi_db temp/netgpi_pref
 # mmseqs align temp/netgpi_db temp/netgpi_db temp/netgpi_pref temp/netgpi_align_db
@@ -12,9 +24,75 @@ from tqdm.auto import tqdm
 # paste -d "," <(cut -f1 -d "|" temp/alignments.tab) <(cut -f2 temp/alignments.tab | cut -f1 -d "|") <(cut -f3 temp/alignments.tab) >netgpi_mmseqs_edgelist.csv
 
 
+def write_numbered_fasta(fp: str, seqs: List[str], idx: np.ndarray) -> None:
+    '''
+    Write the sequences at positions idx to fp, with their number in idx as the header.
+    mmseqs2 then reports integers that index idx, which parse much faster than identifiers.
+    '''
+    with open(fp, 'w') as f:
+        for k, i in enumerate(idx.tolist()):
+            f.write(f'>{k}\n')
+            f.write(seqs[i]+'\n')
+
+
+def read_alignments(fp: str, batch_size: int = BATCH_SIZE) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    '''
+    Read a convertalis file with the columns query,target,fident of numbered sequences
+    in batches of batch_size lines. Yields the query numbers, target numbers and identities.
+    '''
+    if os.path.getsize(fp) == 0:
+        return
+    reader = pd.read_csv(fp, sep='\t', header=None, names=['query', 'target', 'fident'], engine='c',
+                         dtype={'query': np.int64, 'target': np.int64, 'fident': np.float64}, chunksize=batch_size)
+    with reader:
+        for chunk in reader:
+            yield chunk['query'].to_numpy(), chunk['target'].to_numpy(), chunk['fident'].to_numpy()
+
+
+def align_query_blocks(qry_db: str,
+                       target_db: str,
+                       work_dir: str,
+                       block_size: int,
+                       align_args: List[str],
+                       threads: List[str]) -> Iterator[Tuple[np.ndarray, str]]:
+    '''
+    Align all numbered sequences in qry_db against all sequences in target_db, in
+    blocks of block_size queries. Each block is cut from qry_db with createsubdb and
+    aligned against target_db as its own job, so that the intermediate files only
+    hold the alignments of one block. Yields the query numbers of each block and
+    its convertalis file. The files of a block are removed before the next one starts.
+    '''
+    # the lookup maps the keys of the database to the headers, which are the numbers of the sequences.
+    lookup = pd.read_csv(qry_db + '.lookup', sep='\t', header=None, usecols=[0, 1], names=['key', 'number'], dtype=np.int64)
+    lookup = lookup.sort_values('number')
+    keys, numbers = lookup['key'].to_numpy(), lookup['number'].to_numpy()
+
+    keys_fp, block_db, pref, align_db, alignments = (os.path.join(work_dir, name) for name in ('block_keys.txt', 'block_db', 'block_pref', 'block_align_db', 'block_alignments.tab'))
+    for start in range(0, len(keys), block_size):
+        np.savetxt(keys_fp, keys[start:start+block_size], fmt='%d')
+        subprocess.run(['mmseqs', 'createsubdb', keys_fp, qry_db, block_db])
+        subprocess.run(['mmseqs', 'createsubdb', keys_fp, qry_db + '_h', block_db + '_h'])
+        # every query of the block points at all targets.
+        subprocess.run(['mmseqs_fake_prefilter.sh', block_db, target_db, pref, os.path.abspath(target_db)])
+        subprocess.run(['mmseqs', 'align', block_db, target_db, pref, align_db] + align_args)
+        subprocess.run(['mmseqs', 'convertalis', block_db, target_db, align_db, alignments, '--format-output', 'query,target,fident'] + threads)
+
+        yield numbers[start:start+block_size], alignments
+
+        for file in os.listdir(work_dir):
+            if file.startswith('block_'):
+                os.remove(os.path.join(work_dir, file))
+
+
+def resolve_threads(n_threads: int) -> int:
+    '''Number of threads for mmseqs2, -1 or None uses all cores.'''
+    if n_threads is None or n_threads < 1:
+        return os.cpu_count()
+    return n_threads
+
 
 def generate_edges_mmseqs(entity_fp: str, 
-                  full_graph: nx.classes.graph.Graph, 
+                  graph: EntityGraph,
                   tranformation: str,
                   threshold_transformed: float,
                   threshold_original: float = None, # use original threshold (before one-minus) to pass to mmseqs
@@ -22,60 +100,90 @@ def generate_edges_mmseqs(entity_fp: str,
                   delimiter: str = '|',
                   is_nucleotide: bool = False,
                   use_prefilter: bool = False,
+                  cache_dir: str = None,
+                  cache_size: float = DEFAULT_CACHE_SIZE,
+                  n_threads: int = -1,
+                  tmp_dir: str = None,
                   ) -> None:
-
+    '''
+    Align all sequences against each other with mmseqs2 and insert the found edges into the graph.
+    All mmseqs2 steps that can run in parallel use n_threads threads, -1 uses all cores.
+    The sequences are numbered for mmseqs2, so that the alignments can be read as
+    integers in large batches and mapped to the graph with one array lookup.
+    All-vs-all alignments are done in blocks of queries, see `align_query_blocks`.
+    The mmseqs2 databases are written to a new directory in tmp_dir, or in the default
+    temporary location when tmp_dir is None.
+    With cache_dir, the sequence database and the prefilter results are kept in
+    cache_dir/mmseqs, keyed by a hash of the sequences and the database type, so that
+    runs on the same sequences with another threshold or denominator only need to align.
+    Pairwise identities are not cached for mmseqs2: without the prefilter, caching
+    every aligned pair would take more space and time than the alignment saves.
+    '''
+    from .needle_utils import parse_fasta
 
     if shutil.which('mmseqs') is None:
         print('MMseqs2 was not found. Please run `conda install -c conda-forge -c bioconda mmseqs2`')
         exit()
 
-    os.makedirs('temp', exist_ok=True)
+    threads = ['--threads', str(resolve_threads(n_threads))]
+    work_dir = make_tmp_dir(tmp_dir)
+    seq_fasta, seq_db, pref, align_db, alignments = (os.path.join(work_dir, name) for name in ('seqs.fasta', 'seq_db', 'pref', 'align_db', 'alignments.tab'))
+
+    ids, seqs = parse_fasta(entity_fp, delimiter)
+    node_ids = graph.node_ids([id.lstrip('>') for id in ids])
+    write_numbered_fasta(seq_fasta, seqs, np.arange(len(seqs)))
+    del ids, seqs
 
     # Run all mmseqs ops to get a tab file that contains the alignments.
     typ = '2' if is_nucleotide else '1'
-    subprocess.run(['mmseqs', 'createdb', '--dbtype', typ, entity_fp, 'temp/seq_db'])
+    db_cache = DirectoryCache(cache_dir, 'mmseqs', cache_size) if cache_dir is not None else None
+    db_key = f'{file_hash(seq_fasta)}_dbtype{typ}'
 
-    # However, this function will not work with nucleotidenucleotide searches, 
-    # since we need to have a valid diagonal for the banded alignment.
-    if is_nucleotide or use_prefilter:
-        subprocess.run(['mmseqs', 'prefilter', '-s', '7.5', 'temp/seq_db', 'temp/seq_db', 'temp/pref'])
+    def build_db(path: str) -> None:
+        subprocess.run(['mmseqs', 'createdb', '--dbtype', typ, seq_fasta, os.path.join(path, 'seq_db')])
+    if db_cache is None:
+        build_db(work_dir)
     else:
-        subprocess.run(['mmseqs_fake_prefilter.sh', 'temp/seq_db', 'temp/seq_db', 'temp/pref', 'seq_db'])
+        db_dir, cached = db_cache.get(db_key, build_db)
+        seq_db = os.path.join(db_dir, 'seq_db')
+        if cached:
+            print('Using the cached sequence database.')
 
     # 0: alignment length 1: shorter, 2: longer sequence
     id_mode = {'n_aligned':'0', 'shortest':'1', 'longest':'2'}[denominator]
-    
-    command = ['mmseqs', 'align',  'temp/seq_db', 'temp/seq_db', 'temp/pref', 'temp/align_db', '--alignment-mode', '3', '-e', 'inf', '--seq-id-mode', id_mode]
+    align_args = ['--alignment-mode', '3', '-e', 'inf', '--seq-id-mode', id_mode] + threads
     if threshold_original is not None:
-        command = command + ['--min-seq-id', str(threshold_original)]
-    subprocess.run(command)
-    subprocess.run(['mmseqs', 'convertalis', 'temp/seq_db', 'temp/seq_db', 'temp/align_db', 'temp/alignments.tab'])
+        align_args = align_args + ['--min-seq-id', str(threshold_original)]
+
+    # However, this function will not work with nucleotidenucleotide searches, 
+    # since we need to have a valid diagonal for the banded alignment.
+    if is_nucleotide or use_prefilter:
+        def build_pref(path: str) -> None:
+            subprocess.run(['mmseqs', 'prefilter', '-s', '7.5', seq_db, seq_db, os.path.join(path, 'pref')] + threads)
+        if db_cache is None:
+            build_pref(work_dir)
+        else:
+            pref_dir, cached = db_cache.get(f'{db_key}_prefilter_s7.5', build_pref)
+            pref = os.path.join(pref_dir, 'pref')
+            if cached:
+                print('Using the cached prefilter results.')
+        subprocess.run(['mmseqs', 'align',  seq_db, seq_db, pref, align_db] + align_args)
+        subprocess.run(['mmseqs', 'convertalis', seq_db, seq_db, align_db, alignments, '--format-output', 'query,target,fident'] + threads)
+        files = [alignments]
+    else:
+        block_size = max(resolve_threads(n_threads), BLOCK_PAIRS // max(1, len(node_ids)))
+        files = (file for _, file in align_query_blocks(seq_db, seq_db, work_dir, block_size, align_args, threads))
 
     # Read the result
-    with open('temp/alignments.tab') as inf:
-        for line_nr, line in tqdm(enumerate(inf)):
-            spl = line.strip().split('\t')
-
-            this_qry = spl[0].split(delimiter)[0]
-            this_lib = spl[1].split(delimiter)[0]
-            ident = float(spl[2])
-
-            try:
-                metric = TRANSFORMATIONS[tranformation](ident)
-            except ValueError or TypeError:
-                raise TypeError("Failed to interpret the metric column value %r. Please ensure that the edge list file is correctly formatted and that the correct column is specified." % (spl[1]))
-            
-            if this_qry == this_lib:
-                continue
-            if metric > threshold_transformed:
-                continue
-            if not full_graph.has_node(this_qry) or not full_graph.has_node(this_lib):
-                continue
-            if full_graph.has_edge(this_qry, this_lib):
-                if full_graph[this_qry][this_lib]['metric'] > metric:
-                    #nx.set_edge_attributes(full_graph,{(this_qry,this_lib):metric}, 'metric')
-                    full_graph.add_edge(this_qry, this_lib, metric=metric) #Notes: Adding an edge that already exists updates the edge data. 
-            else:
-                full_graph.add_edge(this_qry, this_lib, metric=metric)  
-
-    shutil.rmtree('temp')
+    with tqdm() as pbar:
+        for file in files:
+            for qrys, libs, idents in read_alignments(file):
+                metric = ARRAY_TRANSFORMATIONS[tranformation](idents)
+                src, dst = node_ids[qrys], node_ids[libs]
+                keep = ~(metric > threshold_transformed) & (src >= 0) & (dst >= 0)
+                graph.add_edges(src[keep], dst[keep], metric[keep])
+                pbar.update(len(qrys))
+
+    shutil.rmtree(work_dir)
+    if db_cache is not None:
+        db_cache.evict()
@@ -6,9 +6,9 @@ a lot of the sequence-based code.
 from typing import List, Dict, Tuple, Union, Iterable
 import numpy as np
 import pandas as pd
-import networkx as nx
 from tqdm.auto import tqdm
 from .graph_part import partition_and_remove
+from .entity_graph import EntityGraph
 
 
 # TODO
@@ -19,12 +19,12 @@ from .graph_part import partition_and_remove
 
 def load_entities(molecules: Dict[str,str], labels: Dict[str,str] = None, priorities: Dict[str,str] = None):
     '''
-    Construct the graphs by adding nodes. No edges are generated in this step.
+    Construct the graph by adding nodes. No edges are generated in this step.
     '''
-    part_graph = nx.Graph()
-    full_graph = nx.Graph()
+    graph = EntityGraph()
 
     labels_out = {}
+    label_vals, priority_vals = [], []
     for id, mol in molecules.items():
         
         label = '0'
@@ -38,23 +38,18 @@ def load_entities(molecules: Dict[str,str], labels: Dict[str,str] = None, priori
             labels_out[label] = {'val':len(labels_out), 'num':0}
         
         labels_out[label]['num'] += 1
-        label = labels_out[label]['val']
+        label_vals.append(labels_out[label]['val'])
+        priority_vals.append(priority)
 
-        full_graph.add_node(id)
-        part_graph.add_node(id)
-        node_data = {
-        'priority': priority,
-        'label-val': label
-        }
-        nx.set_node_attributes(full_graph, {id:node_data})
+    graph.add_nodes(molecules.keys(), priority_vals, label_vals)
 
             
-    return full_graph, part_graph, labels_out
+    return graph, labels_out
 
 
 
 
-def compute_fingerprint_tanimoto_distances(full_graph: nx.classes.graph.Graph, molecules: Dict[str, str], threshold: float) -> None:
+def compute_fingerprint_tanimoto_distances(graph: EntityGraph, molecules: Dict[str, str], threshold: float) -> None:
     '''Compute the fingerprint tanimoto distances of all pairs and add edges to the graph if they are below
     the threshold'''
     from rdkit import Chem, DataStructs
@@ -69,25 +64,18 @@ def compute_fingerprint_tanimoto_distances(full_graph: nx.classes.graph.Graph, m
 
     #ms = [Chem.MolFromSmiles('CCOC'), Chem.MolFromSmiles('CCO'), Chem.MolFromSmiles('COC')]
     #fps = 
+    node_ids = graph.node_ids(names)
     for idx_1 in tqdm(range(len(names))):
-        name_1 = names[idx_1]
+        if node_ids[idx_1] < 0:
+            continue
 
         similarities = DataStructs.BulkTanimotoSimilarity(fps[idx_1], fps[idx_1+1:])
 
-        for idx_2 in range(len(similarities)):
-            name_2 = names[idx_1+1+idx_2]
-
-
-            metric = 1 - similarities[idx_2]
-            if metric > threshold:
-                continue
-            if not full_graph.has_node(name_1) or not full_graph.has_node(name_2):
-                continue
-            if full_graph.has_edge(name_1, name_2):
-                if full_graph[name_1][name_2]['metric'] > metric:
-                    nx.set_edge_attributes(full_graph,{(name_1,name_2):metric}, 'metric')
-            else:
-                full_graph.add_edge(name_1, name_2, metric=metric)  
+        # add all edges of this molecule in one batch.
+        metric = 1 - np.array(similarities)
+        lib_ids = node_ids[idx_1+1:]
+        keep = ~(metric > threshold) & (lib_ids >= 0)
+        graph.add_edges(np.full(np.count_nonzero(keep), node_ids[idx_1]), lib_ids[keep], metric[keep])
 
 
 
@@ -179,15 +167,16 @@ def train_test_validation_split(molecules: Union[List[str], np.ndarray, Dict[str
     molecules, labels, priority = _convert_to_dict(molecules, labels, priority)
 
     # make the graph
-    full_graph, part_graph, labels = load_entities(molecules, labels, priority)
+    graph, labels = load_entities(molecules, labels, priority)
     for l in labels:
         """ Find the expected number of entities labelled l in any partition """
         labels[l]['lim'] = labels[l]['num']//partitions
 
     threshold = 1- threshold
     # add the edges
-    compute_fingerprint_tanimoto_distances(full_graph, molecules, threshold)
-    print("Full graph nr. of edges:", full_graph.number_of_edges())
+    compute_fingerprint_tanimoto_distances(graph, molecules, threshold)
+    graph.finalize()
+    print("Full graph nr. of edges:", graph.number_of_edges())
 
 
     # run graph-part
@@ -210,7 +199,7 @@ def train_test_validation_split(molecules: Union[List[str], np.ndarray, Dict[str
         "removal_type": not remove_same,
     }
 
-    partition_assignment_df = partition_and_remove(full_graph, part_graph, labels, json_dict={}, threshold=threshold, config=config, verbose=verbose)
+    partition_assignment_df = partition_and_remove(graph, labels, json_dict={}, threshold=threshold, config=config, verbose=verbose)
 
     # 4. Make output lists.
     partition_assignment_df = partition_assignment_df.reset_index()
@@ -251,15 +240,16 @@ def stratified_k_fold(molecules: Union[List[str], np.ndarray, Dict[str,str]],
     molecules, labels, priority = _convert_to_dict(molecules, labels, priority)
 
     # make the graph
-    full_graph, part_graph, labels = load_entities(molecules, labels, priority)
+    graph, labels = load_entities(molecules, labels, priority)
     for l in labels:
         """ Find the expected number of entities labelled l in any partition """
         labels[l]['lim'] = labels[l]['num']//partitions
 
     threshold = 1- threshold
     # add the edges
-    compute_fingerprint_tanimoto_distances(full_graph, molecules, threshold)
-    print("Full graph nr. of edges:", full_graph.number_of_edges())
+    compute_fingerprint_tanimoto_distances(graph, molecules, threshold)
+    graph.finalize()
+    print("Full graph nr. of edges:", graph.number_of_edges())
 
 
     # run graph-part
@@ -282,7 +272,7 @@ def stratified_k_fold(molecules: Union[List[str], np.ndarray, Dict[str,str]],
         "removal_type": not remove_same,
     }
 
-    partition_assignment_df = partition_and_remove(full_graph, part_graph, labels, json_dict={}, threshold=threshold, config=config, verbose=verbose)
+    partition_assignment_df = partition_and_remove(graph, labels, json_dict={}, threshold=threshold, config=config, verbose=verbose)
 
     # 4. Make output lists.
     partition_assignment_df = partition_assignment_df.reset_index()
@@ -1,27 +1,59 @@
 '''
 This file contains functions that call needleall on a provided
 .fasta file and insert the computed pairwise sequence identities
-as edges into a provided networkx graph.
+as edges into a provided graph.
 '''
 import multiprocessing
-import networkx as nx
 from os import path, remove
 import os
 import shutil
 import numpy as np
 import math
+import re
+import time
+from collections import Counter
 from itertools import groupby
-from typing import Dict, List, Tuple, Iterator
+from typing import Any, BinaryIO, Dict, List, Tuple, Iterator
 import concurrent.futures
 from tqdm.auto import tqdm
-from .transformations import TRANSFORMATIONS
+from .transformations import TRANSFORMATIONS, ARRAY_TRANSFORMATIONS
+from .entity_graph import EntityGraph
+from .tile_utils import PRUNE_CHUNKS, auto_n_chunks, can_prune, cost_balanced_chunks, make_tiles, prune_tiles, pruned_pairs, tile_report, run_tiles
+from .kmer_utils import candidate_pairs, prefilter_params, prefilter_report
+from .cache_utils import DEFAULT_CACHE_SIZE, AlignmentCache, sequence_hashes, split_cached_pairs
+from .temp_utils import make_tmp_dir
+from .compression_utils import open_input
+from .run_dir_utils import POLL_SECONDS, LEASE_SECONDS, open_run_dir, read_manifest, read_chunks, write_chunk_fastas, chunk_fasta_path, finished_tiles, write_shard, read_shard, remove_chunk_fastas, queue_tiles, claim_tiles, n_claimed, wait_for_queue, finish_queue
 
 
+## Number of alignments that are parsed before adding them to the graph.
+BATCH_SIZE = 100000
+
 NORMALIZATIONS = {'shortest': lambda a,b,c: a/min(b,c), # a identity b len(seq1) c len(seq2)
                   'longest': lambda a,b,c: a/max(b,c),
                   'mean' : lambda a,b,c: a/((b+c)/2),
                   }
 
+## needleall output is read in blocks of this many bytes.
+READ_SIZE = 1 << 20
+
+## Header of one alignment in needleall pair format, e.g.
+## # 1: P0CV73
+## # 2: P0CV74
+## ...
+## # Identity:     142/142 (100.0%)
+## ...
+## # Gaps:           0/142 ( 0.0%)
+## Only '#' lines may come between the fields, so a match never runs into an alignment body.
+NEEDLE_HEADER = re.compile(
+    rb'^# 1: (\S+)[^\n]*\n'
+    rb'# 2: (\S+)[^\n]*\n'
+    rb'(?:#[^\n]*\n)*?'
+    rb'# Identity:[ \t]*(\d+)/\d+[ \t]*\([ \t]*([0-9.]+)%\)[^\n]*\n'
+    rb'(?:#[^\n]*\n)*?'
+    rb'# Gaps:[ \t]*(\d+)/(\d+)',
+    re.MULTILINE)
+
 
 
 def get_len_dict(ids: List[str], seqs: List[str]) -> Dict[str,int]:
@@ -35,14 +67,14 @@ def get_len_dict(ids: List[str], seqs: List[str]) -> Dict[str,int]:
 def parse_fasta(fastafile: str, sep='|') -> Tuple[List[str],List[str]]:
     '''
     Parses fasta file into lists of identifiers and sequences.
-	Can handle multi-line sequences and empty lines.
+	Can handle multi-line sequences and empty lines, and compressed files.
     Needleall seems to fail when a '|' is between the identifier and the rest of
     the fasta header, so we split the identifier and only return that.
 
     '''
     ids = []
     seqs = []
-    with open(fastafile, 'r') as f:
+    with open_input(fastafile) as f:
 
         id_seq_groups = (group for group in groupby(f, lambda line: line.startswith(">")))
 
@@ -54,10 +86,80 @@ def parse_fasta(fastafile: str, sep='|') -> Tuple[List[str],List[str]]:
     return ids, seqs
 
 
-def chunk_fasta_file(ids: List[str], seqs: List[str], n_chunks: int) -> int:
+def needle_command(query_fp: str, library_fp: str, is_nucleotide: bool, gapopen: float, gapextend: float,
+                   endweight: bool, endopen: float, endextend: float, matrix: str) -> List[str]:
+    '''The needleall command to align all sequences in query_fp to all sequences in library_fp.'''
+    if is_nucleotide:
+        type_1, type_2, = '-snucleotide1', '-snucleotide2'
+    else:
+        type_1, type_2 = '-sprotein1', '-sprotein2'
+
+    command = ["needleall","-auto","-stdout", 
+               "-aformat", "pair", 
+               "-gapopen", str(gapopen),
+               "-gapextend", str(gapextend),
+               "-endopen", str(endopen),
+               "-endextend", str(endextend),
+               "-datafile", matrix,
+               type_1, type_2, query_fp, library_fp]
+    if endweight:
+        command = command + ["-endweight"]
+    return command
+
+
+def parse_needle_output(stream: BinaryIO, denominator: str, seq_lens: Dict[str,int]) -> Iterator[Tuple[str, str, float]]:
+    '''
+    Parse needleall pair format output from a binary stream.
+    The stream is read in large blocks and only the header of each alignment is
+    matched, the alignments themselves are skipped.
+    Yields the query, library and identity of each alignment.
+    '''
+    rest = b''
+    while True:
+        block = stream.read(READ_SIZE)
+        data = rest + block
+        if block:
+            ## Keep the last alignment, its header may continue in the next block.
+            start = data.rfind(b'\n# 1: ') + 1
+            if start == 0 and not data.startswith(b'# 1: '):
+                start = data.rfind(b'\n') + 1
+            data, rest = data[:start], data[start:]
+
+        for qry, lib, n_matches, percent, gaps, length in NEEDLE_HEADER.findall(data):
+            this_qry = qry.split(b'|')[0].decode()
+            this_lib = lib.split(b'|')[0].decode()
+
+            # Compute different sequence identities as needed.
+            if denominator == 'full': # full is returned by default. just need to parse
+                identity = float(percent)/100
+            elif denominator == 'no_gaps':
+                identity = float(int(n_matches)/(int(length)-int(gaps)))
+            else:
+                identity = NORMALIZATIONS[denominator](int(n_matches), seq_lens[this_qry], seq_lens[this_lib])
+
+            yield this_qry, this_lib, identity
+
+        if not block:
+            break
+
+
+def add_named_edges(graph: EntityGraph, qrys: List[str], libs: List[str], metrics: List[float]) -> None:
+    '''
+    Add a batch of edges between accessions to the graph.
+    The graph was constructed from the same file, so all the nodes should be there.
+    '''
+    src, dst = graph.node_ids(qrys), graph.node_ids(libs)
+    missing = np.flatnonzero((src < 0) | (dst < 0))
+    if len(missing) > 0:
+        this_qry, this_lib = qrys[missing[0]], libs[missing[0]]
+        raise RuntimeError(f'Tried to insert edge {this_qry}-{this_lib} into the graph, but did not find nodes. This should not happen, please report a bug.')
+    graph.add_edges(src, dst, metrics)
+
+
+def chunk_fasta_file(ids: List[str], seqs: List[str], n_chunks: int, tmp_dir: str = '.') -> int:
     '''
-    Break up fasta file into multiple smaller files that can be
-    used for multiprocessing.
+    Break up fasta file into multiple smaller files in tmp_dir that can be
+    used for multiprocessing, named graphpart_{i}.fasta.
     Returns the number of generated chunks.
     '''
 
@@ -73,15 +175,7 @@ def chunk_fasta_file(ids: List[str], seqs: List[str], n_chunks: int) -> int:
         chunk_ids = ids[i*chunk_size:(i+1)*chunk_size]
         chunk_seqs = seqs[i*chunk_size:(i+1)*chunk_size]
 
-        current_idx = 0
-        for file in os.listdir('.'):
-            if file.endswith('.fasta.tmp'):
-                file_idx = int(file.split('.')[0].strip('graphpart_'))
-                if current_idx < file_idx:
-                    current_idx = file_idx
-
-
-        with open(f'graphpart_{i+current_idx}.fasta.tmp', 'w') as f:
+        with open(os.path.join(tmp_dir, f'graphpart_{i}.fasta'), 'w') as f:
             for id, seq in zip(chunk_ids, chunk_seqs):
                 f.write(id+'\n')
                 f.write(seq+'\n')
@@ -89,8 +183,24 @@ def chunk_fasta_file(ids: List[str], seqs: List[str], n_chunks: int) -> int:
     return n_chunks - empty_chunks
 
 
+def write_fasta_chunks(ids: List[str], seqs: List[str], chunks: List[np.ndarray], tmp_dir: str = '.') -> List[str]:
+    '''
+    Write each chunk of sequences to its own fasta file in tmp_dir.
+    Returns the file names.
+    '''
+    files = []
+    for i, chunk in enumerate(chunks):
+        files.append(os.path.join(tmp_dir, f'graphpart_{i}.fasta'))
+        with open(files[-1], 'w') as f:
+            for idx in chunk.tolist():
+                f.write(ids[idx]+'\n')
+                f.write(seqs[idx]+'\n')
+
+    return files
+
+
 def generate_edges(entity_fp: str, 
-                  full_graph: nx.classes.graph.Graph, 
+                  graph: EntityGraph,
                   tranformation: str,
                   threshold: float,
                   denominator: str = 'full',
@@ -102,98 +212,80 @@ def generate_edges(entity_fp: str,
                   endopen: float = 10,
                   endextend: float = 0.5,
                   matrix: str = 'EBLOSUM62',
+                  tmp_dir: str = None,
+                  json_dict: Dict[str, Any] = None,
                   ) -> None:
     '''
     Call needleall and insert found edges into the graph as they are computed.
     This is the default implementation that runs one single process for the full
     dataset without multithreading.
+    If the lengths of two sequences can rule out an edge, length bands of the sequences
+    are aligned against each other one by one instead, skipping the pairs of bands
+    without possible edges. Their number of pairs is reported in json_dict['pruned_pairs'].
+    The fasta files for needleall are written to tmp_dir, by default a new temporary directory.
     '''
     if shutil.which('needleall') is None:
         print('EMBOSS needleall was not found. Please run `conda install -c bioconda emboss`')
         exit()
+    own_tmp_dir = tmp_dir is None
+    if own_tmp_dir:
+        tmp_dir = make_tmp_dir()
 
     # rewrite the .fasta file to prevent issues with '|'
     ids, seqs = parse_fasta(entity_fp, delimiter)
     seq_lens = get_len_dict(ids, seqs)
-    #import ipdb; ipdb.set_trace()
-    chunk_fasta_file(ids, seqs,n_chunks=1)
-
-    if is_nucleotide:
-        type_1, type_2, = '-snucleotide1', '-snucleotide2'
-    else:
-        type_1, type_2 = '-sprotein1', '-sprotein2'
-
-    command = ["needleall","-auto","-stdout", 
-               "-aformat", "pair", 
-               "-gapopen", str(gapopen),
-               "-gapextend", str(gapextend),
-               "-endopen", str(endopen),
-               "-endextend", str(endextend),
-               "-datafile", matrix,
-               type_1, type_2, 'graphpart_0.fasta.tmp', 'graphpart_0.fasta.tmp']
-    if endweight:
-        command = command + ["-endweight"]   
-
 
+    if json_dict is not None:
+        json_dict['pruned_pairs'] = 0
+    if can_prune(denominator, tranformation):
+        lens = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        chunks = cost_balanced_chunks(lens, PRUNE_CHUNKS)
+        tiles, n_pruned = prune_tiles(make_tiles(chunks, lens, triangular=False), chunks, lens, denominator, tranformation, threshold)
+        files = write_fasta_chunks(ids, seqs, chunks, tmp_dir)
+        for i, j, _ in tqdm(tiles):
+            count, (qrys, libs, metrics), seconds = compute_edges(files[i], files[j], tranformation, threshold, seq_lens, denominator, delimiter, is_nucleotide, gapopen, gapextend, endweight, endopen, endextend, matrix)
+            add_named_edges(graph, qrys, libs, metrics)
+
+        if json_dict is not None:
+            json_dict['pruned_pairs'] = n_pruned
+        for file in files:
+            remove(file)
+        if own_tmp_dir:
+            shutil.rmtree(tmp_dir)
+        return
+
+    chunk_fasta_file(ids, seqs, n_chunks=1, tmp_dir=tmp_dir)
+    fasta_file = os.path.join(tmp_dir, 'graphpart_0.fasta')
+
+    command = needle_command(fasta_file, fasta_file, is_nucleotide, gapopen, gapextend, endweight, endopen, endextend, matrix)
+
+    qrys, libs, metrics = [], [], []
     import subprocess
     with subprocess.Popen(
             command,
-            stdout=subprocess.PIPE,
-            bufsize=1,
-            universal_newlines=True) as proc:
-        for line_nr, line in enumerate(proc.stdout):
-            if  line.startswith('# 1:'):
-
-                # # 1: P0CV73
-                this_qry = line[5:].split()[0].split('|')[0]
-
-            elif line.startswith('# 2:'):
-                this_lib = line[5:].split()[0].split('|')[0]
-
-            elif line.startswith('# Identity:'):
-                identity_line = line
-
-            #Gap is reported after identity in the output.
-            elif line.startswith('# Gaps:'):
-                # Gaps:           0/142 ( 0.0%)
-                gaps, rest = line[7:].split('/')
-                gaps = int(gaps)
-                length = int(rest.split('(')[0])
-
-                
-                # Compute different sequence identities as needed.
-
-                if denominator == 'full': # full is returned by default. just need to parse
-                    identity = float(identity_line.split('(')[1][:-3])/100
-                elif denominator == 'no_gaps':
-                    n_matches =  int(identity_line[11:].split('/')[0]) #int() does not mind leading spaces
-                    identity = float(n_matches/(length-gaps))
-                else:
-                    n_matches =  int(identity_line[11:].split('/')[0]) #int() does not mind leading spaces
-                    identity = NORMALIZATIONS[denominator](n_matches, seq_lens[this_qry], seq_lens[this_lib])
-                #line = "# Identity:      14/443 ( 3.2%)"
-                # n_matches =  int(line[11:].split('/')[0]) #int() does not mind leading spaces
-
-                try:
-                    metric = TRANSFORMATIONS[tranformation](identity)
-                except ValueError or TypeError:
-                    raise TypeError("Failed to interpret the metric column value %r. Please ensure that the edge list file is correctly formatted and that the correct column is specified." % (identity))
-                
-                if this_qry == this_lib:
-                    continue
-                if metric > threshold:
-                    continue
-                # NOTE this case should raise an error - graph was constructed from same file before, and so all the nodes should be there.
-                if not full_graph.has_node(this_qry) or not full_graph.has_node(this_lib):
-                    raise RuntimeError(f'Tried to insert edge {this_qry}-{this_lib} into the graph, but did not find nodes. This should not happen, please report a bug.')
-                if full_graph.has_edge(this_qry, this_lib):
-                    if full_graph[this_qry][this_lib]['metric'] > metric:
-                        nx.set_edge_attributes(full_graph,{(this_qry,this_lib):metric}, 'metric')
-                        
-                else:
-                    full_graph.add_edge(this_qry, this_lib, metric=metric)
-
-    remove('graphpart_0.fasta.tmp')
+            stdout=subprocess.PIPE) as proc:
+        for this_qry, this_lib, identity in parse_needle_output(proc.stdout, denominator, seq_lens):
+            try:
+                metric = TRANSFORMATIONS[tranformation](identity)
+            except ValueError or TypeError:
+                raise TypeError("Failed to interpret the metric column value %r. Please ensure that the edge list file is correctly formatted and that the correct column is specified." % (identity))
+
+            if this_qry == this_lib:
+                continue
+            if metric > threshold:
+                continue
+            qrys.append(this_qry)
+            libs.append(this_lib)
+            metrics.append(metric)
+
+            if len(metrics) >= BATCH_SIZE:
+                add_named_edges(graph, qrys, libs, metrics)
+                qrys, libs, metrics = [], [], []
+
+    add_named_edges(graph, qrys, libs, metrics)
+    remove(fasta_file)
+    if own_tmp_dir:
+        shutil.rmtree(tmp_dir)
 
 from multiprocessing import Manager
 
@@ -211,95 +303,48 @@ def compute_edges(query_fp: str,
                   endopen: float = 10,
                   endextend: float = 0.5,
                   matrix: str = 'EBLOSUM62',
-                  ) -> Tuple[int, List[Tuple[str,str,float]]]:
+                  ) -> Tuple[int, Tuple[List[str], List[str], List[float]], float]:
     '''
     Run needleall on query_fp and library_fp,
     Retrieve pairwise similiarities, transform and
-    insert into edge_dict.
+    return the query, library and metric of each edge as columns,
+    as well as the wall time of the alignment.
     '''
-    identity_list = []
+    start_time = time.perf_counter()
+    qrys, libs, metrics = [], [], []
 
-    if is_nucleotide:
-        type_1, type_2, = '-snucleotide1', '-snucleotide2'
-    else:
-        type_1, type_2 = '-sprotein1', '-sprotein2'
-
-    command = ["needleall","-auto","-stdout", 
-               "-aformat", "pair", 
-               "-gapopen", str(gapopen),
-               "-gapextend", str(gapextend),
-               "-endopen", str(endopen),
-               "-endextend", str(endextend),
-               "-datafile", matrix,
-               type_1, type_2, query_fp, library_fp]
-    if endweight:
-        command = command + ["-endweight"]
+    command = needle_command(query_fp, library_fp, is_nucleotide, gapopen, gapextend, endweight, endopen, endextend, matrix)
 
     count = 0
     import subprocess
     with subprocess.Popen(
             command,
-            stdout=subprocess.PIPE,
-            bufsize=1,
-            universal_newlines=True) as proc:
-        for line_nr, line in enumerate(proc.stdout):  
-            if  line.startswith('# 1:'):
-
-                # # 1: P0CV73
-                this_qry = line[5:].split()[0].split('|')[0]
-
-            elif line.startswith('# 2:'):
-                this_lib = line[5:].split()[0].split('|')[0]
-
-            elif line.startswith('# Identity:'):
-                identity_line = line
-
-            #TODO gaps is only reported after the identity...
-            elif line.startswith('# Gaps:'):
-                count +=1
+            stdout=subprocess.PIPE) as proc:
+        for this_qry, this_lib, identity in parse_needle_output(proc.stdout, denominator, seq_lens):
+            count +=1
 
+            try:
+                metric = TRANSFORMATIONS[transformation](identity)
+            except ValueError or TypeError:
+                raise TypeError("Failed to interpret the identity value %r. Please ensure that the ggsearch36 output is correctly formatted." % (identity))
 
-                # Gaps:           0/142 ( 0.0%)
-                gaps, rest = line[7:].split('/')
-                gaps = int(gaps)
-                length = int(rest.split('(')[0])
+            if this_qry == this_lib:
+                continue
+            if metric > threshold:
+                continue
 
-                
-                # Compute different sequence identities as needed.
+            qrys.append(this_qry)
+            libs.append(this_lib)
+            metrics.append(metric)
 
-                if denominator == 'full': # full is returned by default. just need to parse
-                    identity = float(identity_line.split('(')[1][:-3])/100
-                elif denominator == 'no_gaps':
-                    n_matches =  int(identity_line[11:].split('/')[0]) #int() does not mind leading spaces
-                    identity = float(n_matches/(length-gaps))
-                else:
-                    n_matches =  int(identity_line[11:].split('/')[0]) #int() does not mind leading spaces
-                    identity = NORMALIZATIONS[denominator](n_matches, seq_lens[this_qry], seq_lens[this_lib])
-                #line = "# Identity:      14/443 ( 3.2%)"
-                # n_matches =  int(line[11:].split('/')[0]) #int() does not mind leading spaces
-                
-                try:
-                    metric = TRANSFORMATIONS[transformation](identity)
-                except ValueError or TypeError:
-                    raise TypeError("Failed to interpret the identity value %r. Please ensure that the ggsearch36 output is correctly formatted." % (identity))
-                
-                if this_qry == this_lib:
-                    continue
-                if metric > threshold:
-                    continue
-                
-                identity_list.append((this_qry, this_lib, metric))
-                # NOTE this case should raise an error - graph was constructed from same file before, and so all the nodes should be there.
- 
-
-    return (count, identity_list)
+    return (count, (qrys, libs, metrics), time.perf_counter() - start_time)
 
 def generate_edges_mp(entity_fp: str, 
-                  full_graph: nx.classes.graph.Graph, 
+                  graph: EntityGraph,
                   transformation: str,
                   threshold: float,
                   denominator: str = 'full',
-                  n_chunks: int = 10,
+                  n_chunks: int = None,
                   n_procs: int = 4,
                   parallel_mode: str = 'multithread',
                   triangular: bool = False,
@@ -311,87 +356,486 @@ def generate_edges_mp(entity_fp: str,
                   endopen: float = 10,
                   endextend: float = 0.5,
                   matrix: str = 'EBLOSUM62',
+                  max_in_flight: int = None,
+                  run_dir: str = None,
+                  resume: bool = False,
+                  distributed: bool = False,
+                  tmp_dir: str = None,
+                  json_dict: Dict[str, Any] = None,
                   ) -> None:
     '''
     Call needleall to compute all pairwise sequence identities in the dataset.
     Uses chunked fasta files and multiple threads with needelall subprocesses 
     to speed up computation.
+    Chunks are balanced by summed sequence length, and their number is derived
+    from n_procs if not given. Tiles (pairs of chunks) are submitted from the most
+    to the least expensive, idle workers pick up the next tile in line.
+    Tiles in which the sequence lengths rule out any edge are skipped.
+    With run_dir, the edges of each finished tile are written to a shard in run_dir.
+    With resume, the chunks of the run in run_dir are reused and its finished
+    tiles are loaded instead of aligned.
+    With distributed, the tiles are put in a queue in run_dir, from which `run_worker`
+    processes on other hosts claim tiles, while this process aligns tiles with n_procs
+    and merges the shards of all tiles into the graph.
+    Without run_dir, the chunk fasta files are written to tmp_dir, by default a new
+    temporary directory.
+    The wall time of each tile is reported in json_dict['alignment_tiles'],
+    the number of skipped pairs in json_dict['pruned_pairs'].
     '''
     if shutil.which('needleall') is None:
         print('EMBOSS needleall was not found. Please run `conda install -c bioconda emboss`')
         exit()
+    if distributed and run_dir is None:
+        raise ValueError('A distributed run needs a run directory.')
 
     # chunk the input
     ids, seqs = parse_fasta(entity_fp)
     seq_lens = get_len_dict(ids, seqs)
 
-    n_chunks = chunk_fasta_file(ids, seqs, n_chunks) #get the actual number of generated chunks.
+    if n_chunks is None:
+        n_chunks = auto_n_chunks(n_procs, triangular)
+        if can_prune(denominator, transformation):
+            n_chunks = max(n_chunks, PRUNE_CHUNKS)
+    lens = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    def plan():
+        chunks = cost_balanced_chunks(lens, n_chunks)
+        tiles = make_tiles(chunks, lens, triangular)
+        # tiles whose sequence lengths rule out any edge are not aligned.
+        tiles, n_pruned = prune_tiles(tiles, chunks, lens, denominator, transformation, threshold)
+        return chunks, tiles, n_pruned
+
+    own_tmp_dir = tmp_dir is None and run_dir is None
+    if own_tmp_dir:
+        tmp_dir = make_tmp_dir()
+
+    if run_dir is None:
+        chunks, tiles, n_pruned = plan()
+        files = write_fasta_chunks(ids, seqs, chunks, tmp_dir)
+        done = set()
+    else:
+        params = {'aligner': 'needleall', 'transformation': transformation, 'threshold': threshold, 'denominator': denominator, 'triangular': triangular,
+                  'nucleotide': is_nucleotide, 'gapopen': gapopen, 'gapextend': gapextend, 'endweight': endweight, 'endopen': endopen, 'endextend': endextend, 'matrix': matrix}
+        chunks, tiles, n_pruned = open_run_dir(run_dir, entity_fp, params, plan, resume)
+        files = write_chunk_fastas(run_dir, ids, seqs, chunks)
+        done = finished_tiles(run_dir, tiles)
+        # repeated accessions are one node of the graph, any of their positions maps to it.
+        names = [id.lstrip('>') for id in ids]
+        index = {name: i for i, name in enumerate(names)}
+        node_ids = graph.node_ids(names)
+        if (node_ids < 0).any():
+            raise RuntimeError(f'Sequence {names[np.flatnonzero(node_ids < 0)[0]]} was not found in the graph. This should not happen, please report a bug.')
+
+    n_alignments = sum(len(chunks[i]) * len(chunks[j]) for i, j, _ in tiles)
 
-    # start n_procs threads, each thread starts a subprocess
-    # Because of threading's GIL we can write edges directly to the full_graph object.
-    jobs = []
+    if parallel_mode == 'multithread':
+        executor_cls = concurrent.futures.ThreadPoolExecutor
+    elif parallel_mode == 'multiprocess':
+        executor_cls = concurrent.futures.ProcessPoolExecutor
 
-    # this is approximate, but good enough for progress bar drawing.
-    if triangular:
-        n_alignments = 0
-        chunk_size = math.ceil(len(ids)/n_chunks)
-        for i in range(n_chunks):
-            for j in range(i, n_chunks):
-                n_alignments += chunk_size*chunk_size
+    if max_in_flight is None:
+        max_in_flight = 2 * n_procs
+
+    tile_times = []
+    with executor_cls(max_workers=n_procs) as executor:
+        def submit(tile):
+            q, l = files[tile[0]], files[tile[1]]
+            return executor.submit(compute_edges, q, l, transformation, threshold, seq_lens, denominator, delimiter, is_nucleotide, gapopen, gapextend, endweight, endopen, endextend, matrix)
+
+        pbar = tqdm(total=n_alignments)
+        merged = set()
+        def merge_shards():
+            for tile in finished_tiles(run_dir, [tile for tile in tiles if tile not in merged]):
+                src, dst, metrics, count, seconds = read_shard(run_dir, tile)
+                graph.add_edges(node_ids[src], node_ids[dst], metrics)
+                tile_times.append(tile_report(chunks, tile, seconds))
+                pbar.update(count)
+                merged.add(tile)
+
+        # tiles of the resumed run are loaded from their shards.
+        if run_dir is not None:
+            merge_shards()
+
+        def align(jobs):
+            for tile, job in jobs:
+                if job.exception() is not None:
+                    print(job.exception())
+                    # TODO we don't yet know how to recover correctly. It just should not happen in general.
+                    raise RuntimeError('One of the alignment processes did not complete sucessfully.')
+                else:
+                    count, (qrys, libs, metrics), seconds = job.result()
+
+                    # while we wait on more jobs to finish, we can add results as they come in.
+                    if run_dir is None:
+                        add_named_edges(graph, qrys, libs, metrics)
+                    else:
+                        src = np.fromiter((index[qry] for qry in qrys), dtype=np.int64, count=len(qrys))
+                        dst = np.fromiter((index[lib] for lib in libs), dtype=np.int64, count=len(libs))
+                        write_shard(run_dir, tile, src, dst, metrics, count, seconds)
+                        graph.add_edges(node_ids[src], node_ids[dst], metrics)
+                        merged.add(tile)
+                    tile_times.append(tile_report(chunks, tile, seconds))
+                    pbar.update(count)
+                if distributed:
+                    merge_shards()
+
+        if distributed:
+            # workers on other hosts claim tiles from the same queue.
+            queue_tiles(run_dir, tiles, done)
+            # only claim as many tiles as can run here, leaving the others to the workers.
+            align(claim_tiles(run_dir, submit, tiles, n_procs))
+            if len(merged) < len(tiles):
+                print(f'Waiting for workers to finish {len(tiles) - len(merged)} chunk pairs.')
+            last_progress = time.time()
+            while len(merged) < len(tiles):
+                time.sleep(POLL_SECONDS)
+                n_merged = len(merged)
+                merge_shards()
+                # the tiles of workers that died are queued again once their claims expire, and aligned here.
+                align(claim_tiles(run_dir, submit, tiles, n_procs))
+                if len(merged) > n_merged or n_claimed(run_dir) > 0:
+                    last_progress = time.time()
+                elif time.time() - last_progress > LEASE_SECONDS:
+                    missing = [tile[:2] for tile in tiles if tile not in merged]
+                    raise RuntimeError(f'The chunk pairs {missing} of the run in {run_dir} are neither queued nor claimed by a worker, '
+                                       'but their edges were not written. Restart the run with --resume.')
+            finish_queue(run_dir)
+        else:
+            align(run_tiles(submit, [tile for tile in tiles if tile not in done], max_in_flight))
+        pbar.close()
+
+    if json_dict is not None:
+        json_dict['alignment_tiles'] = tile_times
+        json_dict['pruned_pairs'] = n_pruned
+        if run_dir is not None:
+            json_dict['resumed_tiles'] = len(done)
+
+    #delete the chunks
+    if run_dir is None:
+        for file in files:
+            remove(file)
     else:
-        n_alignments = len(ids)*len(ids)
+        remove_chunk_fastas(run_dir, len(chunks))
+    if own_tmp_dir:
+        shutil.rmtree(tmp_dir)
+
 
-    # define in which interval each thread updates the progress bar.
-    # if all update all the time, this would slow down the loop and make runtimes estimate unstable.
-    # update every 1000 OR update every 0.05% of the total, divided by number of procs. 
-    # this worked well on large datasets with 64 threads - fewer threads should then be unproblematic.
-    pbar_update_interval = int((n_alignments * 0.0005)/n_procs) 
-    pbar_update_interval = min(1000, pbar_update_interval)
+def run_worker(run_dir: str, n_procs: int = 1, parallel_mode: str = 'multithread') -> int:
+    '''
+    Align tiles of the distributed run in run_dir, as started by generate_edges_mp
+    with distributed. Waits until the run has queued its tiles, then claims and aligns
+    tiles with n_procs until the queue is empty, writing a shard for each.
+    Any number of workers can run on hosts that share run_dir.
+    Returns the number of aligned tiles.
+    '''
+    if shutil.which('needleall') is None:
+        print('EMBOSS needleall was not found. Please run `conda install -c bioconda emboss`')
+        exit()
 
-    #pbar = tqdm(total= n_alignments)
+    print(f'Waiting for the run in {run_dir}.')
+    if not wait_for_queue(run_dir):
+        print('The run is finished already.')
+        return 0
+    params = read_manifest(run_dir)['params']
+    chunks = read_chunks(run_dir)
+    tiles = [tuple(tile) for tile in read_manifest(run_dir)['tiles']]
+
+    # shards hold positions in the input file, the chunk files list them in chunk order.
+    files = [chunk_fasta_path(run_dir, i) for i in range(len(chunks))]
+    index, seq_lens = {}, {}
+    for file, chunk in zip(files, chunks):
+        ids, seqs = parse_fasta(file)
+        seq_lens.update(get_len_dict(ids, seqs))
+        index.update(zip((id.lstrip('>') for id in ids), chunk.tolist()))
 
     if parallel_mode == 'multithread':
         executor_cls = concurrent.futures.ThreadPoolExecutor
     elif parallel_mode == 'multiprocess':
         executor_cls = concurrent.futures.ProcessPoolExecutor
 
+    n_tiles = 0
     with executor_cls(max_workers=n_procs) as executor:
-        for i in range(n_chunks):
-            start = i if triangular else 0
-            for j in range(start, n_chunks):
-                q = f'graphpart_{i}.fasta.tmp'
-                l = f'graphpart_{j}.fasta.tmp'
-                future = executor.submit(compute_edges, q, l, transformation, threshold, seq_lens, denominator, delimiter, is_nucleotide, gapopen, gapextend, endweight, endopen, endextend, matrix)
-                jobs.append(future)
+        def submit(tile):
+            q, l = files[tile[0]], files[tile[1]]
+            return executor.submit(compute_edges, q, l, params['transformation'], params['threshold'], seq_lens, params['denominator'], '|', params['nucleotide'],
+                                   params['gapopen'], params['gapextend'], params['endweight'], params['endopen'], params['endextend'], params['matrix'])
 
+        for tile, job in claim_tiles(run_dir, submit, tiles, n_procs):
+            count, (qrys, libs, metrics), seconds = job.result()
+            src = np.fromiter((index[qry] for qry in qrys), dtype=np.int64, count=len(qrys))
+            dst = np.fromiter((index[lib] for lib in libs), dtype=np.int64, count=len(libs))
+            write_shard(run_dir, tile, src, dst, metrics, count, seconds)
+            n_tiles += 1
+            print(f'Aligned chunk pair {tile[0]}-{tile[1]} in {seconds:0.2f} seconds.')
 
+    print(f'The queue is empty. Aligned {n_tiles} chunk pairs.')
+    return n_tiles
 
-        pbar = tqdm(total=n_alignments)
-        for job in jobs:
+
+def generate_edges_prefiltered(entity_fp: str,
+                  graph: EntityGraph,
+                  transformation: str,
+                  threshold: float,
+                  denominator: str = 'full',
+                  kmer_size: int = None,
+                  min_shared_kmers: int = None,
+                  n_procs: int = 1,
+                  parallel_mode: str = 'multithread',
+                  triangular: bool = False,
+                  delimiter: str = '|',
+                  is_nucleotide: bool = False,
+                  gapopen: float = 10,
+                  gapextend: float = 0.5,
+                  endweight: bool = False,
+                  endopen: float = 10,
+                  endextend: float = 0.5,
+                  matrix: str = 'EBLOSUM62',
+                  max_in_flight: int = None,
+                  tmp_dir: str = None,
+                  json_dict: Dict[str, Any] = None,
+                  ) -> None:
+    '''
+    Call needleall only on the pairs of sequences that share at least min_shared_kmers
+    distinct k-mers of size kmer_size (defaults in kmer_utils.DEFAULT_K and DEFAULT_MIN_SHARED).
+    Each sequence is aligned to its candidates in one needleall call, the query
+    and its candidates are written to their own fasta files right before the call.
+    Without triangular, each pair is aligned in both orientations as in the other modes.
+    The fasta files are written to tmp_dir, by default a new temporary directory.
+    The numbers of candidate and total pairs are reported in json_dict['prefilter'].
+    '''
+    if shutil.which('needleall') is None:
+        print('EMBOSS needleall was not found. Please run `conda install -c bioconda emboss`')
+        exit()
+    own_tmp_dir = tmp_dir is None
+    if own_tmp_dir:
+        tmp_dir = make_tmp_dir()
+
+    ids, seqs = parse_fasta(entity_fp)
+    seq_lens = get_len_dict(ids, seqs)
+    lens = np.array([len(seq) for seq in seqs], dtype=np.int64)
+
+    kmer_size, min_shared_kmers = prefilter_params(kmer_size, min_shared_kmers, is_nucleotide)
+    qrys, libs, _ = candidate_pairs(seqs, kmer_size, min_shared_kmers)
+    n_candidates = len(qrys)
+    prefilter_counts = prefilter_report(kmer_size, min_shared_kmers, n_candidates, len(seqs))
+    # candidates whose lengths rule out an edge are not aligned either.
+    keep = ~pruned_pairs(lens[qrys], lens[libs], denominator, transformation, threshold)
+    qrys, libs = qrys[keep], libs[keep]
+    if not triangular:
+        qrys, libs = np.concatenate([qrys, libs]), np.concatenate([libs, qrys])
+
+    # group the candidates by query.
+    order = np.lexsort((libs, qrys))
+    qrys, libs = qrys[order], libs[order]
+    queries, first = np.unique(qrys, return_index=True)
+    candidates = np.split(libs, first[1:]) if len(queries) > 0 else []
+    tasks = sorted(((int(q), i, int(lens[q]) * int(lens[c].sum())) for i, (q, c) in enumerate(zip(queries, candidates))), key=lambda x: -x[2])
+
+    if parallel_mode == 'multithread':
+        executor_cls = concurrent.futures.ThreadPoolExecutor
+    elif parallel_mode == 'multiprocess':
+        executor_cls = concurrent.futures.ProcessPoolExecutor
+
+    if max_in_flight is None:
+        max_in_flight = 2 * n_procs
+
+    with executor_cls(max_workers=n_procs) as executor:
+        def submit(task):
+            q, i, _ = task
+            q_file, l_file = os.path.join(tmp_dir, f'graphpart_q{q}.fasta'), os.path.join(tmp_dir, f'graphpart_q{q}_candidates.fasta')
+            with open(q_file, 'w') as f:
+                f.write(ids[q]+'\n')
+                f.write(seqs[q]+'\n')
+            with open(l_file, 'w') as f:
+                for idx in candidates[i].tolist():
+                    f.write(ids[idx]+'\n')
+                    f.write(seqs[idx]+'\n')
+            return executor.submit(compute_edges, q_file, l_file, transformation, threshold, seq_lens, denominator, delimiter, is_nucleotide, gapopen, gapextend, endweight, endopen, endextend, matrix)
+
+        pbar = tqdm(total=len(qrys))
+        for task, job in run_tiles(submit, tasks, max_in_flight):
+            remove(os.path.join(tmp_dir, f'graphpart_q{task[0]}.fasta'))
+            remove(os.path.join(tmp_dir, f'graphpart_q{task[0]}_candidates.fasta'))
             if job.exception() is not None:
                 print(job.exception())
-                # TODO we don't yet know how to recover correctly. It just should not happen in general.
                 raise RuntimeError('One of the alignment processes did not complete sucessfully.')
-            else:
-                count, chunk_identities = job.result()
+            count, (qry_acs, lib_acs, metrics), seconds = job.result()
+            add_named_edges(graph, qry_acs, lib_acs, metrics)
+            pbar.update(count)
+        pbar.close()
 
-                # while we wait on more jobs to finish, we can parse results as they come in.
-                for this_qry, this_lib, metric in chunk_identities:
+    if own_tmp_dir:
+        shutil.rmtree(tmp_dir)
+    if json_dict is not None:
+        json_dict['prefilter'] = prefilter_counts
+        json_dict['pruned_pairs'] = int(n_candidates - np.count_nonzero(keep))
 
-                    if not full_graph.has_node(this_qry) or not full_graph.has_node(this_lib):
-                        raise RuntimeError(f'Tried to insert edge {this_qry}-{this_lib} into the graph, but did not find nodes. This should not happen, please report a bug.')
-                    if full_graph.has_edge(this_qry, this_lib):
-                        if full_graph[this_qry][this_lib]['metric'] > metric:
-                            full_graph.add_edge(this_qry, this_lib, metric=metric) #Notes: Adding an edge that already exists updates the edge data. 
-                            
-                            # this seems to be slow:
-                            #nx.set_edge_attributes(full_graph,{(this_qry,this_lib):metric}, 'metric')
 
-                    else:
-                        full_graph.add_edge(this_qry, this_lib, metric=metric) 
-                
-                pbar.update(count)
+def compute_pair_identities(query_fp: str,
+                  library_fp: str,
+                  qry_names: List[str],
+                  lib_names: List[str],
+                  seq_lens: Dict[str,int],
+                  denominator = 'full',
+                  is_nucleotide: bool = False,
+                  gapopen: float = 10,
+                  gapextend: float = 0.5,
+                  endweight: bool = False,
+                  endopen: float = 10,
+                  endextend: float = 0.5,
+                  matrix: str = 'EBLOSUM62',
+                  ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, float]:
+    '''
+    Run needleall on query_fp and library_fp and return the identities of all
+    aligned pairs, not only those within the threshold. Pairs are given as the
+    positions of their query in qry_names and of their library in lib_names.
+    Also returns the wall time of the alignment.
+    '''
+    start_time = time.perf_counter()
+    qry_pos = {name: i for i, name in enumerate(qry_names)}
+    lib_pos = {name: i for i, name in enumerate(lib_names)}
+    command = needle_command(query_fp, library_fp, is_nucleotide, gapopen, gapextend, endweight, endopen, endextend, matrix)
 
-    #delete the chunks
-    for i in range(n_chunks):
-        remove(f'graphpart_{i}.fasta.tmp')
\ No newline at end of file
+    qrys, libs, identities = [], [], []
+    import subprocess
+    with subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE) as proc:
+        for this_qry, this_lib, identity in parse_needle_output(proc.stdout, denominator, seq_lens):
+            qrys.append(qry_pos[this_qry])
+            libs.append(lib_pos[this_lib])
+            identities.append(identity)
+
+    return np.array(qrys, dtype=np.int64), np.array(libs, dtype=np.int64), np.array(identities, dtype=np.float64), time.perf_counter() - start_time
+
+
+def generate_edges_cached(entity_fp: str,
+                  graph: EntityGraph,
+                  transformation: str,
+                  threshold: float,
+                  cache_dir: str,
+                  cache_size: float = DEFAULT_CACHE_SIZE,
+                  denominator: str = 'full',
+                  n_chunks: int = None,
+                  n_procs: int = 1,
+                  parallel_mode: str = 'multithread',
+                  triangular: bool = False,
+                  prefilter: bool = False,
+                  kmer_size: int = None,
+                  min_shared_kmers: int = None,
+                  delimiter: str = '|',
+                  is_nucleotide: bool = False,
+                  gapopen: float = 10,
+                  gapextend: float = 0.5,
+                  endweight: bool = False,
+                  endopen: float = 10,
+                  endextend: float = 0.5,
+                  matrix: str = 'EBLOSUM62',
+                  max_in_flight: int = None,
+                  tmp_dir: str = None,
+                  json_dict: Dict[str, Any] = None,
+                  ) -> None:
+    '''
+    Compute all pairwise sequence identities with needleall, reusing the results
+    of earlier runs from the alignment cache in cache_dir.
+    The pairs are tiled as in generate_edges_mp. The pairs of each tile that are
+    in the cache are added to the graph right away, the missing ones are aligned
+    in rectangles of queries that miss the same libraries, so that unchanged pairs
+    are not aligned again. The identities of all aligned pairs are added to the cache.
+    With prefilter, only the pairs that share k-mers are needed, as in generate_edges_prefiltered.
+    The fasta files are written to tmp_dir, by default a new temporary directory.
+    The numbers of cached and aligned pairs are reported in json_dict['cache'].
+    '''
+    if shutil.which('needleall') is None:
+        print('EMBOSS needleall was not found. Please run `conda install -c bioconda emboss`')
+        exit()
+    ids, seqs = parse_fasta(entity_fp)
+    names = [id.lstrip('>') for id in ids]
+    seq_lens = get_len_dict(ids, seqs)
+    lens = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    node_ids = graph.node_ids(names)
+    if (node_ids < 0).any():
+        raise RuntimeError(f'Sequence {names[np.flatnonzero(node_ids < 0)[0]]} was not found in the graph. This should not happen, please report a bug.')
+    # needleall reports pairs by accession, the identities of repeated accessions could be cached for the wrong sequence.
+    if len(set(names)) < len(names):
+        repeated = next(name for name, count in Counter(names).items() if count > 1)
+        raise ValueError(f'Accession {repeated} occurs more than once in {entity_fp}. The alignment cache needs unique accessions.')
+
+    own_tmp_dir = tmp_dir is None
+    if own_tmp_dir:
+        tmp_dir = make_tmp_dir()
+
+    hashes = sequence_hashes(seqs)
+    cache = AlignmentCache(cache_dir, {'aligner': 'needleall', 'denominator': denominator, 'nucleotide': is_nucleotide, 'gapopen': gapopen, 'gapextend': gapextend,
+                                       'endweight': endweight, 'endopen': endopen, 'endextend': endextend, 'matrix': matrix}, cache_size)
+    cache.touch(hashes)
+
+    if n_chunks is None:
+        n_chunks = auto_n_chunks(n_procs, triangular)
+        if can_prune(denominator, transformation):
+            n_chunks = max(n_chunks, PRUNE_CHUNKS)
+    chunks = cost_balanced_chunks(lens, n_chunks)
+    tiles, n_pruned = prune_tiles(make_tiles(chunks, lens, triangular), chunks, lens, denominator, transformation, threshold)
+
+    needed = None
+    if prefilter:
+        kmer_size, min_shared_kmers = prefilter_params(kmer_size, min_shared_kmers, is_nucleotide)
+        qrys, libs, _ = candidate_pairs(seqs, kmer_size, min_shared_kmers)
+        if json_dict is not None:
+            json_dict['prefilter'] = prefilter_report(kmer_size, min_shared_kmers, len(qrys), len(seqs))
+        n = len(seqs)
+        candidates = np.sort(np.concatenate([qrys * n + libs, libs * n + qrys]))
+        def needed(qrys: np.ndarray, libs: np.ndarray) -> np.ndarray:
+            keys = qrys[:, None] * n + libs[None, :]
+            if len(candidates) == 0:
+                return np.zeros(keys.shape, dtype=bool)
+            return candidates[np.minimum(np.searchsorted(candidates, keys), len(candidates) - 1)] == keys
+
+    def add_identities(qrys: np.ndarray, libs: np.ndarray, identities: np.ndarray) -> None:
+        metric = ARRAY_TRANSFORMATIONS[transformation](identities)
+        keep = ~(metric > threshold) & ~np.isnan(identities)
+        graph.add_edges(node_ids[qrys[keep]], node_ids[libs[keep]], metric[keep])
+
+    print('Looking up alignments in the cache.')
+    rectangles, n_cached, n_missing = split_cached_pairs(cache, hashes, [(chunks[i], chunks[j]) for i, j, _ in tiles], add_identities, needed)
+    tasks = sorted(((i, 0, int(lens[qrys].sum()) * int(lens[libs].sum())) for i, (qrys, libs) in enumerate(rectangles)), key=lambda x: -x[2])
+
+    if parallel_mode == 'multithread':
+        executor_cls = concurrent.futures.ThreadPoolExecutor
+    elif parallel_mode == 'multiprocess':
+        executor_cls = concurrent.futures.ProcessPoolExecutor
+
+    if max_in_flight is None:
+        max_in_flight = 2 * n_procs
+
+    with executor_cls(max_workers=n_procs) as executor:
+        def submit(task):
+            qrys, libs = rectangles[task[0]]
+            q_file, l_file = os.path.join(tmp_dir, f'graphpart_r{task[0]}.fasta'), os.path.join(tmp_dir, f'graphpart_r{task[0]}_lib.fasta')
+            for file, idx in ((q_file, qrys), (l_file, libs)):
+                with open(file, 'w') as f:
+                    for i in idx.tolist():
+                        f.write(ids[i]+'\n')
+                        f.write(seqs[i]+'\n')
+            return executor.submit(compute_pair_identities, q_file, l_file, [names[i] for i in qrys.tolist()], [names[i] for i in libs.tolist()], seq_lens,
+                                   denominator, is_nucleotide, gapopen, gapextend, endweight, endopen, endextend, matrix)
+
+        pbar = tqdm(total=n_missing)
+        for task, job in run_tiles(submit, tasks, max_in_flight):
+            remove(os.path.join(tmp_dir, f'graphpart_r{task[0]}.fasta'))
+            remove(os.path.join(tmp_dir, f'graphpart_r{task[0]}_lib.fasta'))
+            if job.exception() is not None:
+                print(job.exception())
+                raise RuntimeError('One of the alignment processes did not complete sucessfully.')
+            qry_pos, lib_pos, identities, seconds = job.result()
+            qrys, libs = rectangles[task[0]][0][qry_pos], rectangles[task[0]][1][lib_pos]
+            cache.store(hashes[qrys], hashes[libs], identities)
+            add_identities(qrys, libs, identities)
+            pbar.update(len(identities))
+        pbar.close()
+
+    cache.close()
+    if own_tmp_dir:
+        shutil.rmtree(tmp_dir)
+    if json_dict is not None:
+        json_dict['cache'] = {'cached_pairs': n_cached, 'aligned_pairs': n_missing}
+        json_dict['pruned_pairs'] = n_pruned
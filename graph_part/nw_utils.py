@@ -0,0 +1,439 @@
+'''
+This file contains a NumPy implementation of global Needleman-Wunsch
+alignments that computes pairwise sequence identities without EMBOSS.
+Pairs of sequences are aligned in batches, the dynamic programming matrix
+is filled row by row for all pairs of a batch at once.
+
+The scoring follows needleall: affine gaps (a gap of length n costs
+gapopen + (n-1)*gapextend), end gaps are free unless endweight is set, in
+which case they cost endopen + (n-1)*endextend.
+
+Instead of tracing back the alignment, each cell holds a single integer key
+that packs the score, the number of identical positions and the number of gap
+columns of the best alignment ending in that cell:
+
+    key = score << SCORE_SHIFT | matches << FIELD_BITS | (FIELD - gaps)
+
+Comparing keys compares alignments by score, then by identity, then by
+fewer gaps, so ties between equally scoring alignments are resolved towards
+the highest identity. needleall picks one of the tied alignments by its
+traceback order, so in the case of ties the identities can differ slightly.
+'''
+import os
+import time
+import concurrent.futures
+from typing import Any, Dict, List, Tuple
+import numpy as np
+from tqdm.auto import tqdm
+from .transformations import ARRAY_TRANSFORMATIONS
+from .entity_graph import EntityGraph
+from .needle_utils import parse_fasta
+from .kmer_utils import candidate_pairs, prefilter_params, prefilter_report
+from .tile_utils import PRUNE_CHUNKS, TILES_PER_PROC, auto_n_chunks, can_prune, cost_balanced_chunks, make_tiles, prune_tiles, pruned_pairs, tile_report, run_tiles
+
+
+EBLOSUM62 = '''
+   A  R  N  D  C  Q  E  G  H  I  L  K  M  F  P  S  T  W  Y  V  B  Z  X  *
+A  4 -1 -2 -2  0 -1 -1  0 -2 -1 -1 -1 -1 -2 -1  1  0 -3 -2  0 -2 -1  0 -4
+R -1  5  0 -2 -3  1  0 -2  0 -3 -2  2 -1 -3 -2 -1 -1 -3 -2 -3 -1  0 -1 -4
+N -2  0  6  1 -3  0  0  0  1 -3 -3  0 -2 -3 -2  1  0 -4 -2 -3  3  0 -1 -4
+D -2 -2  1  6 -3  0  2 -1 -1 -3 -4 -1 -3 -3 -1  0 -1 -4 -3 -3  4  1 -1 -4
+C  0 -3 -3 -3  9 -3 -4 -3 -3 -1 -1 -3 -1 -2 -3 -1 -1 -2 -2 -1 -3 -3 -2 -4
+Q -1  1  0  0 -3  5  2 -2  0 -3 -2  1  0 -3 -1  0 -1 -2 -1 -2  0  3 -1 -4
+E -1  0  0  2 -4  2  5 -2  0 -3 -3  1 -2 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+G  0 -2  0 -1 -3 -2 -2  6 -2 -4 -4 -2 -3 -3 -2  0 -2 -2 -3 -3 -1 -2 -1 -4
+H -2  0  1 -1 -3  0  0 -2  8 -3 -3 -1 -2 -1 -2 -1 -2 -2  2 -3  0  0 -1 -4
+I -1 -3 -3 -3 -1 -3 -3 -4 -3  4  2 -3  1  0 -3 -2 -1 -3 -1  3 -3 -3 -1 -4
+L -1 -2 -3 -4 -1 -2 -3 -4 -3  2  4 -2  2  0 -3 -2 -1 -2 -1  1 -4 -3 -1 -4
+K -1  2  0 -1 -3  1  1 -2 -1 -3 -2  5 -1 -3 -1  0 -1 -3 -2 -2  0  1 -1 -4
+M -1 -1 -2 -3 -1  0 -2 -3 -2  1  2 -1  5  0 -2 -1 -1 -1 -1  1 -3 -1 -1 -4
+F -2 -3 -3 -3 -2 -3 -3 -3 -1  0  0 -3  0  6 -4 -2 -2  1  3 -1 -3 -3 -1 -4
+P -1 -2 -2 -1 -3 -1 -1 -2 -2 -3 -3 -1 -2 -4  7 -1 -1 -4 -3 -2 -2 -1 -2 -4
+S  1 -1  1  0 -1  0  0  0 -1 -2 -2  0 -1 -2 -1  4  1 -3 -2 -2  0  0  0 -4
+T  0 -1  0 -1 -1 -1 -1 -2 -2 -1 -1 -1 -1 -2 -1  1  5 -2 -2  0 -1 -1  0 -4
+W -3 -3 -4 -4 -2 -2 -3 -2 -2 -3 -2 -3 -1  1 -4 -3 -2 11  2 -3 -4 -3 -2 -4
+Y -2 -2 -2 -3 -2 -1 -2 -3  2 -1 -1 -2 -1  3 -3 -2 -2  2  7 -1 -3 -2 -1 -4
+V  0 -3 -3 -3 -1 -2 -2 -3 -3  3  1 -2  1 -1 -2 -2  0 -3 -1  4 -3 -2 -1 -4
+B -2 -1  3  4 -3  0  1 -1  0 -3 -4  0 -3 -3 -2  0 -1 -4 -3 -3  4  1 -1 -4
+Z -1  0  0  1 -3  3  4 -2  0 -3 -3  1 -1 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+X  0 -1 -1 -1 -2 -1 -1 -1 -1 -1 -1 -1 -1 -1 -2  0  0 -2 -1 -1 -1 -1 -1 -4
+* -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4  1
+'''
+
+EDNAFULL = '''
+    A   T   G   C   S   W   R   Y   K   M   B   V   H   D   N   U
+A   5  -4  -4  -4  -4   1   1  -4  -4   1  -4  -1  -1  -1  -2  -4
+T  -4   5  -4  -4  -4   1  -4   1   1  -4  -1  -4  -1  -1  -2   5
+G  -4  -4   5  -4   1  -4   1  -4   1  -4  -1  -1  -4  -1  -2  -4
+C  -4  -4  -4   5   1  -4  -4   1  -4   1  -1  -1  -1  -4  -2  -4
+S  -4  -4   1   1  -1  -4  -2  -2  -2  -2  -1  -1  -3  -3  -1  -4
+W   1   1  -4  -4  -4  -1  -2  -2  -2  -2  -3  -3  -1  -1  -1   1
+R   1  -4   1  -4  -2  -2  -1  -4  -2  -2  -3  -1  -3  -1  -1  -4
+Y  -4   1  -4   1  -2  -2  -4  -1  -2  -2  -1  -3  -1  -3  -1   1
+K  -4   1   1  -4  -2  -2  -2  -2  -1  -4  -1  -3  -3  -1  -1   1
+M   1  -4  -4   1  -2  -2  -2  -2  -4  -1  -3  -1  -1  -3  -1  -4
+B  -4  -1  -1  -1  -1  -3  -3  -1  -1  -3  -1  -2  -2  -2  -1  -1
+V  -1  -4  -1  -1  -1  -3  -1  -3  -3  -1  -2  -1  -2  -2  -1  -4
+H  -1  -1  -4  -1  -3  -1  -3  -1  -3  -1  -2  -2  -1  -2  -1  -1
+D  -1  -1  -1  -4  -3  -1  -1  -3  -1  -3  -2  -2  -2  -1  -1  -1
+N  -2  -2  -2  -2  -1  -1  -1  -1  -1  -1  -1  -1  -1  -1  -1  -2
+U  -4   5  -4  -4  -4   1  -4   1   1  -4  -1  -4  -1  -1  -2   5
+'''
+
+MATRICES = {'EBLOSUM62': EBLOSUM62, 'EDNAFULL': EDNAFULL}
+
+ARRAY_NORMALIZATIONS = {'shortest': lambda a,b,c: a/np.minimum(b,c), # a identity b len(seq1) c len(seq2)
+                        'longest': lambda a,b,c: a/np.maximum(b,c),
+                        'mean' : lambda a,b,c: a/((b+c)/2),
+                        }
+
+## Layout of the alignment keys.
+FIELD_BITS = 17
+FIELD = (1 << FIELD_BITS) - 1
+SCORE_SHIFT = 2 * FIELD_BITS
+MAX_SCORE = 1 << 27
+NEG = -(1 << 62)
+
+## Number of DP cells (pairs x library length) that are filled at once.
+BATCH_CELLS = 1 << 14
+
+
+def load_matrix(matrix: str) -> Tuple[List[str], np.ndarray]:
+    '''
+    Load a substitution matrix in EMBOSS format, either one of the built-in
+    matrices (EBLOSUM62, EDNAFULL) or a path to a matrix file.
+    Returns the alphabet and the scores.
+    '''
+    if matrix in MATRICES:
+        text = MATRICES[matrix]
+    elif os.path.exists(matrix):
+        with open(matrix) as f:
+            text = f.read()
+    else:
+        raise ValueError(f'Unknown substitution matrix {matrix}. Use one of {list(MATRICES.keys())} or provide a path to a matrix file.')
+
+    lines = [l.split() for l in text.splitlines() if l.strip() != '' and not l.startswith('#')]
+    alphabet = [a.upper() for a in lines[0]]
+    scores = np.array([[float(x) for x in l[1:]] for l in lines[1:]])
+    return alphabet, scores
+
+
+class Scoring():
+    '''
+    Substitution and gap keys of an alignment configuration.
+    Scores are scaled to integers, so that keys can be compared exactly.
+    '''
+    def __init__(self,
+                 matrix: str = 'EBLOSUM62',
+                 gapopen: float = 10,
+                 gapextend: float = 0.5,
+                 endweight: bool = False,
+                 endopen: float = 10,
+                 endextend: float = 0.5):
+
+        alphabet, scores = load_matrix(matrix)
+        penalties = [gapopen, gapextend, endopen, endextend] if endweight else [gapopen, gapextend]
+        if gapextend > gapopen or (endweight and endextend > endopen):
+            raise ValueError('The built-in aligner requires gap extension penalties that are not larger than the gap open penalties.')
+
+        # smallest factor that makes all scores integers.
+        values = np.concatenate([scores.ravel(), penalties])
+        for scale in [1, 2, 4, 5, 8, 10, 20, 25, 40, 50, 100, 1000]:
+            if np.allclose(values * scale, np.round(values * scale)):
+                break
+        else:
+            raise ValueError('The built-in aligner supports scores and penalties with up to three decimals.')
+        self.scale = scale
+
+        def gap_key(penalty: float) -> int:
+            # a gap column subtracts its penalty from the score and adds one gap.
+            return (int(round(penalty * scale)) << SCORE_SHIFT) + 1
+
+        self.open_key, self.ext_key = gap_key(gapopen), gap_key(gapextend)
+        if endweight:
+            self.end_open_key, self.end_ext_key = gap_key(endopen), gap_key(endextend)
+        else:
+            self.end_open_key, self.end_ext_key = gap_key(0), gap_key(0)
+        self.max_penalty = max(penalties) * scale
+        self.max_substitution = np.abs(scores).max() * scale
+
+        # substitution keys for all pairs of byte codes. Characters that are not in the
+        # matrix are scored as X (proteins) or N (nucleotides), identity is case insensitive.
+        unknown = alphabet.index('X') if 'X' in alphabet else alphabet.index('N')
+        codes = [chr(c).upper() for c in range(256)]
+        index = np.array([alphabet.index(c) if c in alphabet else unknown for c in codes])
+        upper = np.array([ord(c) if len(c) == 1 else 0 for c in codes])
+        sub = np.round(scores * scale).astype(np.int64)[index[:, None], index[None, :]]
+        identical = upper[:, None] == upper[None, :]
+        self.sub_keys = ((sub << SCORE_SHIFT) + (identical.astype(np.int64) << FIELD_BITS)).ravel()
+
+
+def align_batch(qry: np.ndarray, lib: np.ndarray, qry_lens: np.ndarray, lib_lens: np.ndarray, scoring: Scoring) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Globally align a batch of sequence pairs.
+    qry and lib are padded byte code matrices (pairs x length), the lengths
+    need to be at least 1.
+    Returns the number of identical positions and gap columns of each alignment.
+    '''
+    n_pairs, lib_width = lib.shape
+    if qry.shape[1] + lib_width > FIELD:
+        raise ValueError(f'The built-in aligner supports sequence pairs with up to {FIELD} residues.')
+    score_bound = scoring.max_substitution * min(qry.shape[1], lib_width) + 2 * scoring.max_penalty * (qry.shape[1] + lib_width + 1)
+    if score_bound >= MAX_SCORE:
+        raise ValueError('The sequences are too long for the built-in aligner with the chosen scoring.')
+
+    ## DP rows are stored as (column, pair), so that all operations and the
+    ## running maximum along a row are vectorized over the pairs.
+    pairs = np.arange(n_pairs)
+    cols = np.arange(lib_width + 1, dtype=np.int64)[:, None]
+    lib_codes = np.ascontiguousarray(lib.T, dtype=np.int64)
+    qry_codes = np.ascontiguousarray(qry.T, dtype=np.int64) * 256
+    sub_keys = scoring.sub_keys
+
+    # vertical gaps in the first and in the last column of each pair are end gaps.
+    v_open = np.full((lib_width + 1, n_pairs), scoring.open_key, dtype=np.int64)
+    v_ext = np.full((lib_width + 1, n_pairs), scoring.ext_key, dtype=np.int64)
+    v_open[0] = v_open[lib_lens, pairs] = scoring.end_open_key
+    v_ext[0] = v_ext[lib_lens, pairs] = scoring.end_ext_key
+
+    # horizontal gaps: X[j] = max_k<j (Hp[k] + k*ext) - open - (j-1)*ext.
+    # Opening a gap right after a gap in the same direction never scores better as long as
+    # the extension penalty is not larger than the open penalty, so Hp excludes X.
+    ramp = cols * scoring.ext_key
+    open_ramp = scoring.open_key + cols[:-1] * scoring.ext_key
+    end_ramp = cols * scoring.end_ext_key
+
+    # first row: leading end gaps in the query.
+    H = np.empty((lib_width + 1, n_pairs), dtype=np.int64)
+    H[:] = FIELD - scoring.end_open_key - (cols - 1) * scoring.end_ext_key
+    H[0] = FIELD
+    Y = np.full((lib_width + 1, n_pairs), NEG, dtype=np.int64)
+    Hp = np.empty_like(H)
+    X = np.empty_like(H)
+    sub = np.empty((lib_width, n_pairs), dtype=np.int64)
+    result = np.empty(n_pairs, dtype=np.int64)
+
+    for i in range(1, qry.shape[1] + 1):
+        np.add(lib_codes, qry_codes[i-1], out=sub)
+        np.take(sub_keys, sub, out=sub)
+        np.add(H[:-1], sub, out=sub)
+
+        np.subtract(H, v_open, out=X)
+        np.subtract(Y, v_ext, out=Y)
+        np.maximum(X, Y, out=Y)
+        Hp[0] = Y[0]
+        np.maximum(Y[1:], sub, out=Hp[1:])
+
+        np.add(Hp, ramp, out=X)
+        np.maximum.accumulate(X, axis=0, out=X)
+        np.subtract(X[:-1], open_ramp, out=X[:-1])
+        H[0] = Hp[0]
+        np.maximum(Hp[1:], X[:-1], out=H[1:])
+
+        # in the last row of a pair, horizontal gaps are end gaps.
+        done = np.flatnonzero(qry_lens == i)
+        if len(done) > 0:
+            done_lens = lib_lens[done]
+            end_gap = Hp[:, done] + end_ramp
+            end_gap[cols >= done_lens[None, :]] = NEG
+            end_gap = end_gap.max(axis=0) - scoring.end_open_key - (done_lens - 1) * scoring.end_ext_key
+            result[done] = np.maximum(Hp[done_lens, done], end_gap)
+
+    matches = (result >> FIELD_BITS) & FIELD
+    gaps = FIELD - (result & FIELD)
+    return matches, gaps
+
+
+def compute_identities(matches: np.ndarray, gaps: np.ndarray, qry_lens: np.ndarray, lib_lens: np.ndarray, denominator: str) -> np.ndarray:
+    '''Sequence identities of aligned pairs, computed the same way as from needleall output.'''
+    length = (qry_lens + lib_lens + gaps) // 2
+    if denominator == 'full':
+        # needleall reports the identity in percent with one decimal.
+        return np.array([float('%.1f' % x) for x in (100 * matches / length).tolist()]) / 100
+    elif denominator == 'no_gaps':
+        aligned = length - gaps
+        return np.divide(matches, aligned, out=np.zeros(len(matches)), where=aligned > 0)
+    else:
+        return ARRAY_NORMALIZATIONS[denominator](matches, qry_lens, lib_lens)
+
+
+## Data of the worker processes, set once by the pool initializer.
+_worker_data = {}
+
+def _init_worker(codes: np.ndarray, lens: np.ndarray, scoring: Scoring, params: Dict) -> None:
+    _worker_data.update(codes=codes, lens=lens, scoring=scoring, **params)
+
+
+def align_pairs(qry_idx: np.ndarray, lib_idx: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Align pairs of the length-sorted sequences in batches. Returns the pairs
+    within the threshold with their metric.
+    '''
+    codes, lens, scoring = _worker_data['codes'], _worker_data['lens'], _worker_data['scoring']
+    if len(qry_idx) == 0:
+        return qry_idx, lib_idx, np.zeros(0)
+
+    batch_size = max(1, BATCH_CELLS // (int(lens[lib_idx].max()) + 1))
+    srcs, dsts, metrics = [], [], []
+    for start in range(0, len(qry_idx), batch_size):
+        q, l = qry_idx[start:start+batch_size], lib_idx[start:start+batch_size]
+        q_lens, l_lens = lens[q], lens[l]
+        matches, gaps = align_batch(codes[q, :q_lens.max()], codes[l, :l_lens.max()], q_lens, l_lens, scoring)
+
+        identity = compute_identities(matches, gaps, q_lens, l_lens, _worker_data['denominator'])
+        metric = ARRAY_TRANSFORMATIONS[_worker_data['transformation']](identity)
+        within = ~(metric > _worker_data['threshold'])
+        srcs.append(q[within])
+        dsts.append(l[within])
+        metrics.append(metric[within])
+
+    return np.concatenate(srcs), np.concatenate(dsts), np.concatenate(metrics)
+
+
+def align_tile(qry_start: int, qry_end: int, lib_start: int, lib_end: int) -> Tuple[int, Tuple[np.ndarray, np.ndarray, np.ndarray], float]:
+    '''
+    Align all pairs between two blocks of the length-sorted sequences, only pairs
+    with qry < lib when the blocks overlap. Pairs whose lengths rule out an edge
+    are skipped. Returns the number of aligned pairs,
+    the pairs within the threshold with their metric and the wall time.
+    '''
+    start_time = time.perf_counter()
+    lens = _worker_data['lens']
+
+    qry_idx, lib_idx = np.meshgrid(np.arange(qry_start, qry_end), np.arange(lib_start, lib_end), indexing='ij')
+    qry_idx, lib_idx = qry_idx.ravel(), lib_idx.ravel()
+    keep = qry_idx < lib_idx
+    # pairs whose lengths rule out an edge are not aligned.
+    keep &= ~pruned_pairs(lens[qry_idx], lens[lib_idx], _worker_data['denominator'], _worker_data['transformation'], _worker_data['threshold'])
+    qry_idx, lib_idx = qry_idx[keep], lib_idx[keep]
+
+    return len(qry_idx), align_pairs(qry_idx, lib_idx), time.perf_counter() - start_time
+
+
+def align_candidates(qry_idx: np.ndarray, lib_idx: np.ndarray) -> Tuple[int, Tuple[np.ndarray, np.ndarray, np.ndarray], float]:
+    '''Align a list of candidate pairs. Returns the same as align_tile.'''
+    start_time = time.perf_counter()
+    return len(qry_idx), align_pairs(qry_idx, lib_idx), time.perf_counter() - start_time
+
+
+def generate_edges_nw(entity_fp: str,
+                      graph: EntityGraph,
+                      transformation: str,
+                      threshold: float,
+                      denominator: str = 'full',
+                      n_procs: int = -1,
+                      delimiter: str = '|',
+                      is_nucleotide: bool = False,
+                      gapopen: float = 10,
+                      gapextend: float = 0.5,
+                      endweight: bool = False,
+                      endopen: float = 10,
+                      endextend: float = 0.5,
+                      matrix: str = None,
+                      max_in_flight: int = None,
+                      prefilter: bool = False,
+                      kmer_size: int = None,
+                      min_shared_kmers: int = None,
+                      json_dict: Dict[str, Any] = None,
+                      ) -> None:
+    '''
+    Compute all pairwise global alignments with the built-in aligner and insert
+    the edges within the threshold into the graph.
+    The sequences are sorted by length and split into blocks of similar summed length.
+    Pairs of blocks are aligned by n_procs worker processes, the most expensive first.
+    Results are added to the graph as the tiles complete, with at most max_in_flight
+    (default 2*n_procs) tiles submitted and not yet added.
+    Tiles and pairs whose sequence lengths rule out an edge are skipped.
+    The wall time of each tile is reported in json_dict['alignment_tiles'],
+    the number of skipped pairs in json_dict['pruned_pairs'].
+    With prefilter, only the pairs that share at least min_shared_kmers distinct
+    k-mers of size kmer_size (defaults in kmer_utils) are aligned,
+    split into tasks of similar cost. Their number is reported in json_dict['prefilter'].
+    '''
+    if matrix is None:
+        matrix = 'EDNAFULL' if is_nucleotide else 'EBLOSUM62'
+    scoring = Scoring(matrix, gapopen, gapextend, endweight, endopen, endextend)
+    if n_procs is None or n_procs < 1:
+        n_procs = os.cpu_count()
+
+    ids, seqs = parse_fasta(entity_fp, delimiter)
+    ids = [id.lstrip('>') for id in ids]
+    node_ids = graph.node_ids(ids)
+    if (node_ids < 0).any():
+        raise RuntimeError(f'Sequence {ids[np.flatnonzero(node_ids < 0)[0]]} was not found in the graph. This should not happen, please report a bug.')
+
+    # sort by length, so that pairs in a batch need little padding. Empty sequences have no edges.
+    lens = np.array([len(s) for s in seqs], dtype=np.int64)
+    order = np.argsort(lens, kind='stable')
+    order = order[lens[order] > 0]
+    lens = lens[order]
+    codes = np.zeros((len(order), int(lens.max()) if len(lens) > 0 else 1), dtype=np.uint8)
+    for row, idx in enumerate(order.tolist()):
+        codes[row, :lens[row]] = np.frombuffer(seqs[idx].encode('ascii', errors='replace'), dtype=np.uint8)
+
+    n_seqs = len(order)
+    params = {'transformation': transformation, 'threshold': threshold, 'denominator': denominator}
+    if prefilter:
+        # only align the pairs that share k-mers, in tasks of similar cost.
+        kmer_size, min_shared_kmers = prefilter_params(kmer_size, min_shared_kmers, is_nucleotide)
+        qry_idx, lib_idx, _ = candidate_pairs([seqs[idx] for idx in order.tolist()], kmer_size, min_shared_kmers)
+        n_candidates = len(qry_idx)
+        prefilter_counts = prefilter_report(kmer_size, min_shared_kmers, n_candidates, n_seqs)
+        keep = ~pruned_pairs(lens[qry_idx], lens[lib_idx], denominator, transformation, threshold)
+        # order by library, so that pairs in a batch have similar lengths.
+        by_lib = np.lexsort((qry_idx[keep], lib_idx[keep]))
+        qry_idx, lib_idx = qry_idx[keep][by_lib], lib_idx[keep][by_lib]
+        n_pruned = n_candidates - len(qry_idx)
+
+        cost = np.cumsum(lens[qry_idx] * lens[lib_idx])
+        n_tasks = TILES_PER_PROC * n_procs
+        bounds = np.unique(np.concatenate([[0], np.searchsorted(cost, cost[-1] * np.arange(1, n_tasks) / n_tasks), [len(cost)]])) if len(cost) > 0 else []
+        tiles = sorted(((int(start), int(end), int(cost[end-1] - (cost[start-1] if start > 0 else 0))) for start, end in zip(bounds[:-1], bounds[1:])), key=lambda x: -x[2])
+        work = lambda task: (align_candidates, qry_idx[task[0]:task[1]], lib_idx[task[0]:task[1]])
+        pbar = tqdm(total=len(qry_idx))
+    else:
+        # the sequences are sorted already, so each chunk is a contiguous block.
+        n_chunks = auto_n_chunks(n_procs, triangular=True)
+        if can_prune(denominator, transformation):
+            n_chunks = max(n_chunks, PRUNE_CHUNKS)
+        chunks = cost_balanced_chunks(lens, n_chunks)
+        blocks = [(int(chunk[0]), int(chunk[-1]) + 1) for chunk in chunks]
+        tiles = make_tiles(chunks, lens, triangular=True, upper_diagonal=True)
+        tiles, n_pruned = prune_tiles(tiles, chunks, lens, denominator, transformation, threshold, upper_diagonal=True)
+        work = lambda tile: (align_tile, *blocks[tile[0]], *blocks[tile[1]])
+        pbar = tqdm(total=n_seqs * (n_seqs - 1) // 2)
+        pbar.update(n_pruned)
+
+    tile_times = []
+    def add_result(tile, result):
+        nonlocal n_pruned
+        count, (src, dst, metric), seconds = result
+        graph.add_edges(node_ids[order[src]], node_ids[order[dst]], metric)
+        if prefilter:
+            pbar.update(count)
+            return
+        tile_times.append(tile_report(chunks, tile, seconds))
+        i, j, _ = tile
+        n_pairs = len(chunks[i]) * (len(chunks[i]) - 1) // 2 if i == j else len(chunks[i]) * len(chunks[j])
+        n_pruned += n_pairs - count
+        pbar.update(n_pairs)
+
+    if n_procs == 1:
+        _init_worker(codes, lens, scoring, params)
+        for tile in tiles:
+            fn, *args = work(tile)
+            add_result(tile, fn(*args))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_procs, initializer=_init_worker, initargs=(codes, lens, scoring, params)) as executor:
+            # the executor hands the next tile to whichever worker becomes idle first.
+            submit = lambda tile: executor.submit(*work(tile))
+            for tile, job in run_tiles(submit, tiles, max_in_flight if max_in_flight is not None else 2 * n_procs):
+                add_result(tile, job.result())
+    pbar.close()
+
+    if json_dict is not None:
+        if prefilter:
+            json_dict['prefilter'] = prefilter_counts
+        else:
+            json_dict['alignment_tiles'] = tile_times
+        json_dict['pruned_pairs'] = int(n_pruned)
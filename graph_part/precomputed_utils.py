@@ -1,12 +1,123 @@
 '''
 Parsing functions for precomputed similarities.
+
+Edge lists are either comma separated text or the binary checkpoint format:
+a 40 byte header (magic, version, number of nodes, number of edges, size of
+the node table), the node identifiers separated by newlines and padded to
+8 bytes, followed by the float64 metrics and the int32 src and dst positions
+in the node table. The arrays are memory-mapped when loading.
+
+Both formats can be gzip, bzip2 or xz compressed. Compressed binary edge
+lists are read into memory instead.
 '''
-import networkx as nx
-from .transformations import TRANSFORMATIONS
+import struct
+from typing import List, Tuple
+import numpy as np
+import pandas as pd
+from .transformations import ARRAY_TRANSFORMATIONS
+from .entity_graph import EntityGraph
+from .compression_utils import compression_module, open_input, open_output, read_head
 from tqdm import tqdm
 
+## Number of edges that are parsed and added to the graph at once.
+BATCH_SIZE = 1000000
+
+CHECKPOINT_MAGIC = b'GPEDGES\0'
+CHECKPOINT_VERSION = 1
+## magic, version, reserved, number of nodes, number of edges, size of the node table in bytes.
+CHECKPOINT_HEADER = struct.Struct('<8sIIQQQ')
+
+
+def is_binary_edge_list(edge_fp: str) -> bool:
+    '''True if edge_fp starts with the magic of the binary checkpoint format, after decompression.'''
+    return read_head(edge_fp, len(CHECKPOINT_MAGIC)) == CHECKPOINT_MAGIC
+
+
+def _write_array(f, a: np.ndarray, dtype: type) -> None:
+    # tofile() would bypass the compression of compressed files, write the bytes instead.
+    f.write(memoryview(np.ascontiguousarray(a, dtype=dtype)).cast('B'))
+
+
+def write_binary_edge_list(edge_fp: str, ids: List[str], src: np.ndarray, dst: np.ndarray, metric: np.ndarray) -> None:
+    '''
+    Write edges between positions in ids in the binary checkpoint format.
+    The metric is written as float64, so that it is compared to the threshold
+    exactly as in the run that wrote it. Names ending in .gz, .bz2 or .xz are
+    written compressed.
+    '''
+    table = '\n'.join(ids).encode()
+    with open_output(edge_fp, 'wb') as f:
+        f.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, 0, len(ids), len(src), len(table)))
+        f.write(table + b'\0' * (-len(table) % 8))
+        _write_array(f, metric, np.float64)
+        _write_array(f, src, np.int32)
+        _write_array(f, dst, np.int32)
+
+
+def read_binary_edge_list(edge_fp: str) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Read a binary checkpoint. Returns the node identifiers and memory-mapped
+    src, dst and metric arrays, src and dst are positions in the identifiers.
+    Compressed checkpoints can not be memory-mapped, their arrays are read into memory.
+    '''
+    compressed = compression_module(edge_fp) is not None
+    with open_input(edge_fp, 'rb') as f:
+        magic, version, _, n_nodes, n_edges, table_size = CHECKPOINT_HEADER.unpack(f.read(CHECKPOINT_HEADER.size))
+        if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+            raise ValueError(f'{edge_fp} is not a binary edge list of version {CHECKPOINT_VERSION}.')
+        table = f.read(table_size + (-table_size % 8))[:table_size].decode()
+        if compressed and n_edges > 0:
+            arrays = f.read(16 * n_edges)
+            if len(arrays) < 16 * n_edges:
+                raise ValueError(f'{edge_fp} is truncated.')
+            metric = np.frombuffer(arrays, dtype=np.float64, count=n_edges)
+            src = np.frombuffer(arrays, dtype=np.int32, count=n_edges, offset=8 * n_edges)
+            dst = np.frombuffer(arrays, dtype=np.int32, count=n_edges, offset=12 * n_edges)
+    ids = table.split('\n') if n_nodes > 0 else []
+
+    offset = CHECKPOINT_HEADER.size + table_size + (-table_size % 8)
+    if n_edges == 0:
+        return ids, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64)
+    if compressed:
+        return ids, src, dst, metric
+    metric = np.memmap(edge_fp, dtype=np.float64, mode='r', offset=offset, shape=(n_edges,))
+    src = np.memmap(edge_fp, dtype=np.int32, mode='r', offset=offset + 8 * n_edges, shape=(n_edges,))
+    dst = np.memmap(edge_fp, dtype=np.int32, mode='r', offset=offset + 12 * n_edges, shape=(n_edges,))
+    return ids, src, dst, metric
+
+
+def load_binary_edge_list(edge_fp: str,
+               graph: EntityGraph,
+               tranformation: str,
+               threshold: float) -> None:
+    '''Load edges from a binary checkpoint, mapping its node table to the graph once.'''
+    ids, src, dst, values = read_binary_edge_list(edge_fp)
+    node_ids = graph.node_ids(ids)
+    with tqdm(total=len(src)) as pbar:
+        for start in range(0, len(src), BATCH_SIZE):
+            metric = ARRAY_TRANSFORMATIONS[tranformation](np.asarray(values[start:start+BATCH_SIZE]))
+            qrys, libs = node_ids[src[start:start+BATCH_SIZE]], node_ids[dst[start:start+BATCH_SIZE]]
+            keep = ~(metric > threshold) & (qrys >= 0) & (libs >= 0)
+            graph.add_edges(qrys[keep], libs[keep], metric[keep])
+            pbar.update(len(metric))
+
+
+COLUMN_COUNT_ERROR = """
+        Edge list file does not contain at least three comma 
+        separated columns. The first two columns should contain
+        entity identifiers and the third should contain the
+        metric to partition by.
+        """
+
+
+def has_short_row(edge_fp: str, n_columns: int) -> bool:
+    '''Check whether any non-empty row of a text edge list has fewer than n_columns columns.'''
+    with open_input(edge_fp, background=False) as f:
+        return any(line.strip() and len(line.split(',')) < n_columns for line in f)
+
+
 def load_edge_list(edge_fp: str, 
-               full_graph: nx.classes.graph.Graph, 
+               graph: EntityGraph,
                tranformation: str,
                threshold: float,
                metric_column: int):
@@ -14,34 +125,46 @@ def load_edge_list(edge_fp: str,
     Load edges form a precomputed edge list saved as .csv
     Expects the names of the nodes in columns 0 and 1, the
     metric in metric_column.
+    The file is parsed in chunks of BATCH_SIZE lines by the pandas
+    C parser. Each name column is factorized, so that only its distinct
+    names are looked up in the graph. Pairs of unknown nodes and self-pairs
+    are dropped.
+    Binary checkpoints are recognized by their header and loaded
+    with `load_binary_edge_list` instead. Compressed files are
+    decompressed by a reader thread while they are parsed.
     '''
-    with open(edge_fp) as inf:
-        #pdb.set_trace()
-        for line_nr, line in tqdm(enumerate(inf)):
-            spl = line.strip().split(',')
-            if len(spl) < 3:
-                raise ValueError("""
-                Edge list file does not contain at least three comma 
-                separated columns. The first two columns should contain
-                entity identifiers and the third should contain the
-                metric to partition by.
-                """)
-            
-            this_qry = spl[0]
-            this_lib = spl[1]
-            try:
-                metric = TRANSFORMATIONS[tranformation](float(spl[metric_column]))
-            except ValueError or TypeError:
-                raise TypeError("Failed to interpret the metric column value %r. Please ensure that the edge list file is correctly formatted and that the correct column is specified." % (spl[1]))
-            
-            if this_qry == this_lib:
-                continue
-            if metric > threshold:
-                continue
-            if not full_graph.has_node(this_qry) or not full_graph.has_node(this_lib):
-                continue
-            if full_graph.has_edge(this_qry, this_lib):
-                if full_graph[this_qry][this_lib]['metric'] > metric:
-                    nx.set_edge_attributes(full_graph,{(this_qry,this_lib):metric}, 'metric')
-            else:
-                full_graph.add_edge(this_qry, this_lib, metric=metric)  
\ No newline at end of file
+    if is_binary_edge_list(edge_fp):
+        load_binary_edge_list(edge_fp, graph, tranformation, threshold)
+        return
+
+    with open_input(edge_fp, background=False) as f:
+        first_line = f.readline()
+    if first_line == '':
+        return
+    if len(first_line.strip().split(',')) < 3:
+        raise ValueError(COLUMN_COUNT_ERROR)
+
+    def column_node_ids(names: pd.Series) -> np.ndarray:
+        codes, distinct = pd.factorize(names.to_numpy())
+        return graph.node_ids(distinct)[codes]
+
+    # without na_filter, names like NA stay names.
+    edge_file = open_input(edge_fp, 'rb')
+    reader = pd.read_csv(edge_file, sep=',', header=None, usecols=sorted({0, 1, metric_column}), engine='c', na_filter=False,
+                         dtype={0: object, 1: object, metric_column: np.float64}, chunksize=BATCH_SIZE)
+    with edge_file, reader, tqdm() as pbar:
+        try:
+            for chunk in reader:
+                src, dst = column_node_ids(chunk[0]), column_node_ids(chunk[1])
+                ## Metric transformations should be defined here
+                metric = ARRAY_TRANSFORMATIONS[tranformation](chunk[metric_column].to_numpy())
+                keep = ~(metric > threshold) & (src >= 0) & (dst >= 0) & (src != dst)
+                graph.add_edges(src[keep], dst[keep], metric[keep])
+                pbar.update(len(chunk))
+        except pd.errors.ParserError as e:
+            raise ValueError(COLUMN_COUNT_ERROR) from e
+        except ValueError as e:
+            ## a row with missing columns reads as an empty metric, tell it apart from a bad metric.
+            if has_short_row(edge_fp, max(3, metric_column + 1)):
+                raise ValueError(COLUMN_COUNT_ERROR) from e
+            raise TypeError("Failed to interpret a metric column value. Please ensure that the edge list file is correctly formatted and that the correct column is specified.") from e
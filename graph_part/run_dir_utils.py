@@ -0,0 +1,317 @@
+'''
+Functions to keep the alignment tiles of a run in a run directory, so that
+an interrupted run can be resumed. The directory holds a manifest with the
+parameters of the run and its tiles, the chunking of the sequences, a fasta
+file per chunk and one edge shard per finished tile. All files are written
+to a temporary name first and then renamed, so a file that exists is complete.
+
+In a distributed run, the unfinished tiles are put in a queue in the run
+directory. Workers on any host that can see the directory claim tiles by
+renaming their queue entry, which is atomic also on network file systems.
+A claim is a lease: the worker renews it while it aligns the tile, and a claim
+that was not renewed for LEASE_SECONDS is put back in the queue, so that the
+tiles of a worker that died are aligned by another process.
+'''
+import concurrent.futures
+import hashlib
+import json
+import os
+import socket
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import numpy as np
+
+
+MANIFEST = 'manifest.json'
+CHUNKS = 'chunks.npz'
+QUEUE = 'queue'
+CLAIMED = 'claimed'
+FINISHED = 'finished'
+
+## Seconds between checks of the run directory while waiting for other processes.
+POLL_SECONDS = 2
+
+## Seconds after which a claim that was not renewed expires and its tile is queued again.
+## Generous, as the modification times are set by the file system and the clocks of hosts may differ.
+LEASE_SECONDS = 600
+
+## Seconds between renewals of the claims of the tiles that are being aligned.
+RENEW_SECONDS = 60
+
+## Version of the run directory layout, runs of other versions can not be resumed.
+VERSION = 1
+
+
+def file_hash(path: str) -> str:
+    '''sha256 of a file, read in blocks.'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _replace(path: str, write: Callable[[Any], None], mode: str = 'w') -> None:
+    '''
+    Write a file under a temporary name with `write(f)` and rename it to path.
+    The temporary name includes the host, as processes on different hosts can have the same pid.
+    '''
+    tmp_path = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_path, mode) as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def chunk_fasta_path(run_dir: str, i: int) -> str:
+    return os.path.join(run_dir, f'chunk_{i}.fasta')
+
+
+def shard_path(run_dir: str, tile: Tuple[int, int, int]) -> str:
+    return os.path.join(run_dir, f'tile_{tile[0]}_{tile[1]}.npz')
+
+
+def open_run_dir(run_dir: str,
+                 entity_fp: str,
+                 params: Dict[str, Any],
+                 plan: Callable[[], Tuple[List[np.ndarray], List[Tuple[int, int, int]], int]],
+                 resume: bool = False) -> Tuple[List[np.ndarray], List[Tuple[int, int, int]], int]:
+    '''
+    Set up the run directory for a new run, or load the run to resume.
+    plan() returns the chunks, the tiles and the number of pruned pairs of a new run.
+    When resuming, the chunks and tiles of the existing run are returned instead,
+    so that its finished tiles stay valid. The input file and params need to match.
+    '''
+    manifest_fp = os.path.join(run_dir, MANIFEST)
+    fasta_hash = file_hash(entity_fp)
+    # json turns tuples into lists, compare params as they will be loaded.
+    params = json.loads(json.dumps(params))
+
+    if os.path.exists(manifest_fp):
+        if not resume:
+            raise ValueError(f'{run_dir} already contains a run. Use --resume to continue it, or choose another run directory.')
+        with open(manifest_fp) as f:
+            manifest = json.load(f)
+        if manifest['version'] != VERSION or manifest['fasta_sha256'] != fasta_hash or manifest['params'] != params:
+            raise ValueError(f'The run in {run_dir} was started with a different input file or different parameters, it can not be resumed.')
+        tiles = [tuple(tile) for tile in manifest['tiles']]
+        return read_chunks(run_dir), tiles, manifest['pruned_pairs']
+
+    if resume:
+        print(f'Found no run to resume in {run_dir}, starting a new one.')
+    os.makedirs(run_dir, exist_ok=True)
+    chunks, tiles, n_pruned = plan()
+    order = np.concatenate(chunks) if len(chunks) > 0 else np.zeros(0, dtype=np.int64)
+    bounds = np.cumsum([len(chunk) for chunk in chunks])[:-1]
+    _replace(os.path.join(run_dir, CHUNKS), lambda f: np.savez(f, order=order, bounds=bounds), 'wb')
+    # the manifest is written last, it marks the directory as a run.
+    manifest = {'version': VERSION, 'fasta_sha256': fasta_hash, 'params': params,
+                'tiles': [list(tile) for tile in tiles], 'pruned_pairs': n_pruned}
+    _replace(manifest_fp, lambda f: json.dump(manifest, f))
+    return chunks, tiles, n_pruned
+
+
+def write_chunk_fastas(run_dir: str, ids: List[str], seqs: List[str], chunks: List[np.ndarray]) -> List[str]:
+    '''Write each chunk of sequences to its fasta file in the run directory. Returns the file names.'''
+    files = []
+    for i, chunk in enumerate(chunks):
+        files.append(chunk_fasta_path(run_dir, i))
+        def write(f, chunk=chunk):
+            for idx in chunk.tolist():
+                f.write(ids[idx]+'\n')
+                f.write(seqs[idx]+'\n')
+        _replace(files[-1], write)
+    return files
+
+
+def finished_tiles(run_dir: str, tiles: List[Tuple[int, int, int]]) -> Set[Tuple[int, int, int]]:
+    '''The tiles whose shard was written.'''
+    return {tile for tile in tiles if os.path.exists(shard_path(run_dir, tile))}
+
+
+def write_shard(run_dir: str, tile: Tuple[int, int, int], src: np.ndarray, dst: np.ndarray, metric: np.ndarray, count: int, seconds: float) -> None:
+    '''
+    Write the edges of a tile, as positions of the sequences in the input file,
+    together with the number of aligned pairs and the wall time of the tile.
+    '''
+    _replace(shard_path(run_dir, tile), lambda f: np.savez(f, src=np.asarray(src, dtype=np.int32), dst=np.asarray(dst, dtype=np.int32),
+                                                           metric=np.asarray(metric, dtype=np.float64), count=count, seconds=seconds), 'wb')
+
+
+def read_shard(run_dir: str, tile: Tuple[int, int, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int, float]:
+    '''Read the edges, the number of aligned pairs and the wall time of a tile.'''
+    with np.load(shard_path(run_dir, tile)) as data:
+        return data['src'], data['dst'], data['metric'], int(data['count']), float(data['seconds'])
+
+
+def remove_chunk_fastas(run_dir: str, n_chunks: int) -> None:
+    '''Remove the chunk fasta files of a finished run, the shards are kept.'''
+    for i in range(n_chunks):
+        if os.path.exists(chunk_fasta_path(run_dir, i)):
+            os.remove(chunk_fasta_path(run_dir, i))
+
+
+def read_manifest(run_dir: str) -> Optional[Dict[str, Any]]:
+    '''The manifest of the run in run_dir, None if there is none yet.'''
+    manifest_fp = os.path.join(run_dir, MANIFEST)
+    if not os.path.exists(manifest_fp):
+        return None
+    with open(manifest_fp) as f:
+        return json.load(f)
+
+
+def read_chunks(run_dir: str) -> List[np.ndarray]:
+    '''The sequence positions of each chunk of the run in run_dir.'''
+    with np.load(os.path.join(run_dir, CHUNKS)) as data:
+        return np.split(data['order'], data['bounds'])
+
+
+def queue_tiles(run_dir: str, tiles: List[Tuple[int, int, int]], done: Set[Tuple[int, int, int]]) -> None:
+    '''
+    Put the unfinished tiles in the queue of the run directory, in the order of tiles.
+    Claims of an earlier run are dropped, so that tiles of workers that died are queued again.
+    '''
+    _remove_queue(run_dir)
+    if os.path.exists(os.path.join(run_dir, FINISHED)):
+        os.remove(os.path.join(run_dir, FINISHED))
+    os.makedirs(os.path.join(run_dir, CLAIMED))
+
+    # the queue is filled under a temporary name, so that workers never see a partial queue.
+    queue = os.path.join(run_dir, f'{QUEUE}.{os.getpid()}.tmp')
+    os.makedirs(queue)
+    for rank, tile in enumerate(tiles):
+        if tile not in done:
+            open(os.path.join(queue, f'{rank:06d}_{tile[0]}_{tile[1]}'), 'w').close()
+    os.rename(queue, os.path.join(run_dir, QUEUE))
+
+
+def _remove_queue(run_dir: str) -> None:
+    for name in (QUEUE, CLAIMED):
+        if os.path.exists(os.path.join(run_dir, name)):
+            for file in os.listdir(os.path.join(run_dir, name)):
+                os.remove(os.path.join(run_dir, name, file))
+            os.rmdir(os.path.join(run_dir, name))
+
+
+def claim_tile(run_dir: str) -> Optional[Tuple[Tuple[int, int], str]]:
+    '''
+    Claim the first tile in the queue by moving its entry to the claimed tiles.
+    Returns the (query chunk, library chunk) of the tile and the path of the claim,
+    None when the queue is empty.
+    '''
+    try:
+        names = sorted(os.listdir(os.path.join(run_dir, QUEUE)))
+    except FileNotFoundError:
+        return None
+    for name in names:
+        claim = os.path.join(run_dir, CLAIMED, f'{name}.{socket.gethostname()}.{os.getpid()}')
+        try:
+            os.rename(os.path.join(run_dir, QUEUE, name), claim)
+        except FileNotFoundError:
+            # another worker was faster.
+            continue
+        _, i, j = name.split('_')
+        return (int(i), int(j)), claim
+    return None
+
+
+def claim_tiles(run_dir: str,
+                submit: Callable[[Tuple[int, int, int]], concurrent.futures.Future],
+                tiles: List[Tuple[int, int, int]],
+                max_in_flight: int) -> Iterator[Tuple[Tuple[int, int, int], concurrent.futures.Future]]:
+    '''
+    Claim tiles from the queue of run_dir and submit them with `submit`, keeping at most
+    max_in_flight tiles submitted but not yet consumed, until the queue is empty.
+    Yields (tile, future) in the order in which the tiles complete, as `run_tiles`.
+    The claims of the submitted tiles are renewed until the caller processed them,
+    i.e. wrote their shard, then they are released. When the queue is empty, expired
+    claims of other processes are queued again and claimed.
+    '''
+    by_chunks = {(tile[0], tile[1]): tile for tile in tiles}
+    pending = {}
+    while True:
+        while len(pending) < max(1, max_in_flight):
+            claimed = claim_tile(run_dir)
+            if claimed is None and requeue_stale_claims(run_dir) > 0:
+                claimed = claim_tile(run_dir)
+            if claimed is None:
+                break
+            tile = by_chunks[claimed[0]]
+            pending[submit(tile)] = (tile, claimed[1])
+        if len(pending) == 0:
+            return
+
+        done, _ = concurrent.futures.wait(pending, timeout=RENEW_SECONDS, return_when=concurrent.futures.FIRST_COMPLETED)
+        renew_claims(claim for future, (_, claim) in pending.items() if future not in done)
+        for future in done:
+            tile, claim = pending.pop(future)
+            yield tile, future
+            try:
+                os.remove(claim)
+            except FileNotFoundError:
+                pass
+
+
+def renew_claims(claims: Iterable[str]) -> None:
+    '''Set the modification time of the claims to now, so that they don't expire.'''
+    for claim in claims:
+        try:
+            os.utime(claim)
+        except FileNotFoundError:
+            # the claim expired and its tile was queued again, aligning it twice does no harm.
+            pass
+
+
+def requeue_stale_claims(run_dir: str, lease_seconds: float = LEASE_SECONDS) -> int:
+    '''
+    Put the tiles whose claim was not renewed for lease_seconds back in the queue,
+    as the process that claimed them died. Expired claims of tiles whose shard
+    was written are removed instead. Returns the number of queued tiles.
+    '''
+    try:
+        names = os.listdir(os.path.join(run_dir, CLAIMED))
+    except FileNotFoundError:
+        return 0
+    n_queued = 0
+    for name in names:
+        claim = os.path.join(run_dir, CLAIMED, name)
+        # the claim is named after the queue entry, followed by the host and the pid.
+        entry = name.split('.', 1)[0]
+        _, i, j = entry.split('_')
+        try:
+            if time.time() - os.path.getmtime(claim) < lease_seconds:
+                continue
+            if os.path.exists(shard_path(run_dir, (int(i), int(j), 0))):
+                os.remove(claim)
+            else:
+                os.rename(claim, os.path.join(run_dir, QUEUE, entry))
+                n_queued += 1
+        except FileNotFoundError:
+            # the claim was released or queued again by another process meanwhile.
+            continue
+    return n_queued
+
+
+def n_claimed(run_dir: str) -> int:
+    '''The number of tiles that are claimed by a process.'''
+    try:
+        return len(os.listdir(os.path.join(run_dir, CLAIMED)))
+    except FileNotFoundError:
+        return 0
+
+
+def wait_for_queue(run_dir: str) -> bool:
+    '''
+    Wait until the queue of the run in run_dir was created. Returns False if the run
+    finished already.
+    '''
+    while not os.path.exists(os.path.join(run_dir, QUEUE)):
+        if os.path.exists(os.path.join(run_dir, FINISHED)):
+            return False
+        time.sleep(POLL_SECONDS)
+    return True
+
+
+def finish_queue(run_dir: str) -> None:
+    '''Remove the queue of a finished run and mark it as finished, so that workers stop.'''
+    open(os.path.join(run_dir, FINISHED), 'w').close()
+    _remove_queue(run_dir)
@@ -0,0 +1,33 @@
+'''
+Per-run temporary directories for the files that the aligners read and write.
+Each run gets its own directory, so that concurrent runs in the same working
+directory do not see each other's files. By default, the directory is made in
+the system temporary directory (TMPDIR). The intermediate files of mmseqs2 are
+many times the size of the input, so a directory in memory such as /dev/shm
+is only used when it is given explicitly.
+'''
+import contextlib
+import os
+import shutil
+import tempfile
+from typing import Iterator
+
+
+def make_tmp_dir(parent: str = None) -> str:
+    '''
+    Make a new temporary directory in parent, or in the system temporary directory.
+    The caller removes it.
+    '''
+    if parent is not None:
+        os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(prefix='graphpart_', dir=parent)
+
+
+@contextlib.contextmanager
+def tmp_dir_context(parent: str = None) -> Iterator[str]:
+    '''A temporary directory as by `make_tmp_dir`, that is removed on exit, also after errors.'''
+    path = make_tmp_dir(parent)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,160 @@
+'''
+Functions to split all-vs-all alignments into tiles of similar cost.
+The cost of aligning two sequences grows with the product of their lengths,
+so a tile (a pair of chunks) costs the sum of the length products of its pairs.
+'''
+import math
+import concurrent.futures
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from .transformations import ARRAY_TRANSFORMATIONS
+
+
+## Number of tiles per process when sizing chunks automatically. More tiles
+## than processes keep all processes busy while the last tiles finish.
+TILES_PER_PROC = 4
+
+## Minimum number of chunks when tiles can be pruned by length. Chunks with
+## narrower length ranges let more tiles be skipped.
+PRUNE_CHUNKS = 8
+
+## Transformations that decrease with identity. Only with these, an upper bound
+## on the identity of a pair can show that it is not within the threshold.
+DECREASING_TRANSFORMATIONS = ('one-minus', 'inverse')
+
+
+def auto_n_chunks(n_procs: int, triangular: bool) -> int:
+    '''Smallest number of chunks that gives TILES_PER_PROC tiles per process.'''
+    n_tiles = TILES_PER_PROC * max(1, n_procs)
+    if triangular:
+        return max(1, math.ceil((math.sqrt(8 * n_tiles + 1) - 1) / 2))
+    return max(1, math.ceil(math.sqrt(n_tiles)))
+
+
+def cost_balanced_chunks(seq_lens: np.ndarray, n_chunks: int) -> List[np.ndarray]:
+    '''
+    Split sequences into at most n_chunks chunks with similar summed length.
+    Sequences are sorted by length, so each chunk holds sequences of similar
+    length. Returns the sequence indices of each chunk.
+    '''
+    seq_lens = np.asarray(seq_lens)
+    order = np.argsort(seq_lens, kind='stable')
+    total = np.cumsum(seq_lens[order])
+    if len(order) == 0:
+        return []
+    bounds = np.searchsorted(total, total[-1] * np.arange(1, n_chunks) / n_chunks, side='left') + 1
+    return [chunk for chunk in np.split(order, bounds) if len(chunk) > 0]
+
+
+def make_tiles(chunks: List[np.ndarray], seq_lens: np.ndarray, triangular: bool, upper_diagonal: bool = False) -> List[Tuple[int, int, int]]:
+    '''
+    Make the (query chunk, library chunk, cost) tiles of an all-vs-all alignment,
+    the most expensive tiles first. With triangular, only tiles with query <= library
+    are made. With upper_diagonal, tiles on the diagonal only align each pair once.
+    '''
+    seq_lens = np.asarray(seq_lens, dtype=np.int64)
+    sums = [int(seq_lens[chunk].sum()) for chunk in chunks]
+    squares = [int((seq_lens[chunk]**2).sum()) for chunk in chunks]
+
+    tiles = []
+    for i in range(len(chunks)):
+        for j in range(i if triangular else 0, len(chunks)):
+            cost = sums[i] * sums[j]
+            if i == j and upper_diagonal:
+                cost = (cost - squares[i]) // 2
+            tiles.append((i, j, cost))
+
+    return sorted(tiles, key=lambda x: -x[2])
+
+
+def identity_bound(shorter: np.ndarray, longer: np.ndarray, denominator: str) -> Optional[np.ndarray]:
+    '''
+    Upper bound of the identity of pairs of sequences with the given lengths.
+    A pair has at most `shorter` identical positions, and its global alignment
+    is at least `longer` long. Returns None for denominators without a length
+    bound (shortest, no_gaps).
+    '''
+    shorter = np.asarray(shorter, dtype=np.float64)
+    longer = np.asarray(longer, dtype=np.float64)
+    if denominator in ('full', 'longest'):
+        bound = shorter / longer
+    elif denominator == 'mean':
+        bound = shorter / ((shorter + longer) / 2)
+    else:
+        return None
+    # full identities are rounded to 0.1%, the others may differ in the last bits.
+    return bound + 1e-3 if denominator == 'full' else bound * (1 + 1e-9)
+
+
+def can_prune(denominator: str, transformation: str) -> bool:
+    '''Whether pairs can be pruned by length for this denominator and transformation.'''
+    return transformation in DECREASING_TRANSFORMATIONS and identity_bound(1, 1, denominator) is not None
+
+
+def pruned_pairs(qry_lens: np.ndarray, lib_lens: np.ndarray, denominator: str, transformation: str, threshold: float) -> np.ndarray:
+    '''Mask of the pairs whose lengths rule out an edge within the threshold.'''
+    qry_lens, lib_lens = np.asarray(qry_lens), np.asarray(lib_lens)
+    if not can_prune(denominator, transformation):
+        return np.zeros(np.broadcast(qry_lens, lib_lens).shape, dtype=bool)
+    bound = identity_bound(np.minimum(qry_lens, lib_lens), np.maximum(qry_lens, lib_lens), denominator)
+    return ARRAY_TRANSFORMATIONS[transformation](bound) > threshold
+
+
+def prune_tiles(tiles: List[Tuple[int, int, int]], chunks: List[np.ndarray], seq_lens: np.ndarray,
+                denominator: str, transformation: str, threshold: float,
+                upper_diagonal: bool = False) -> Tuple[List[Tuple[int, int, int]], int]:
+    '''
+    Drop the tiles in which no pair can be within the threshold, judged by
+    the closest lengths of the two chunks. Returns the remaining tiles and
+    the number of pairs in the dropped tiles.
+    '''
+    if not can_prune(denominator, transformation):
+        return tiles, 0
+    seq_lens = np.asarray(seq_lens)
+    lo = np.array([seq_lens[chunk].min() for chunk in chunks])
+    hi = np.array([seq_lens[chunk].max() for chunk in chunks])
+
+    kept, n_pruned = [], 0
+    for tile in tiles:
+        i, j, _ = tile
+        # the closest lengths of the two chunks. Overlapping length ranges can not be pruned.
+        longer = max(lo[i], lo[j])
+        shorter = min(hi[i], hi[j], longer)
+        if pruned_pairs(shorter, longer, denominator, transformation, threshold):
+            n = len(chunks[i])
+            n_pruned += n * (n - 1) // 2 if i == j and upper_diagonal else n * len(chunks[j])
+        else:
+            kept.append(tile)
+    return kept, n_pruned
+
+
+def tile_report(chunks: List[np.ndarray], tile: Tuple[int, int, int], seconds: float) -> Dict[str, float]:
+    '''Summary of a computed tile for the json report, used to calibrate the cost model.'''
+    i, j, cost = tile
+    return {'query_chunk': i, 'library_chunk': j, 'query_size': len(chunks[i]), 'library_size': len(chunks[j]), 'cost': cost, 'seconds': round(seconds, 4)}
+
+
+def run_tiles(submit: Callable[[Tuple[int, int, int]], concurrent.futures.Future],
+              tiles: List[Tuple[int, int, int]],
+              max_in_flight: int) -> Iterator[Tuple[Tuple[int, int, int], concurrent.futures.Future]]:
+    '''
+    Submit tiles in order with `submit`, keeping at most max_in_flight tiles submitted
+    but not yet consumed. Yields (tile, future) in the order in which the tiles complete.
+    The next tile is submitted before a finished one is yielded, so the workers stay
+    busy while the caller processes the result.
+    '''
+    tiles = iter(tiles)
+    pending = {}
+    for tile in tiles:
+        pending[submit(tile)] = tile
+        if len(pending) >= max(1, max_in_flight):
+            break
+
+    while len(pending) > 0:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            tile = pending.pop(future)
+            next_tile = next(tiles, None)
+            if next_tile is not None:
+                pending[submit(next_tile)] = next_tile
+            yield tile, future
@@ -4,12 +4,10 @@ We first partition the data into 10 or 20 partitions. These
 are then combined to yield the splits. Then removal is applied,
 as always.
 '''
-import networkx as nx
 import numpy as np
-import pandas as pd
-from collections import Counter
 from itertools import combinations
 from typing import List, Tuple
+from .entity_graph import EntityGraph
 
 
 def check_train_val_test_args(args):
@@ -31,20 +29,17 @@ def check_train_val_test_args(args):
     
     
 
-def compute_partition_similarity_matrix(full_graph: nx.classes.graph.Graph, part_graph: nx.classes.graph.Graph, n_partitions: int, threshold: float) -> np.ndarray:
+def compute_partition_similarity_matrix(graph: EntityGraph, n_partitions: int, threshold: float) -> np.ndarray:
     '''Compute a similarity matrix of the partitions. Metric = number of connections between.'''
     partition_connections = np.zeros((n_partitions, n_partitions))
-    #iterate over all sequences
-    for n,d in full_graph.nodes(data=True):
-        # get the partition of the sequence 
-        self_cluster = part_graph.nodes[n]['cluster']
-        #get the neighbors of the sequence
-        neighbours = nx.neighbors(full_graph,n) 
-        #count the number of neighbors of each partition
-        neighbour_clusters = Counter((part_graph.nodes[nb]['cluster'] for nb in nx.neighbors(full_graph,n) if full_graph[n][nb]['metric'] < threshold))
-
-        for cl, count in neighbour_clusters.items():
-            partition_connections[int(self_cluster), int(cl)] += count #Partition id ['cluster'] is float.
+    # within-threshold edges between nodes that were not removed
+    within = graph.alive[graph.src] & graph.alive[graph.dst] & (graph.metric < threshold)
+    # get the partitions of both ends. Partition id ['cluster'] is float.
+    src_cluster = graph.cluster[graph.src[within]].astype(int)
+    dst_cluster = graph.cluster[graph.dst[within]].astype(int)
+    # each edge is a neighbour of both of its nodes.
+    np.add.at(partition_connections, (src_cluster, dst_cluster), 1)
+    np.add.at(partition_connections, (dst_cluster, src_cluster), 1)
 
     return partition_connections
 
@@ -80,8 +75,7 @@ def find_best_partition_combinations(partition_connections: np.ndarray, n_train:
     return train_partitions, test_partitions, val_partitions
 
 
-def train_val_test_split(part_graph: nx.classes.graph.Graph, 
-                     full_graph: nx.classes.graph.Graph, 
+def train_val_test_split(graph: EntityGraph,
                      threshold: float, 
                      test_ratio: float,
                      val_ratio: float, 
@@ -95,36 +89,17 @@ def train_val_test_split(part_graph: nx.classes.graph.Graph,
 
     # For each partition, measure the overlap to other partitions.
     # partition_connections is essentially a similarity matrix of all the partitions.
-    partition_connections = compute_partition_similarity_matrix(full_graph, part_graph, n_partitions, threshold)
+    partition_connections = compute_partition_similarity_matrix(graph, n_partitions, threshold)
 
     # Given the similarity matrix, find the combinations with maximum overlap.
     # By doing this now, we reduce the number of move/removal operations later.
     train_partitions, test_partitions, val_partitions = find_best_partition_combinations(partition_connections, n_train, n_test)
-    # Given the new assignments, update the graph.
-    # part_graph has the following format: {'C0IW58': {'cluster': 0.0, 'C-size': 124, 'label-counts': array([92, 32])}
-
-    # Compute the new statistics to add to the nodes.
-    df = pd.DataFrame(((d) for n,d in full_graph.nodes(data=True)))
-    df['cluster'] = [part_graph.nodes[n]['cluster'] for n in full_graph.nodes()]
-    df['AC'] = [n for n in full_graph.nodes()]
-    df = df.groupby(['cluster','label-val'])['AC'].count().reset_index().pivot_table(values='AC',columns=['label-val'],index=['cluster'])
-
-    train_statistics = df.loc[[float(x) for x in train_partitions]].sum(axis=0)
-    train_attributes = {'cluster': 0.0, 'C-size': sum(train_statistics), 'label-counts': train_statistics.to_numpy()}
-    test_statistics = df.loc[[float(x) for x in test_partitions]].sum(axis=0)
-    test_attributes = {'cluster': 1.0, 'C-size': sum(test_statistics), 'label-counts': test_statistics.to_numpy()}
-    val_statistics = df.loc[[float(x) for x in val_partitions]].sum(axis=0)
-    val_attributes = {'cluster': 2.0, 'C-size': sum(val_statistics), 'label-counts': val_statistics.to_numpy()}
-
 
-    # Now, update part_graph
-    for n, d in part_graph.nodes(data=True):
-        if int(d['cluster']) in train_partitions:
-            nx.set_node_attributes(part_graph, {n:train_attributes})
-        elif int(d['cluster']) in test_partitions:
-            nx.set_node_attributes(part_graph, {n:test_attributes})
-        else:
-            nx.set_node_attributes(part_graph, {n:val_attributes})
+    # Given the new assignments, update the graph. train is 0, test is 1 and val is 2.
+    new_cluster = np.full(n_partitions, 2.0)
+    new_cluster[list(train_partitions)] = 0.0
+    new_cluster[list(test_partitions)] = 1.0
+    graph.cluster = new_cluster[graph.cluster.astype(int)]
 
 
 
@@ -21,3 +21,31 @@ INVERSE_TRANSFORMATIONS = {
     'None': lambda x: x,
     None: lambda x: x
 }
+
+
+def _array_inverse(x: np.ndarray) -> np.ndarray:
+    out = np.full(x.shape, np.inf)
+    np.divide(1, x, out=out, where=x > 0)
+    return out
+
+## Element-wise versions of TRANSFORMATIONS, for transforming a batch of values at once.
+ARRAY_TRANSFORMATIONS = {
+    'one-minus': lambda x: 1-x, 
+    'inverse': _array_inverse, 
+    'square': lambda x: x**2,
+    'log': lambda x: np.log(x),
+    'none': lambda x: x,
+    'None': lambda x: x,
+    None: lambda x: x
+}
+
+## Element-wise versions of INVERSE_TRANSFORMATIONS.
+ARRAY_INVERSE_TRANSFORMATIONS = {
+    'one-minus': lambda x: 1-x, 
+    'inverse': _array_inverse, 
+    'square': lambda x: np.sqrt(x),
+    'log': lambda x: np.exp(x),
+    'none': lambda x: x,
+    'None': lambda x: x,
+    None: lambda x: x
+}
@@ -7,7 +7,6 @@ with open(os.path.join("README.md")) as f:
 
 requirements = [
     "numpy>=1.19.5",
-    "networkx>=2.5.1",
     "tqdm>=4.62.3",
     "pandas>=1.1.5"
 ]
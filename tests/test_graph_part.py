@@ -0,0 +1,101 @@
+import contextlib
+import io
+import numpy as np
+import pytest
+from graph_part.entity_graph import EdgeAccumulator, EntityGraph
+from graph_part.graph_part import collapse_duplicates, load_entities, restricted_linkage, run_partitioning
+
+
+def test_restricted_linkage_breaks_ties_in_insertion_order():
+    graph = EntityGraph()
+    graph.add_nodes(['A', 'B', 'C', 'D'], False, 0)
+    # all edges tie. A-C was added before A-B, so it is linked first and
+    # fills the cluster of A, then B links to D.
+    graph.add_edges(np.array([0, 0, 1]), np.array([2, 1, 3]), np.array([0.1, 0.1, 0.1]))
+    graph.finalize()
+    clusters = restricted_linkage(graph, threshold=0.5, part_size=2, label_limits=np.array([100]))
+    assert clusters.tolist() == [0, 1, 0, 1]
+
+
+def test_restricted_linkage_skips_removed_nodes_and_long_edges():
+    graph = EntityGraph()
+    graph.add_nodes(['A', 'B', 'C', 'D'], False, 0)
+    graph.add_edges(np.array([0, 1, 2]), np.array([1, 2, 3]), np.array([0.1, 0.2, 0.9]))
+    graph.finalize()
+    graph.remove_nodes(np.array([1]))
+    clusters = restricted_linkage(graph, threshold=0.5, part_size=4, label_limits=np.array([100]))
+    assert clusters.tolist() == [0, 1, 2, 3]
+
+
+def test_edge_accumulator_keeps_minimum_metric_and_first_rank():
+    edges = EdgeAccumulator()
+    edges.add([0, 2, 1], [1, 1, 0], [0.5, 0.3, 0.2])
+    edges.add([1, 3, 2, 3], [2, 3, 0, 0], [0.1, 0.0, 0.4, 0.6])
+    edges.compact()
+    edges.add([0, 1], [3, 0], [0.7, 0.9])
+
+    src, dst, metric, rank = edges.edges()
+    # pairs are stored as (min, max), self-pairs are dropped.
+    assert list(zip(src.tolist(), dst.tolist())) == [(0, 1), (0, 2), (0, 3), (1, 2)]
+    assert metric.tolist() == [0.2, 0.4, 0.6, 0.1]
+    # the rank of a pair is its first insertion, whichever occurrence has the minimum metric.
+    assert rank.tolist() == [0, 5, 6, 1]
+
+
+## Entities and a shuffled edge list with repeated, reversed and tied pairs.
+FASTA = ''.join(f'>N{i}|label={label}|priority=0\nAAAA\n' for i, label in enumerate([0, 0, 1, 1, 1, 1, 0, 0, 0, 1, 0, 1, 1, 0, 1, 0, 0, 0]))
+EDGES = '''N7,N13,0.6
+N15,N8,0.8
+N17,N3,0.7
+N9,N4,0.6
+N2,N14,0.7
+N15,N10,0.5
+N2,N17,0.7
+N15,N10,0.7
+N8,N13,0.8
+N6,N17,0.9
+N3,N0,0.8
+N0,N3,0.8
+N6,N2,0.8
+N17,N6,0.8
+N15,N8,0.8
+N1,N14,0.8
+N15,N11,0.7
+N17,N2,0.7
+N15,N12,0.9
+N9,N13,0.8
+N14,N11,0.5
+N12,N15,0.6
+N14,N11,0.8
+N11,N14,0.9
+N0,N7,0.8
+'''
+
+## Partitions of the networkx implementation for EDGES, entities that were removed are missing.
+EXPECTED = {'N2': 2, 'N3': 2, 'N4': 2, 'N5': 1, 'N6': 2, 'N7': 2, 'N9': 2, 'N10': 1,
+            'N12': 1, 'N13': 2, 'N14': 2, 'N15': 1, 'N16': 0, 'N17': 2}
+
+
+@pytest.mark.parametrize('initialization_mode', ['slow-nn', 'fast-nn'])
+def test_partitions_of_shuffled_edge_list(tmp_path, initialization_mode):
+    (tmp_path / 'entities.fasta').write_text(FASTA)
+    (tmp_path / 'edges.csv').write_text(EDGES)
+    config = dict(alignment_mode='precomputed', fasta_file=str(tmp_path / 'entities.fasta'), edge_file=str(tmp_path / 'edges.csv'),
+                  metric_column=2, threshold=0.35, partitions=3, transformation='one-minus', out_file=None, priority_name='priority',
+                  labels_name='label', initialization_mode=initialization_mode, test_ratio=0, val_ratio=0, save_checkpoint_path=None,
+                  allow_moving=True, removal_type=True, denominator='full', threads=1, nucleotide=False, prefilter=False)
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        df = run_partitioning(config, write_output_file=False, write_json_report=False, verbose=False)
+    assert df['cluster'].astype(int).to_dict() == EXPECTED
+
+
+def test_collapse_duplicates_with_other_header_separators(tmp_path):
+    (tmp_path / 'entities.fasta').write_text('>P1:label=a\nMKVLA\n>P2 - label=b\nMKVLA\n>P3|label=a\nmkvla\n>P4:label=b\nMKVLW\n')
+    graph, _ = load_entities(str(tmp_path / 'entities.fasta'), 'priority', 'label')
+    assert graph.ids == ['P1', 'P2', 'P3', 'P4']
+    # identical sequences, ignoring case, are aligned once.
+    assert collapse_duplicates(str(tmp_path / 'entities.fasta'), graph, 'one-minus', 0.3, str(tmp_path / 'unique.fasta')) == 2
+    assert (tmp_path / 'unique.fasta').read_text() == '>P1:label=a\nMKVLA\n>P4:label=b\nMKVLW\n'
+    graph.finalize()
+    src, dst, metric = graph.edge_arrays()
+    assert sorted(zip(src.tolist(), dst.tolist(), metric.tolist())) == [(0, 1, 0.0), (0, 2, 0.0), (1, 2, 0.0)]
@@ -0,0 +1,51 @@
+from itertools import combinations
+import numpy as np
+import pytest
+from graph_part import kmer_utils
+from graph_part.kmer_utils import candidate_pairs
+
+
+def brute_force_pairs(seqs, k, min_shared):
+    '''
+    Pairs that share at least min_shared distinct k-mers, counted with sets, and all
+    pairs of sequences with fewer k-mers than that. Pairs that are only kept because
+    of a short sequence report 0 shared k-mers.
+    '''
+    kmers = [{seq.upper()[i:i+k] for i in range(len(seq) - k + 1)} for seq in seqs]
+    pairs = []
+    for qry, lib in combinations(range(len(seqs)), 2):
+        n_shared = len(kmers[qry] & kmers[lib])
+        if n_shared >= min_shared:
+            pairs.append((qry, lib, n_shared))
+        elif len(kmers[qry]) < min_shared or len(kmers[lib]) < min_shared:
+            pairs.append((qry, lib, 0))
+    return pairs
+
+
+@pytest.fixture
+def seqs():
+    rng = np.random.default_rng(3)
+    ancestors = [''.join(rng.choice(list('ACDEFGHIKL'), 40)) for _ in range(4)]
+    seqs = []
+    for i in range(60):
+        seq = np.array(list(ancestors[i % 4]))
+        mutated = rng.random(len(seq)) < 0.4
+        seq[mutated] = rng.choice(list('ACDEFGHIKL'), mutated.sum())
+        seqs.append(''.join(seq)[:rng.integers(20, 41)])
+    # short sequences have too few k-mers to be judged, and are paired with all others.
+    return seqs + ['ACD', 'ac', '', 'acdefg']
+
+
+@pytest.mark.parametrize('k,min_shared', [(1, 1), (2, 5), (3, 2), (3, 5), (4, 3)])
+@pytest.mark.parametrize('block_size', [None, 1, 50])
+def test_candidate_pairs_match_brute_force(monkeypatch, seqs, k, min_shared, block_size):
+    if block_size is not None:
+        monkeypatch.setattr(kmer_utils, 'BLOCK_CELLS', block_size * len(seqs))
+        monkeypatch.setattr(kmer_utils, 'BLOCK_POSTINGS', block_size)
+    qrys, libs, shared = candidate_pairs(seqs, k, min_shared)
+    assert list(zip(qrys.tolist(), libs.tolist(), shared.tolist())) == brute_force_pairs(seqs, k, min_shared)
+
+
+def test_candidate_pairs_without_sequences():
+    qrys, libs, shared = candidate_pairs([], 3, 2)
+    assert len(qrys) == len(libs) == len(shared) == 0
@@ -0,0 +1,45 @@
+import io
+import pytest
+from graph_part import needle_utils
+from graph_part.needle_utils import parse_needle_output
+
+
+def needle_pair_output(pairs):
+    '''needleall pair format output of (query, library, matches, gaps, length) alignments.'''
+    out = ['########################################\n# Program: needleall\n# Rundate: today\n########################################\n\n']
+    for qry, lib, matches, gaps, length in pairs:
+        out.append('#=======================================\n#\n# Aligned_sequences: 2\n')
+        out.append(f'# 1: {qry}\n# 2: {lib}\n# Matrix: EBLOSUM62\n# Gap_penalty: 10.0\n# Extend_penalty: 0.5\n#\n')
+        out.append(f'# Length: {length}\n')
+        out.append(f'# Identity:    {matches:5d}/{length} ({100*matches/length:5.1f}%)\n')
+        out.append(f'# Similarity:  {matches:5d}/{length} ({100*matches/length:5.1f}%)\n')
+        out.append(f'# Gaps:        {gaps:5d}/{length} ({100*gaps/length:5.1f}%)\n# Score: 42.0\n#\n#\n#=======================================\n\n')
+        # the alignment itself, which the parser skips.
+        out.append(f'{qry[:13]:<13} 1 MKVLAAGIVALLLAAGCSSSKEETSGE     27\n              |||||.|||||||| ||||||\n{lib[:13]:<13} 1 MKVLAQGIVALLLA-GCSSKEETSGE     26\n\n\n')
+    out.append('#---------------------------------------\n#---------------------------------------\n')
+    return ''.join(out).encode()
+
+
+PAIRS = [(f'Q{i}|label=1', f'L{j}', (7 * i + 3 * j) % 50, (i + j) % 9, 50 + i) for i in range(12) for j in range(5)]
+SEQ_LENS = {**{f'Q{i}': 40 + i for i in range(12)}, **{f'L{j}': 45 + j for j in range(5)}}
+
+
+@pytest.mark.parametrize('read_size', [1, 2, 7, 64, 333, 1 << 20])
+@pytest.mark.parametrize('denominator', ['full', 'no_gaps', 'shortest'])
+def test_parse_needle_output_across_blocks(monkeypatch, read_size, denominator):
+    monkeypatch.setattr(needle_utils, 'READ_SIZE', read_size)
+    parsed = list(parse_needle_output(io.BytesIO(needle_pair_output(PAIRS)), denominator, SEQ_LENS))
+
+    assert [(qry, lib) for qry, lib, _ in parsed] == [(qry.split('|')[0], lib) for qry, lib, *_ in PAIRS]
+    for (_, _, identity), (qry, lib, matches, gaps, length) in zip(parsed, PAIRS):
+        qry = qry.split('|')[0]
+        if denominator == 'full':
+            assert identity == float(f'{100*matches/length:.1f}') / 100
+        elif denominator == 'no_gaps':
+            assert identity == pytest.approx(matches / (length - gaps))
+        else:
+            assert identity == pytest.approx(matches / min(SEQ_LENS[qry], SEQ_LENS[lib]))
+
+
+def test_parse_needle_output_empty():
+    assert list(parse_needle_output(io.BytesIO(b''), 'full', {})) == []
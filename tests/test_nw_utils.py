@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from graph_part.nw_utils import Scoring, align_batch, load_matrix
+
+
+def reference_alignment(qry, lib, matrix, gapopen, gapextend, endweight, endopen, endextend):
+    '''
+    Textbook Gotoh alignment of a single pair, cell by cell. Alignments are compared
+    by score, then by identical positions, then by fewer gap columns.
+    Returns the number of identical positions and gap columns of the best alignment.
+    '''
+    alphabet, scores = load_matrix(matrix)
+    n, m = len(qry), len(lib)
+    neg = (-np.inf, 0, 0)
+    def extend(key, penalty):
+        return (key[0] - penalty, key[1], key[2] - 1)
+    def costs(is_end):
+        if not is_end:
+            return gapopen, gapextend
+        return (endopen, endextend) if endweight else (0, 0)
+
+    H = [[neg] * (m + 1) for _ in range(n + 1)]
+    X = [[neg] * (m + 1) for _ in range(n + 1)]
+    Y = [[neg] * (m + 1) for _ in range(n + 1)]
+    H[0][0] = (0, 0, 0)
+    for i in range(n + 1):
+        for j in range(m + 1):
+            if i == 0 and j == 0:
+                continue
+            if j > 0:
+                # gap in the query, an end gap in the first and in the last row.
+                open_cost, ext_cost = costs(i == 0 or i == n)
+                X[i][j] = max(extend(H[i][j-1], open_cost), extend(X[i][j-1], ext_cost))
+            if i > 0:
+                open_cost, ext_cost = costs(j == 0 or j == m)
+                Y[i][j] = max(extend(H[i-1][j], open_cost), extend(Y[i-1][j], ext_cost))
+            M = neg
+            if i > 0 and j > 0:
+                a, b = alphabet.index(qry[i-1]), alphabet.index(lib[j-1])
+                prev = H[i-1][j-1]
+                M = (prev[0] + scores[a, b], prev[1] + (qry[i-1] == lib[j-1]), prev[2])
+            H[i][j] = max(M, X[i][j], Y[i][j])
+    return H[n][m][1], -H[n][m][2]
+
+
+def encode(seqs):
+    codes = np.zeros((len(seqs), max(len(s) for s in seqs)), dtype=np.uint8)
+    for i, s in enumerate(seqs):
+        codes[i, :len(s)] = np.frombuffer(s.encode(), dtype=np.uint8)
+    return codes, np.array([len(s) for s in seqs], dtype=np.int64)
+
+
+@pytest.mark.parametrize('gapopen,gapextend,endweight', [(10, 0.5, False), (10, 0.5, True), (3, 1, False), (2, 2, True)])
+def test_align_batch_matches_reference(gapopen, gapextend, endweight):
+    rng = np.random.default_rng(0)
+    # a small alphabet makes many equally scoring alignments, whose ties need to be broken the same way.
+    qrys = [''.join(rng.choice(list('ACDEW'), rng.integers(1, 13))) for _ in range(150)]
+    libs = [''.join(rng.choice(list('ACDEW'), rng.integers(1, 13))) for _ in range(150)]
+    endopen, endextend = 5, 0.5
+    scoring = Scoring('EBLOSUM62', gapopen, gapextend, endweight, endopen, endextend)
+
+    qry_codes, qry_lens = encode(qrys)
+    lib_codes, lib_lens = encode(libs)
+    matches, gaps = align_batch(qry_codes, lib_codes, qry_lens, lib_lens, scoring)
+
+    expected = [reference_alignment(q, l, 'EBLOSUM62', gapopen, gapextend, endweight, endopen, endextend) for q, l in zip(qrys, libs)]
+    assert matches.tolist() == [e[0] for e in expected]
+    assert gaps.tolist() == [e[1] for e in expected]
+
+
+def test_align_batch_identity_ignores_case():
+    scoring = Scoring('EBLOSUM62')
+    qry_codes, qry_lens = encode(['MKVLA', 'mkvla'])
+    lib_codes, lib_lens = encode(['MKVLA', 'MKVLA'])
+    matches, gaps = align_batch(qry_codes, lib_codes, qry_lens, lib_lens, scoring)
+    assert matches.tolist() == [5, 5]
+    assert gaps.tolist() == [0, 0]
@@ -0,0 +1,90 @@
+import contextlib
+import io
+import numpy as np
+import pandas as pd
+import pytest
+from graph_part.graph_part import load_entities, run_partitioning
+from graph_part.precomputed_utils import load_edge_list, read_binary_edge_list, write_binary_edge_list
+
+
+@pytest.mark.parametrize('name', ['edges.bin', 'edges.bin.gz', 'edges.bin.bz2', 'edges.bin.xz'])
+def test_binary_edge_list_round_trip(tmp_path, name):
+    rng = np.random.default_rng(0)
+    ids = [f'P{i}' for i in range(100)]
+    src, dst = rng.integers(0, 100, 1000), rng.integers(0, 100, 1000)
+    metric = rng.random(1000)
+    write_binary_edge_list(str(tmp_path / name), ids, src, dst, metric)
+
+    read_ids, read_src, read_dst, read_metric = read_binary_edge_list(str(tmp_path / name))
+    assert read_ids == ids
+    assert np.array_equal(read_src, src)
+    assert np.array_equal(read_dst, dst)
+    # float64 on disk, the metric is exact.
+    assert np.array_equal(read_metric, metric)
+
+
+def test_binary_edge_list_without_edges(tmp_path):
+    write_binary_edge_list(str(tmp_path / 'edges.bin'), [], np.zeros(0), np.zeros(0), np.zeros(0))
+    ids, src, dst, metric = read_binary_edge_list(str(tmp_path / 'edges.bin'))
+    assert ids == [] and len(src) == len(dst) == len(metric) == 0
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    '''A fasta file with labels and a csv edge list of identities between its entries.'''
+    rng = np.random.default_rng(1)
+    n = 90
+    with open(tmp_path / 'entities.fasta', 'w') as f:
+        for i in range(n):
+            f.write(f'>E{i}|label={i % 2}|priority=0\n')
+            f.write(''.join(rng.choice(list('ACDEFGHIKLMNPQRSTVWY'), 30)) + '\n')
+    pairs = {(int(a), int(b)) for a, b in rng.integers(0, n, (200, 2)) if a != b}
+    with open(tmp_path / 'edges.csv', 'w') as f:
+        for a, b in sorted(pairs):
+            f.write(f'E{a},E{b},{rng.random():.4f}\n')
+    return tmp_path
+
+
+def partition(fasta_fp, edge_fp, checkpoint_fp=None, checkpoint_format='csv'):
+    config = dict(alignment_mode='precomputed', fasta_file=fasta_fp, edge_file=edge_fp, metric_column=2, threshold=0.5, partitions=3,
+                  transformation='one-minus', out_file=None, priority_name='priority', labels_name='label', initialization_mode='slow-nn',
+                  test_ratio=0, val_ratio=0, save_checkpoint_path=checkpoint_fp, checkpoint_format=checkpoint_format, allow_moving=True,
+                  removal_type=True, denominator='full', threads=1, nucleotide=False, prefilter=False)
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        return run_partitioning(config, write_output_file=False, write_json_report=False, verbose=False)
+
+
+def edge_set(fasta_fp, edge_fp):
+    graph, _ = load_entities(fasta_fp, 'priority', 'label')
+    with contextlib.redirect_stderr(io.StringIO()):
+        load_edge_list(edge_fp, graph, 'one-minus', 0.5, 2)
+    graph.finalize()
+    src, dst, metric = graph.edge_arrays()
+    return {(graph.ids[a], graph.ids[b]): m for a, b, m in zip(src.tolist(), dst.tolist(), metric.tolist())}
+
+
+@pytest.mark.parametrize('name,checkpoint_format', [('checkpoint.csv', 'csv'), ('checkpoint.csv.gz', 'csv'),
+                                                    ('checkpoint.bin', 'binary'), ('checkpoint.bin.xz', 'binary')])
+def test_checkpoint_round_trip(dataset, name, checkpoint_format):
+    fasta_fp, edge_fp, checkpoint_fp = str(dataset / 'entities.fasta'), str(dataset / 'edges.csv'), str(dataset / name)
+    first = partition(fasta_fp, edge_fp, checkpoint_fp, checkpoint_format)
+
+    expected, loaded = edge_set(fasta_fp, edge_fp), edge_set(fasta_fp, checkpoint_fp)
+    assert loaded.keys() == expected.keys()
+    assert [loaded[pair] for pair in expected] == pytest.approx(list(expected.values()))
+
+    # the checkpoint replaces the alignments of a second run.
+    second = partition(fasta_fp, checkpoint_fp)
+    pd.testing.assert_frame_equal(first, second)
+
+
+@pytest.mark.parametrize('row, error', [('E3,E4\n', ValueError), ('"E3,E4,0.5\n', ValueError), ('E3,E4,high\n', TypeError)])
+def test_malformed_edge_list_row(dataset, row, error):
+    '''A malformed row after the first reports the column count, an unreadable metric the metric column.'''
+    with open(dataset / 'edges.csv', 'a') as f:
+        f.write(row)
+        f.write('E5,E6,0.5\n')
+    with pytest.raises(error) as excinfo:
+        edge_set(str(dataset / 'entities.fasta'), str(dataset / 'edges.csv'))
+    assert type(excinfo.value) is error
+    assert ('three comma' in str(excinfo.value)) == (error is ValueError)
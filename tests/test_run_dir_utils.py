@@ -0,0 +1,135 @@
+import contextlib
+import io
+import os
+import time
+import numpy as np
+import pytest
+from graph_part import needle_utils
+from graph_part.entity_graph import EntityGraph
+from graph_part.needle_utils import generate_edges_mp, parse_fasta
+from graph_part.run_dir_utils import CLAIMED, QUEUE, claim_tile, open_run_dir, queue_tiles, requeue_stale_claims, shard_path, write_shard
+
+
+@pytest.fixture
+def fasta_fp(tmp_path):
+    '''Families of similar sequences, so that there are edges within and between chunks.'''
+    rng = np.random.default_rng(2)
+    alphabet = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+    with open(tmp_path / 'entities.fasta', 'w') as f:
+        for family in range(8):
+            ancestor = rng.choice(alphabet, 40)
+            for member in range(5):
+                seq = np.where(rng.random(40) < 0.3, rng.choice(alphabet, 40), ancestor)
+                f.write(f'>F{family}_{member}|label={member % 2}\n{"".join(seq)}\n')
+    return str(tmp_path / 'entities.fasta')
+
+
+def fake_compute_edges(aligned):
+    '''compute_edges without needleall, the identity of a pair is its fraction of identical positions.'''
+    def compute_edges(query_fp, library_fp, transformation, threshold, seq_lens, *args):
+        aligned.append((query_fp, library_fp))
+        qry_ids, qry_seqs = parse_fasta(query_fp)
+        lib_ids, lib_seqs = parse_fasta(library_fp)
+        qrys, libs, metrics = [], [], []
+        for qry, qry_seq in zip(qry_ids, qry_seqs):
+            for lib, lib_seq in zip(lib_ids, lib_seqs):
+                metric = 1 - sum(a == b for a, b in zip(qry_seq, lib_seq)) / max(len(qry_seq), len(lib_seq))
+                if qry != lib and metric <= threshold:
+                    qrys.append(qry.lstrip('>'))
+                    libs.append(lib.lstrip('>'))
+                    metrics.append(metric)
+        return len(qry_ids) * len(lib_ids), (qrys, libs, metrics), 0.0
+    return compute_edges
+
+
+def graph_edges(fasta_fp, **kwargs):
+    ids, _ = parse_fasta(fasta_fp)
+    graph = EntityGraph()
+    graph.add_nodes([id.lstrip('>') for id in ids], False, 0)
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        generate_edges_mp(fasta_fp, graph, 'one-minus', 0.5, n_chunks=3, **kwargs)
+    graph.finalize()
+    src, dst, metric = graph.edge_arrays()
+    return sorted(zip(src.tolist(), dst.tolist(), metric.tolist()))
+
+
+@pytest.fixture
+def aligned(monkeypatch):
+    aligned = []
+    monkeypatch.setattr(needle_utils, 'compute_edges', fake_compute_edges(aligned))
+    monkeypatch.setattr(needle_utils.shutil, 'which', lambda name: f'/usr/bin/{name}')
+    return aligned
+
+
+def test_resume_partial_run_dir(tmp_path, fasta_fp, aligned):
+    expected = graph_edges(fasta_fp)
+    assert len(expected) > 0
+
+    run_dir = str(tmp_path / 'run')
+    assert graph_edges(fasta_fp, run_dir=run_dir) == expected
+    shards = sorted(name for name in os.listdir(run_dir) if name.startswith('tile_'))
+    assert len(shards) == 9
+
+    # an interrupted run has only written some of its shards.
+    for name in shards[::2]:
+        os.remove(os.path.join(run_dir, name))
+    with pytest.raises(ValueError):
+        graph_edges(fasta_fp, run_dir=run_dir)
+
+    aligned.clear()
+    json_dict = {}
+    assert graph_edges(fasta_fp, run_dir=run_dir, resume=True, json_dict=json_dict) == expected
+    assert len(aligned) == len(shards[::2])
+    assert json_dict['resumed_tiles'] == len(shards) - len(shards[::2])
+
+
+def test_resume_with_other_parameters(tmp_path, fasta_fp, aligned):
+    run_dir = str(tmp_path / 'run')
+    graph_edges(fasta_fp, run_dir=run_dir)
+    with pytest.raises(ValueError):
+        graph_edges(fasta_fp, run_dir=run_dir, resume=True, gapopen=5)
+
+
+def test_open_run_dir_resume_keeps_plan(tmp_path, fasta_fp):
+    run_dir = str(tmp_path / 'run')
+    chunks = [np.array([2, 0]), np.array([1, 3])]
+    tiles = [(0, 0, 1), (0, 1, 2), (1, 1, 1)]
+    open_run_dir(run_dir, fasta_fp, {'threshold': 0.3}, lambda: (chunks, tiles, 5))
+
+    def plan():
+        raise AssertionError('a resumed run keeps its plan')
+    read_chunks, read_tiles, n_pruned = open_run_dir(run_dir, fasta_fp, {'threshold': 0.3}, plan, resume=True)
+    assert [chunk.tolist() for chunk in read_chunks] == [chunk.tolist() for chunk in chunks]
+    assert read_tiles == tiles
+    assert n_pruned == 5
+
+
+def test_stale_claims_are_queued_again(tmp_path):
+    run_dir = str(tmp_path)
+    tiles = [(0, 0, 1), (0, 1, 1), (1, 1, 1)]
+    queue_tiles(run_dir, tiles, set())
+    (first, first_claim), (second, second_claim) = claim_tile(run_dir), claim_tile(run_dir)
+    write_shard(run_dir, (*second, 1), np.zeros(0), np.zeros(0), np.zeros(0), 0, 0.0)
+
+    # fresh claims are kept.
+    assert requeue_stale_claims(run_dir, lease_seconds=60) == 0
+    assert len(os.listdir(os.path.join(run_dir, CLAIMED))) == 2
+
+    # an expired claim is queued again, unless the tile was finished.
+    old = time.time() - 120
+    os.utime(first_claim, (old, old))
+    os.utime(second_claim, (old, old))
+    assert requeue_stale_claims(run_dir, lease_seconds=60) == 1
+    assert os.listdir(os.path.join(run_dir, CLAIMED)) == []
+    assert sorted(os.listdir(os.path.join(run_dir, QUEUE))) == ['000000_0_0', '000002_1_1']
+    assert os.path.exists(shard_path(run_dir, (*second, 1)))
+    assert claim_tile(run_dir)[0] == first
+
+
+def test_run_dir_with_repeated_accessions(tmp_path, fasta_fp, aligned):
+    # the second entry of each family repeats the accession of the first one.
+    with open(fasta_fp) as f:
+        text = f.read().replace('_1|', '_0|')
+    with open(fasta_fp, 'w') as f:
+        f.write(text)
+    assert graph_edges(fasta_fp, run_dir=str(tmp_path / 'run')) == graph_edges(fasta_fp)